@@ -1,29 +1,34 @@
 # Added imports and router definition before any @router usage to avoid NameError
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Header
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Header, Response, Body, Request
 from fastapi.encoders import jsonable_encoder
-from sqlalchemy.orm import Session
-from database import SessionLocal, init_db, get_db
-from models import User, Warehouse, Supplier, Consumer, Drug, Inventory, OperationLog, Transfer, SystemSettings, Permission, Tool, ToolInventory
-from passlib.context import CryptContext
-from datetime import datetime, timedelta
-import shutil, os
+from sqlalchemy import and_, or_, func, inspect
+from sqlalchemy.orm import Session, undefer, joinedload
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from database import SessionLocal, init_db, get_db, SQLITE_BEGIN_OPTION
+from models import User, Warehouse, Supplier, Consumer, Drug, Inventory, OperationLog, Transfer, SystemSettings, Permission, Tool, ToolInventory, StockSummary
+from datetime import date, datetime, timedelta
+import shutil, os, json, base64, csv, io, re, tempfile, hashlib, uuid
 from PIL import Image
-from fastapi.responses import FileResponse, JSONResponse
-import pandas as pd
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.pagesizes import A4
-import arabic_reshaper
-from bidi.algorithm import get_display
-import jdatetime
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from openpyxl import Workbook, load_workbook
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import reports
+import refcache
+import events
+import changelog
+import principals
+import passwords
+import imagestore
+import backups
+from principals import Principal
 import jwt
 from functools import wraps
 from typing import Optional
 from pydantic import BaseModel
 
 router = APIRouter()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # JWT Settings
 SECRET_KEY = "your-secret-key-change-in-production"
@@ -49,23 +54,39 @@ def verify_token(authorization: str = Header(None)):
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="توکن نامعتبر است")
 
-def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)):
+def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)) -> Principal:
+    """
+    کاربر احراز هویت شده از کش principals (بدون کوئری تا زمانی که ورودی کش معتبر است)
+    توکن‌های صادر شده قبل از تغییر رمز (token_version قدیمی) پذیرفته نمی‌شوند
+    """
     payload = verify_token(authorization)
-    user = db.query(User).filter(User.id == payload.get('user_id')).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="کاربر یافت نشد")
-    return user
+    user_id = payload.get('user_id')
+    token_version = payload.get('tv', 0)
+    
+    def load():
+        user = db.query(User).options(joinedload(User.warehouses), joinedload(User.permissions)).filter(User.id == user_id).first()
+        if not user:
+            raise HTTPException(status_code=404, detail="کاربر یافت نشد")
+        if (user.token_version or 0) != token_version:
+            raise HTTPException(status_code=401, detail="توکن منقضی شده است")
+        return Principal.from_user(user)
+    
+    return principals.get(user_id, token_version, load)
+
+def issue_token(user: User) -> str:
+    return create_access_token({"user_id": user.id, "username": user.username,
+                                "access_level": user.access_level, "tv": user.token_version or 0})
 
 def require_access(access_levels: list):
     def decorator(func):
-        async def wrapper(*args, current_user: User = Depends(get_current_user), **kwargs):
+        async def wrapper(*args, current_user: Principal = Depends(get_current_user), **kwargs):
             if current_user.access_level not in access_levels:
                 raise HTTPException(status_code=403, detail="شما دسترسی به این عملیات را ندارید")
             return await func(*args, current_user=current_user, **kwargs)
         return wrapper
     return decorator
 
-def require_edit_permission(current_user: User = Depends(get_current_user)):
+def require_edit_permission(current_user: Principal = Depends(get_current_user)):
     """
     Prevent viewers from editing/creating/deleting
     Only warehouseman, admin, superadmin can edit
@@ -74,7 +95,7 @@ def require_edit_permission(current_user: User = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="مشاهده‌گران دسترسی ثبت/ویرایش ندارند")
     return current_user
 
-def check_warehouse_access(user: User, warehouse_id: int):
+def check_warehouse_access(user: Principal, warehouse_id: int):
     """
     Check if user has access to specific warehouse
     - admin/superadmin: access to all warehouses
@@ -85,8 +106,7 @@ def check_warehouse_access(user: User, warehouse_id: int):
         return True
     
     if user.access_level == 'warehouseman':
-        user_warehouse_ids = [w.id for w in user.warehouses]
-        return warehouse_id in user_warehouse_ids
+        return warehouse_id in user.warehouse_ids
     
     return False
 
@@ -99,7 +119,12 @@ def get_db():
     finally:
         db.close()
 
-def log_operation(db: Session, action: str, details: str, user_id: int = None, current_user: User = None):
+def log_operation(db: Session, action: str, details: str, user_id: int = None, current_user: Principal = None):
+    """
+    Add an audit entry to the caller's session.
+    Does not commit: the entry is written in the same transaction as the change it describes,
+    so callers must log before their single db.commit().
+    """
     try:
         # If current_user provided, use their ID
         if current_user and not user_id:
@@ -112,7 +137,6 @@ def log_operation(db: Session, action: str, details: str, user_id: int = None, c
             timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         )
         db.add(log)
-        db.commit()
     except Exception as e:
         print(f"Failed to log operation: {e}")
 
@@ -127,65 +151,253 @@ def get_users_for_login(db: Session = Depends(get_db)):
     return [{"username": u.username, "full_name": u.full_name} for u in users]
 
 # User registration/login/password recovery
+# bcrypt runs in the password pool (passwords.py); these endpoints are async so a login waiting
+# for its hash holds no API thread, and their queries go through run_in_threadpool
+
+def find_user_by_username(db: Session, username: str):
+    return db.query(User).options(joinedload(User.warehouses)).filter(User.username == username).first()
+
+def save_password_hash(db: Session, user_id: int, hashed: str):
+    """Same password, new hash (rehash on login): sessions stay valid"""
+    db.query(User).filter(User.id == user_id).update({User.password: hashed}, synchronize_session=False)
+    db.commit()
+
+def set_password(db: Session, user: User, hashed: str) -> str:
+    """New password: tokens issued before the change stop working; returns a fresh token"""
+    user.password = hashed
+    user.token_version = (user.token_version or 0) + 1
+    db.commit()
+    principals.invalidate(user.id)
+    return issue_token(user)
+
 @router.post('/login')
-def login_user(username: str, password: str, db: Session = Depends(get_db)):
+async def login_user(username: str, password: str, db: Session = Depends(get_db)):
     # Convert username to lowercase for case-insensitive login
-    username_lower = username.lower()
-    user = db.query(User).filter(User.username == username_lower).first()
-    if not user or not pwd_context.verify(password, user.password):
+    user = await run_in_threadpool(find_user_by_username, db, username.lower())
+    if not user:
+        raise HTTPException(status_code=401, detail="نام کاربری یا رمز عبور اشتباه است")
+    valid, new_hash = await passwords.verify_password(password, user.password)
+    if not valid:
         raise HTTPException(status_code=401, detail="نام کاربری یا رمز عبور اشتباه است")
-    
-    token = create_access_token({"user_id": user.id, "username": user.username, "access_level": user.access_level})
-    
-    # Get user warehouses
-    user_warehouses_ids = [w.id for w in user.warehouses]
 
-    return {
+    response = {
         "id": user.id,
         "username": user.username,
         "full_name": user.full_name,
         "access_level": user.access_level,
-        "warehouses": user_warehouses_ids,
-        "token": token
+        "warehouses": [w.id for w in user.warehouses],
+        "token": issue_token(user)
     }
+    # Hash made with other bcrypt parameters: replace it now that the password is known
+    if new_hash:
+        await run_in_threadpool(save_password_hash, db, user.id, new_hash)
+    return response
 
 @router.post('/recover-password')
-def recover_password(username: str, new_password: str, db: Session = Depends(get_db)):
+async def recover_password(username: str, new_password: str, db: Session = Depends(get_db)):
     # Convert username to lowercase for case-insensitive recovery
-    username_lower = username.lower()
-    user = db.query(User).filter(User.username == username_lower).first()
+    user = await run_in_threadpool(find_user_by_username, db, username.lower())
     if not user:
         raise HTTPException(status_code=404, detail="کاربر یافت نشد")
-    user.password = pwd_context.hash(new_password)
-    db.commit()
+    hashed = await passwords.hash_password(new_password)
+    await run_in_threadpool(set_password, db, user, hashed)
     return {"message": "رمز عبور با موفقیت تغییر یافت"}
 
+# ---------- Conditional GET for list endpoints ----------
+
+# Table versions restart from zero with the process, so tags from an earlier run must never match
+ETAG_PROCESS_ID = uuid.uuid4().hex[:12]
+
+def table_versions(tables) -> str:
+    """Committed-write versions of the tables (see refcache); they only move forward within a process"""
+    return '.'.join(str(refcache.table_version(table)) for table in ('*', *tables))
+
+def list_etag(request: Request, tables) -> str:
+    """Strong ETag from the committed-write versions of the tables behind a list, plus the query string"""
+    versions = table_versions(tables)
+    query = '&'.join(sorted(f"{key}={value}" for key, value in request.query_params.multi_items()))
+    digest = hashlib.sha1(f"{request.url.path}?{query}|{versions}".encode('utf-8')).hexdigest()[:16]
+    return f'"{ETAG_PROCESS_ID}-{digest}"'
+
+def check_not_modified(request: Request, response: Response, tables):
+    """
+    Set ETag/Cache-Control on the response and return a 304 response when the client's copy is current.
+    Called before any query, so an unchanged list costs no database access.
+    """
+    etag = list_etag(request, tables)
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
+# ---------- Reference data (served from refcache) ----------
+
+def row_dict(obj) -> dict:
+    """Column values of an ORM row, for caching"""
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+
+def get_transit_warehouse_id(db: Session):
+    """شناسه انبار کالای در راه (TRANSIT) - None اگر وجود نداشته باشد"""
+    def load():
+        row = db.query(Warehouse.id).filter(Warehouse.code == "TRANSIT").first()
+        return row.id if row else None
+    return refcache.get_or_load(db, 'transit_warehouse_id', ['warehouses'], load)
+
+def get_system_settings(db: Session) -> dict:
+    return refcache.get_or_load(db, 'system_settings', ['system_settings'],
+                                lambda: {s.key: s.value for s in db.query(SystemSettings).all()})
+
+# ---------- Image store ----------
+
+# Store entries never change, so browsers may keep them for good
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def image_response(request: Request, digest: str, size: int, cache_control: str):
+    """A stored rendition with its content-derived ETag; 304 when the client already has it"""
+    if size not in imagestore.RENDITION_SIZES:
+        raise HTTPException(status_code=400, detail=f"اندازه تصویر باید یکی از {list(imagestore.RENDITION_SIZES)} باشد")
+    found = imagestore.rendition(digest, size)
+    if not found:
+        raise HTTPException(status_code=404, detail="تصویر یافت نشد")
+    path, media_type = found
+    etag = f'"{digest}-{size}"'
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+IMAGE_BUSY_DETAIL = "سرور در حال پردازش تصاویر دیگر است، لطفاً چند لحظه بعد دوباره تلاش کنید"
+INVALID_IMAGE_DETAIL = "فایل تصویر معتبر نیست"
+IMAGE_TOO_LARGE_DETAIL = f"حجم تصویر نباید بیش از {imagestore.MAX_UPLOAD_BYTES // (1024 * 1024)} مگابایت باشد"
+
+async def ingest_image(data: bytes) -> str:
+    """
+    Decode and encode in the image worker pool; the request holds no thread while it waits.
+    Call inside imagestore.pinned(digest_of(data)), held until the reference is committed.
+    """
+    try:
+        return await asyncio.wrap_future(imagestore.submit(data))
+    except imagestore.PoolBusy:
+        raise HTTPException(status_code=503, detail=IMAGE_BUSY_DETAIL)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise HTTPException(status_code=400, detail=INVALID_IMAGE_DETAIL)
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Upload bytes in chunks, refused with 413 as soon as they pass MAX_UPLOAD_BYTES"""
+    chunks = []
+    size = 0
+    while True:
+        chunk = await file.read(1024 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > imagestore.MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=IMAGE_TOO_LARGE_DETAIL)
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+def decode_data_url(image_data: str) -> bytes:
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    if len(image_data) * 3 // 4 > imagestore.MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=IMAGE_TOO_LARGE_DETAIL)
+    try:
+        return base64.b64decode(image_data)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=INVALID_IMAGE_DETAIL)
+
+class UploadSizeLimit:
+    """
+    ASGI middleware: request bodies on the given path prefixes are cut off with 413 while they
+    stream in (declared Content-Length first, then the bytes actually received), before
+    FastAPI has spooled a whole oversized upload. limits: {path prefix: max bytes}.
+    """
+    def __init__(self, app, limits: dict):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = None
+        if scope['type'] == 'http':
+            limit = next((size for prefix, size in self.limits.items() if scope['path'].startswith(prefix)), None)
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        content_length = dict(scope['headers']).get(b'content-length')
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse({"detail": IMAGE_TOO_LARGE_DETAIL}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=IMAGE_TOO_LARGE_DETAIL)
+            return message
+        return await self.app(scope, limited_receive, send)
+
+# Multipart overhead on top of the file; base64 in a JSON body is 4/3 of the image
+UPLOAD_BODY_LIMITS = {
+    '/api/upload-drug-image': imagestore.MAX_UPLOAD_BYTES + 64 * 1024,
+    '/api/tools': imagestore.MAX_UPLOAD_BYTES * 4 // 3 + 64 * 1024,
+}
+
+def remove_legacy_image(path):
+    """Per-item image files from before the image store (images/drug_X.jpg, images/tool_X.jpg)"""
+    full_path = os.path.join(os.path.dirname(__file__), path)
+    if os.path.exists(full_path):
+        try:
+            os.remove(full_path)
+        except OSError as e:
+            print(f"Error deleting image file: {e}")
+
+@router.get('/images/{digest}')
+def get_image(digest: str, request: Request, size: int = imagestore.FULL_SIZE):
+    """تصویر از مخزن تصاویر بر اساس هش محتوا - قابل کش دائمی در مرورگر"""
+    return image_response(request, digest, size, IMMUTABLE_CACHE_CONTROL)
+
 # CRUD for Warehouses, Suppliers, Consumers, Drugs
 @router.get('/warehouses')
-def get_warehouses(db: Session = Depends(get_db), include_virtual: bool = False):
+def get_warehouses(request: Request, response: Response, db: Session = Depends(get_db), include_virtual: bool = False):
     """
     دریافت لیست انبارها
     به طور پیش‌فرض، انبارهای مجازی (مانند TRANSIT) نمایش داده نمی‌شوند
     """
-    query = db.query(Warehouse)
-    if not include_virtual:
-        query = query.filter(Warehouse.is_virtual == False)
-    return query.all()
+    not_modified = check_not_modified(request, response, ['warehouses'])
+    if not_modified:
+        return not_modified
+    def load():
+        query = db.query(Warehouse)
+        if not include_virtual:
+            query = query.filter(Warehouse.is_virtual == False)
+        return [row_dict(w) for w in query.all()]
+    return refcache.get_or_load(db, ('warehouses', include_virtual), ['warehouses'], load)
 
 @router.post('/warehouses')
-def add_warehouse(data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def add_warehouse(data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can create warehouses
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند انبار تعریف کنند")
     warehouse = Warehouse(**data)
     db.add(warehouse)
+    log_operation(db, "Add Warehouse", f"افزودن انبار: {warehouse.name}")
     db.commit()
     db.refresh(warehouse)
-    log_operation(db, "Add Warehouse", f"افزودن انبار: {warehouse.name}")
     return warehouse
 
 @router.put('/warehouses/{warehouse_id}')
-def update_warehouse(warehouse_id: int, data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_warehouse(warehouse_id: int, data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can update warehouses
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند انبار ویرایش کنند")
@@ -194,12 +406,12 @@ def update_warehouse(warehouse_id: int, data: dict, db: Session = Depends(get_db
         raise HTTPException(status_code=404, detail="انبار یافت نشد")
     for key, value in data.items():
         setattr(warehouse, key, value)
-    db.commit()
     log_operation(db, "Update Warehouse", f"ویرایش انبار: {warehouse.name}")
+    db.commit()
     return warehouse
 
 @router.delete('/warehouses/{warehouse_id}')
-def delete_warehouse(warehouse_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_warehouse(warehouse_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can delete warehouses
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند انبار حذف کنند")
@@ -229,13 +441,45 @@ def delete_warehouse(warehouse_id: int, db: Session = Depends(get_db), current_u
         )
     
     db.delete(warehouse)
-    db.commit()
     log_operation(db, "Delete Warehouse", f"حذف انبار: {name}")
+    db.commit()
     return {"message": "انبار حذف شد"}
 
 @router.get('/drugs')
-def get_drugs(db: Session = Depends(get_db)):
-    return db.query(Drug).all()
+def get_drugs(request: Request, response: Response, db: Session = Depends(get_db), include_image_data: bool = False):
+    """
+    دریافت کاتالوگ داروها
+    به طور پیش‌فرض فقط ستون‌های اصلی برگردانده می‌شود و تصویر از طریق /images/{image_hash} دریافت می‌شود
+    """
+    not_modified = check_not_modified(request, response, ['drugs'])
+    if not_modified:
+        return not_modified
+    if include_image_data:
+        return db.query(Drug).options(undefer(Drug.image_data)).all()
+
+    # Lean catalog projection - never touches the base64 image_data column
+    def load():
+        rows = db.query(
+            Drug.id,
+            Drug.name,
+            Drug.dose,
+            Drug.package_type,
+            Drug.image,
+            Drug.image_hash,
+            Drug.description,
+            Drug.has_expiry_date
+        ).order_by(Drug.id).all()
+        return [{
+            'id': r.id,
+            'name': r.name,
+            'dose': r.dose,
+            'package_type': r.package_type,
+            'image': r.image,
+            'image_hash': r.image_hash,
+            'description': r.description,
+            'has_expiry_date': r.has_expiry_date
+        } for r in rows]
+    return refcache.get_or_load(db, 'drugs', ['drugs'], load)
 
 # Pydantic models for drug create/update (JSON body)
 class DrugCreate(BaseModel):
@@ -253,6 +497,7 @@ class DrugResponse(BaseModel):
     description: Optional[str] = None
     image: Optional[str] = None
     image_data: Optional[str] = None
+    image_hash: Optional[str] = None
     has_expiry_date: Optional[bool] = True
     
     class Config:
@@ -267,21 +512,21 @@ class DrugUpdate(BaseModel):
 
 
 @router.post('/drugs', response_model=DrugResponse)
-def add_drug(data: DrugCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def add_drug(data: DrugCreate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can create drugs
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند دارو تعریف کنند")
     drug = Drug(**data.dict())
     db.add(drug)
+    log_operation(db, "Add Drug", f"افزودن دارو: {drug.name}")
     db.commit()
     db.refresh(drug)
-    log_operation(db, "Add Drug", f"افزودن دارو: {drug.name}")
     # Return drug object - FastAPI will serialize it using DrugResponse model
     return drug
 
 
 @router.put('/drugs/{drug_id}', response_model=DrugResponse)
-def update_drug(drug_id: int, data: DrugUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_drug(drug_id: int, data: DrugUpdate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can update drugs
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند دارو ویرایش کنند")
@@ -290,14 +535,14 @@ def update_drug(drug_id: int, data: DrugUpdate, db: Session = Depends(get_db), c
         raise HTTPException(status_code=404, detail="دارو یافت نشد")
     for key, value in data.dict(exclude_unset=True).items():
         setattr(drug, key, value)
+    log_operation(db, "Update Drug", f"ویرایش دارو: {drug.name}")
     db.commit()
     db.refresh(drug)
-    log_operation(db, "Update Drug", f"ویرایش دارو: {drug.name}")
     return drug
     return JSONResponse(content=jsonable_encoder(drug))
 
 @router.delete('/drugs/{drug_id}')
-def delete_drug(drug_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_drug(drug_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can delete drugs
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند دارو حذف کنند")
@@ -325,31 +570,28 @@ def delete_drug(drug_id: int, db: Session = Depends(get_db), current_user: User
             detail=f"این دارو در {transfer_count} انتقال استفاده شده است. ابتدا انتقال‌های مربوطه را حذف کنید"
         )
     
-    # Delete image file from disk if exists
-    if drug.image:
-        image_path = drug.image
-        if os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-                print(f"Deleted image file: {image_path}")
-            except Exception as e:
-                print(f"Error deleting image file: {e}")
+    # Delete image file from disk if exists; store entries may be shared and are released after commit
+    image_hash = drug.image_hash
+    if drug.image and not image_hash:
+        remove_legacy_image(drug.image)
     
     # Delete drug from database (image_data will be automatically removed)
     db.delete(drug)
-    db.commit()
     
     # Log operation (keep log for audit trail)
     log_operation(db, "Delete Drug", f"حذف دارو: {name}")
+    db.commit()
+    imagestore.release(db, image_hash)
     
     return {"message": "دارو و تصاویر مربوطه حذف شد"}
 
 @router.get('/suppliers')
 def get_suppliers(db: Session = Depends(get_db)):
-    return db.query(Supplier).all()
+    return refcache.get_or_load(db, 'suppliers', ['suppliers'],
+                                lambda: [row_dict(s) for s in db.query(Supplier).all()])
 
 @router.post('/suppliers')
-def add_supplier(data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def add_supplier(data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can create suppliers
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند تأمین‌کننده تعریف کنند")
@@ -360,7 +602,7 @@ def add_supplier(data: dict, db: Session = Depends(get_db), current_user: User =
     return supplier
 
 @router.put('/suppliers/{supplier_id}')
-def update_supplier(supplier_id: int, data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_supplier(supplier_id: int, data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can update suppliers
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند تأمین‌کننده ویرایش کنند")
@@ -376,7 +618,7 @@ def update_supplier(supplier_id: int, data: dict, db: Session = Depends(get_db),
     return db_supplier
 
 @router.delete('/suppliers/{supplier_id}')
-def delete_supplier(supplier_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_supplier(supplier_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can delete suppliers
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند تأمین‌کننده حذف کنند")
@@ -394,16 +636,20 @@ def delete_supplier(supplier_id: int, db: Session = Depends(get_db), current_use
     
     name = db_supplier.name
     db.delete(db_supplier)
-    db.commit()
     log_operation(db, "Delete Supplier", f"حذف تأمین‌کننده: {name}")
+    db.commit()
     return {"message": "تأمین‌کننده با موفقیت حذف شد"}
 
 @router.get('/consumers')
-def get_consumers(db: Session = Depends(get_db)):
-    return db.query(Consumer).all()
+def get_consumers(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = check_not_modified(request, response, ['consumers'])
+    if not_modified:
+        return not_modified
+    return refcache.get_or_load(db, 'consumers', ['consumers'],
+                                lambda: [row_dict(c) for c in db.query(Consumer).all()])
 
 @router.post('/consumers')
-def add_consumer(data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def add_consumer(data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can create consumers
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند مصرف‌کننده تعریف کنند")
@@ -414,7 +660,7 @@ def add_consumer(data: dict, db: Session = Depends(get_db), current_user: User =
     return consumer
 
 @router.put('/consumers/{consumer_id}')
-def update_consumer(consumer_id: int, data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_consumer(consumer_id: int, data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can update consumers
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند مصرف‌کننده ویرایش کنند")
@@ -430,7 +676,7 @@ def update_consumer(consumer_id: int, data: dict, db: Session = Depends(get_db),
     return db_consumer
 
 @router.delete('/consumers/{consumer_id}')
-def delete_consumer(consumer_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_consumer(consumer_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only admin/superadmin can delete consumers
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط مدیران می‌توانند مصرف‌کننده حذف کنند")
@@ -448,16 +694,50 @@ def delete_consumer(consumer_id: int, db: Session = Depends(get_db), current_use
     
     name = db_consumer.name
     db.delete(db_consumer)
-    db.commit()
     log_operation(db, "Delete Consumer", f"حذف مصرف‌کننده: {name}")
+    db.commit()
     return {"message": "مصرف‌کننده با موفقیت حذف شد"}
 
+INVENTORY_PAGE_MAX = 500
+
+def encode_inventory_cursor(expire_date: Optional[str], inventory_id: int) -> str:
+    """Opaque keyset cursor for (expire_date, id) ordering"""
+    raw = json.dumps([expire_date, inventory_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_inventory_cursor(cursor: str):
+    try:
+        expire_date, inventory_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return expire_date, int(inventory_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="مکان‌نمای صفحه‌بندی نامعتبر است")
+
 @router.get('/inventory')
-def get_inventory(db: Session = Depends(get_db), include_virtual: bool = False, include_disposed: bool = False):
+def get_inventory(
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db),
+    include_virtual: bool = False,
+    include_disposed: bool = False,
+    warehouse_id: Optional[int] = None,
+    drug_id: Optional[int] = None,
+    supplier_id: Optional[int] = None,
+    expire_date_from: Optional[str] = None,
+    expire_date_to: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None
+):
     """
     دریافت موجودی انبارها
     به طور پیش‌فرض، موجودی انبارهای مجازی (TRANSIT) و داروهای معدوم شده نمایش داده نمی‌شود
+    با ارسال limit، نتایج به صورت صفحه‌بندی (keyset روی expire_date و id) برگردانده می‌شود:
+    - X-Total-Count: تعداد کل رکوردهای منطبق با فیلترها
+    - X-Next-Cursor: مقدار cursor برای دریافت صفحه بعد (در صفحه آخر ارسال نمی‌شود)
     """
+    not_modified = check_not_modified(request, response, ['inventory', 'warehouses'])
+    if not_modified:
+        return not_modified
+    
     query = db.query(Inventory)
     
     # Filter out disposed items by default
@@ -468,10 +748,72 @@ def get_inventory(db: Session = Depends(get_db), include_virtual: bool = False,
         # Join with Warehouse and filter out virtual warehouses
         query = query.join(Warehouse).filter(Warehouse.is_virtual == False)
     
-    return query.order_by(Inventory.expire_date.asc()).all()
+    if warehouse_id:
+        query = query.filter(Inventory.warehouse_id == warehouse_id)
+    if drug_id:
+        query = query.filter(Inventory.drug_id == drug_id)
+    if supplier_id:
+        query = query.filter(Inventory.supplier_id == supplier_id)
+    if expire_date_from:
+        query = query.filter(Inventory.expire_date >= expire_date_from)
+    if expire_date_to:
+        query = query.filter(Inventory.expire_date <= expire_date_to)
+    
+    response.headers["X-Total-Count"] = str(query.count())
+    
+    if cursor:
+        # SQLite sorts NULL expiry dates first, so the keyset predicate has to follow suit
+        last_expire, last_id = decode_inventory_cursor(cursor)
+        if last_expire is None:
+            query = query.filter(or_(
+                and_(Inventory.expire_date.is_(None), Inventory.id > last_id),
+                Inventory.expire_date.isnot(None)
+            ))
+        else:
+            query = query.filter(or_(
+                Inventory.expire_date > last_expire,
+                and_(Inventory.expire_date == last_expire, Inventory.id > last_id)
+            ))
+    
+    query = query.order_by(Inventory.expire_date.asc(), Inventory.id.asc())
+    
+    if limit is None:
+        return query.all()
+    
+    limit = max(1, min(limit, INVENTORY_PAGE_MAX))
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_inventory_cursor(rows[-1].expire_date, rows[-1].id)
+    return rows
+
+@router.get('/inventory/summary')
+def get_inventory_summary(
+    db: Session = Depends(get_db),
+    include_virtual: bool = False,
+    warehouse_id: Optional[int] = None,
+    drug_id: Optional[int] = None
+):
+    """
+    جمع موجودی هر دارو در هر انبار (بدون اقلام معدوم شده)
+    از جدول stock_summary خوانده می‌شود که همراه با هر تغییر موجودی به‌روز می‌شود
+    """
+    query = db.query(StockSummary)
+    if not include_virtual:
+        query = query.join(Warehouse, StockSummary.warehouse_id == Warehouse.id).filter(Warehouse.is_virtual == False)
+    if warehouse_id:
+        query = query.filter(StockSummary.warehouse_id == warehouse_id)
+    if drug_id:
+        query = query.filter(StockSummary.drug_id == drug_id)
+    return [{
+        'warehouse_id': row.warehouse_id,
+        'drug_id': row.drug_id,
+        'quantity': row.quantity,
+        'lot_count': row.lot_count
+    } for row in query.order_by(StockSummary.warehouse_id, StockSummary.drug_id).all()]
 
 @router.post('/inventory')
-def add_inventory(data: dict, db: Session = Depends(get_db), current_user: User = Depends(require_edit_permission)):
+def add_inventory(data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(require_edit_permission)):
     # Check warehouse access for warehousemen
     warehouse_id = data.get('warehouse_id')
     if not check_warehouse_access(current_user, warehouse_id):
@@ -491,30 +833,231 @@ def add_inventory(data: dict, db: Session = Depends(get_db), current_user: User
             existing.supplier_id = data['supplier_id']
         if 'entry_date' in data and data['entry_date']:
             existing.entry_date = data['entry_date']
-        db.commit()
-        db.refresh(existing)
         
         drug = db.query(Drug).filter(Drug.id == existing.drug_id).first()
         drug_name = drug.name if drug else "دارو نامشخص"
         log_operation(db, "Update Inventory (Duplicate)", f"افزایش {data.get('quantity', 0)} عدد به موجودی {drug_name} (انقضا: {data.get('expire_date')})")
+        db.commit()
+        db.refresh(existing)
         
         return existing
     
     # Create new inventory record
     inventory = Inventory(**data)
     db.add(inventory)
-    db.commit()
-    db.refresh(inventory)
     
     # Get drug name for log
     drug = db.query(Drug).filter(Drug.id == inventory.drug_id).first()
     drug_name = drug.name if drug else "دارو نامشخص"
     log_operation(db, "Add Inventory", f"رسید {inventory.quantity} عدد از {drug_name}")
+    db.commit()
+    db.refresh(inventory)
     
     return inventory
 
+BULK_RECEIPT_BATCH_SIZE = 500
+
+# Lots store their expiry as YYYY-MM; the day, if given, is dropped so re-imports merge into the same lot
+EXPIRE_DATE_RE = re.compile(r'(\d{4})[-/](\d{1,2})(?:[-/]\d{1,2})?(?:[ T]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?')
+
+def normalize_expire_date(value):
+    """Expiry from a CSV/XLSX cell or JSON as YYYY-MM, None when empty; raises ValueError otherwise"""
+    if value is None:
+        return None
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%Y-%m')
+    value = str(value).strip()
+    if not value:
+        return None
+    match = EXPIRE_DATE_RE.fullmatch(value)
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise ValueError(f"invalid expiry date: {value}")
+    return f"{match.group(1)}-{int(match.group(2)):02d}"
+
+def parse_whole_number(value):
+    """Integer from a cell or JSON value ("5", 5.0), None when empty; raises ValueError for 2.5 or text"""
+    if value is None or isinstance(value, bool):
+        return None if value is None else int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        number = value
+    else:
+        value = str(value).strip()
+        if not value:
+            return None
+        number = float(value)
+    if not number.is_integer():
+        raise ValueError(f"not a whole number: {value}")
+    return int(number)
+
+def parse_receipt_file(file: UploadFile):
+    """Read receipt lines from CSV or XLSX; returns (row_number, dict) pairs, header is row 1"""
+    ext = file.filename.split('.')[-1].lower() if file.filename else ''
+    if ext == 'csv':
+        text = file.file.read().decode('utf-8-sig')
+        reader = csv.DictReader(io.StringIO(text))
+        return [(idx, row) for idx, row in enumerate(reader, 2)]
+    if ext == 'xlsx':
+        workbook = load_workbook(file.file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else '' for h in next(rows, [])]
+        lines = []
+        for idx, values in enumerate(rows, 2):
+            if values is None or all(v is None for v in values):
+                continue
+            lines.append((idx, dict(zip(header, values))))
+        workbook.close()
+        return lines
+    raise HTTPException(status_code=400, detail="فرمت فایل باید CSV یا XLSX باشد")
+
+def import_inventory_lines(db: Session, current_user: Principal, lines):
+    """
+    ثبت رسید گروهی در یک تراکنش
+    lines: (line_number, dict) pairs. Invalid lines are reported and skipped; valid ones are upserted.
+    """
+    def clean(value):
+        if value is None:
+            return None
+        value = str(value).strip()
+        return value or None
+    
+    errors = []
+    parsed = []
+    for line_no, raw in lines:
+        if not isinstance(raw, dict):
+            errors.append({'line': line_no, 'error': "ساختار سطر نامعتبر است"})
+            continue
+        try:
+            expire_date = normalize_expire_date(raw.get('expire_date'))
+        except ValueError:
+            errors.append({'line': line_no, 'error': "تاریخ انقضا نامعتبر است (قالب YYYY-MM)"})
+            continue
+        try:
+            quantity = parse_whole_number(raw.get('quantity'))
+        except (TypeError, ValueError):
+            errors.append({'line': line_no, 'error': "تعداد باید عدد صحیح باشد"})
+            continue
+        try:
+            parsed.append((line_no, {
+                'warehouse_id': parse_whole_number(raw.get('warehouse_id')),
+                'drug_id': parse_whole_number(raw.get('drug_id')),
+                'expire_date': expire_date,
+                'quantity': quantity,
+                'supplier_id': parse_whole_number(raw.get('supplier_id')),
+                'entry_date': clean(raw.get('entry_date'))
+            }))
+        except (TypeError, ValueError):
+            errors.append({'line': line_no, 'error': "مقدار عددی نامعتبر است"})
+    
+    # Reference data and access checks once per distinct id, not once per line
+    warehouse_ids = {line['warehouse_id'] for _, line in parsed if line['warehouse_id']}
+    drug_ids = {line['drug_id'] for _, line in parsed if line['drug_id']}
+    known_warehouses = {w.id for w in db.query(Warehouse.id).filter(Warehouse.id.in_(warehouse_ids)).all()} if warehouse_ids else set()
+    allowed_warehouses = {w for w in known_warehouses if check_warehouse_access(current_user, w)}
+    drugs = {d.id: d for d in db.query(Drug.id, Drug.has_expiry_date).filter(Drug.id.in_(drug_ids)).all()} if drug_ids else {}
+    
+    # Valid lines are merged per lot so each lot is written once
+    lots = {}
+    imported_lines = 0
+    for line_no, line in parsed:
+        if not line['warehouse_id'] or not line['drug_id'] or line['quantity'] is None:
+            errors.append({'line': line_no, 'error': "انبار، دارو و تعداد الزامی است"})
+        elif line['quantity'] <= 0:
+            errors.append({'line': line_no, 'error': "تعداد باید بیشتر از صفر باشد"})
+        elif line['warehouse_id'] not in known_warehouses:
+            errors.append({'line': line_no, 'error': "انبار یافت نشد"})
+        elif line['warehouse_id'] not in allowed_warehouses:
+            errors.append({'line': line_no, 'error': "شما فقط می‌توانید برای انبار اختصاصی خود رسید ثبت کنید"})
+        elif line['drug_id'] not in drugs:
+            errors.append({'line': line_no, 'error': "دارو یافت نشد"})
+        elif not line['expire_date'] and drugs[line['drug_id']].has_expiry_date:
+            errors.append({'line': line_no, 'error': "تاریخ انقضا برای این دارو الزامی است"})
+        else:
+            imported_lines += 1
+            key = (line['warehouse_id'], line['drug_id'], line['expire_date'])
+            if key in lots:
+                lots[key]['quantity'] += line['quantity']
+                lots[key]['supplier_id'] = line['supplier_id'] or lots[key]['supplier_id']
+                lots[key]['entry_date'] = line['entry_date'] or lots[key]['entry_date']
+            else:
+                lots[key] = dict(line)
+    
+    dated = [lot for key, lot in lots.items() if key[2] is not None]
+    undated = [lot for key, lot in lots.items() if key[2] is None]
+    
+    inventory_table = Inventory.__table__
+    for start in range(0, len(dated), BULK_RECEIPT_BATCH_SIZE):
+        batch = [dict(lot, is_disposed=False) for lot in dated[start:start + BULK_RECEIPT_BATCH_SIZE]]
+        stmt = sqlite_insert(inventory_table).values(batch)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['warehouse_id', 'drug_id', 'expire_date'],
+            set_={
+                'quantity': inventory_table.c.quantity + stmt.excluded.quantity,
+                'supplier_id': func.coalesce(stmt.excluded.supplier_id, inventory_table.c.supplier_id),
+                'entry_date': func.coalesce(stmt.excluded.entry_date, inventory_table.c.entry_date)
+            }
+        )
+        db.execute(stmt)
+    
+    # NULL expiry never conflicts in a UNIQUE index, so lots without expiry are merged through the ORM
+    if undated:
+        existing = {
+            (inv.warehouse_id, inv.drug_id): inv
+            for inv in db.query(Inventory).filter(
+                Inventory.expire_date.is_(None),
+                Inventory.drug_id.in_({lot['drug_id'] for lot in undated}),
+                Inventory.warehouse_id.in_({lot['warehouse_id'] for lot in undated})
+            ).all()
+        }
+        for lot in undated:
+            inv = existing.get((lot['warehouse_id'], lot['drug_id']))
+            if inv:
+                inv.quantity += lot['quantity']
+                if lot['supplier_id']:
+                    inv.supplier_id = lot['supplier_id']
+                if lot['entry_date']:
+                    inv.entry_date = lot['entry_date']
+            else:
+                db.add(Inventory(**lot))
+    
+    total_quantity = sum(lot['quantity'] for lot in lots.values())
+    if lots:
+        # The upsert bypasses the ORM, so the change feed only learns which warehouses/drugs moved
+        events.record(db, 'inventory.bulk_receipt',
+                      warehouse_ids=sorted({key[0] for key in lots}),
+                      drug_ids=sorted({key[1] for key in lots}))
+        log_operation(db, "Bulk Inventory Receipt",
+                      f"رسید گروهی: {imported_lines} سطر، {len(lots)} قلم، مجموع {total_quantity} عدد",
+                      current_user=current_user)
+        db.commit()
+    
+    return {
+        "imported_lines": imported_lines,
+        "lots": len(lots),
+        "total_quantity": total_quantity,
+        "errors": sorted(errors, key=lambda e: e['line'])
+    }
+
+@router.post('/inventory/bulk')
+def bulk_add_inventory(lines: list = Body(...), db: Session = Depends(get_db), current_user: Principal = Depends(require_edit_permission)):
+    """
+    رسید گروهی از آرایه JSON
+    هر سطر: warehouse_id, drug_id, expire_date, quantity, supplier_id (اختیاری), entry_date (اختیاری)
+    شماره سطر در خطاها از ۱ شروع می‌شود
+    """
+    return import_inventory_lines(db, current_user, list(enumerate(lines, 1)))
+
+@router.post('/inventory/bulk/upload')
+def bulk_upload_inventory(file: UploadFile = File(...), db: Session = Depends(get_db), current_user: Principal = Depends(require_edit_permission)):
+    """
+    رسید گروهی از فایل CSV یا XLSX با ستون‌های warehouse_id, drug_id, expire_date, quantity, supplier_id, entry_date
+    شماره سطر در خطاها همان شماره ردیف فایل است (ردیف ۱ سرستون است)
+    """
+    return import_inventory_lines(db, current_user, parse_receipt_file(file))
+
 @router.put('/inventory/{inventory_id}')
-def update_inventory(inventory_id: int, data: dict, db: Session = Depends(get_db), current_user: User = Depends(require_edit_permission)):
+def update_inventory(inventory_id: int, data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(require_edit_permission)):
     inventory = db.query(Inventory).filter(Inventory.id == inventory_id).first()
     if not inventory:
         raise HTTPException(status_code=404, detail="رسید یافت نشد")
@@ -526,13 +1069,13 @@ def update_inventory(inventory_id: int, data: dict, db: Session = Depends(get_db
     for key, value in data.items():
         setattr(inventory, key, value)
     
+    log_operation(db, "Update Inventory", f"ویرایش موجودی شماره: {inventory_id}")
     db.commit()
     db.refresh(inventory)
-    log_operation(db, "Update Inventory", f"ویرایش موجودی شماره: {inventory_id}")
     return inventory
 
 @router.delete('/inventory/{inventory_id}')
-def delete_inventory(inventory_id: int, db: Session = Depends(get_db), current_user: User = Depends(require_edit_permission)):
+def delete_inventory(inventory_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(require_edit_permission)):
     inventory = db.query(Inventory).filter(Inventory.id == inventory_id).first()
     if not inventory:
         raise HTTPException(status_code=404, detail="رسید یافت نشد")
@@ -549,196 +1092,273 @@ def delete_inventory(inventory_id: int, db: Session = Depends(get_db), current_u
     
     # Delete inventory completely
     db.delete(inventory)
-    db.commit()
     
     # Log for audit trail
     log_operation(db, "Delete Inventory", f"حذف رسید: {drug_name} - {warehouse_name} - تعداد: {inventory.quantity}")
+    db.commit()
     
     return {"message": "رسید حذف شد"}
 
-@router.get('/logs')
-def get_logs(db: Session = Depends(get_db)):
-    # Action translations to Persian
-    action_translations = {
-        "Add Warehouse": "افزودن انبار",
-        "Update Warehouse": "ویرایش انبار",
-        "Delete Warehouse": "حذف انبار",
-        "Add Drug": "افزودن دارو",
-        "Update Drug": "ویرایش دارو",
-        "Delete Drug": "حذف دارو",
-        "Add Inventory": "رسید انبار",
-        "Update Inventory": "ویرایش موجودی",
-        "Update Inventory (Duplicate)": "افزایش موجودی",
-        "Delete Inventory": "حذف موجودی",
-        "Upload Drug Image": "آپلود تصویر دارو",
-        "Create Transfer": "ایجاد حواله",
-        "Confirm Transfer": "تایید حواله",
-        "Reject Transfer": "رد حواله",
-        "Delete Transfer": "حذف حواله",
-        "Resolve Mismatch": "رفع مغایرت",
-        "Add Supplier": "افزودن تامین‌کننده",
-        "Update Supplier": "ویرایش تامین‌کننده",
-        "Delete Supplier": "حذف تامین‌کننده",
-        "Add Consumer": "افزودن مصرف‌کننده",
-        "Update Consumer": "ویرایش مصرف‌کننده",
-        "Delete Consumer": "حذف مصرف‌کننده"
+# Action translations to Persian
+LOG_ACTION_TRANSLATIONS = {
+    "Add Warehouse": "افزودن انبار",
+    "Update Warehouse": "ویرایش انبار",
+    "Delete Warehouse": "حذف انبار",
+    "Add Drug": "افزودن دارو",
+    "Update Drug": "ویرایش دارو",
+    "Delete Drug": "حذف دارو",
+    "Add Inventory": "رسید انبار",
+    "Update Inventory": "ویرایش موجودی",
+    "Update Inventory (Duplicate)": "افزایش موجودی",
+    "Delete Inventory": "حذف موجودی",
+    "Upload Drug Image": "آپلود تصویر دارو",
+    "Create Transfer": "ایجاد حواله",
+    "Confirm Transfer": "تایید حواله",
+    "Reject Transfer": "رد حواله",
+    "Delete Transfer": "حذف حواله",
+    "Resolve Mismatch": "رفع مغایرت",
+    "Add Supplier": "افزودن تامین‌کننده",
+    "Update Supplier": "ویرایش تامین‌کننده",
+    "Delete Supplier": "حذف تامین‌کننده",
+    "Add Consumer": "افزودن مصرف‌کننده",
+    "Update Consumer": "ویرایش مصرف‌کننده",
+    "Delete Consumer": "حذف مصرف‌کننده",
+    "Bulk Inventory Receipt": "رسید گروهی انبار",
+    "Create Transfer Batch": "ایجاد حواله گروهی"
+}
+
+LOG_PAGE_MAX = 1000
+LOG_EXPORT_BATCH = 1000
+
+def build_log_query(db: Session, user_id: Optional[int], action: Optional[str],
+                    from_time: Optional[str], to_time: Optional[str]):
+    """
+    Filtered operation log query, newest first, with the user eagerly joined
+    - action: substring of the English action or its Persian translation
+    - from_time / to_time: 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' (Gregorian, like the stored timestamp)
+    """
+    query = db.query(OperationLog).options(joinedload(OperationLog.user))
+    if user_id:
+        query = query.filter(OperationLog.user_id == user_id)
+    if action:
+        translated = [en for en, fa in LOG_ACTION_TRANSLATIONS.items() if action in fa]
+        query = query.filter(or_(OperationLog.action.contains(action), OperationLog.action.in_(translated)))
+    if from_time:
+        query = query.filter(OperationLog.timestamp >= from_time)
+    if to_time:
+        if len(to_time) == 10:
+            # Whole day is inclusive
+            to_time = f"{to_time} 23:59:59"
+        query = query.filter(OperationLog.timestamp <= to_time)
+    return query.order_by(OperationLog.id.desc())
+
+def serialize_log(log: OperationLog):
+    return {
+        "id": log.id,
+        "user_id": log.user_id,
+        "action": LOG_ACTION_TRANSLATIONS.get(log.action, log.action),
+        "action_en": log.action,  # Keep original for reference
+        "details": log.details,
+        "timestamp": log.timestamp,
+        "user": {
+            "id": log.user.id,
+            "username": log.user.username,
+            "full_name": log.user.full_name
+        } if log.user else None
     }
-    
-    logs = db.query(OperationLog).order_by(OperationLog.id.desc()).all()
-    
-    # Translate actions
-    result = []
-    for log in logs:
-        log_dict = {
-            "id": log.id,
-            "user_id": log.user_id,
-            "action": action_translations.get(log.action, log.action),
-            "action_en": log.action,  # Keep original for reference
-            "details": log.details,
-            "timestamp": log.timestamp,
-            "user": {
-                "id": log.user.id,
-                "username": log.user.username,
-                "full_name": log.user.full_name
-            } if log.user else None
-        }
-        result.append(log_dict)
-    
-    return result
 
-# Drug image upload & compression
-@router.post('/upload-drug-image')
-def upload_drug_image(drug_id: int, file: UploadFile = File(...), db: Session = Depends(get_db)):
-    import base64
-    from io import BytesIO
+@router.get('/logs')
+def get_logs(
+    response: Response,
+    db: Session = Depends(get_db),
+    user_id: Optional[int] = None,
+    action: Optional[str] = None,
+    from_time: Optional[str] = None,
+    to_time: Optional[str] = None,
+    limit: Optional[int] = None,
+    before_id: Optional[int] = None
+):
+    """
+    دریافت تاریخچه عملیات (جدیدترین اول)
+    با ارسال limit، نتایج صفحه‌بندی می‌شود؛ X-Next-Cursor شناسه‌ای است که باید به عنوان before_id ارسال شود
+    """
+    query = build_log_query(db, user_id, action, from_time, to_time)
+    response.headers["X-Total-Count"] = str(query.order_by(None).count())
+    
+    if before_id:
+        query = query.filter(OperationLog.id < before_id)
+    
+    if limit is None:
+        return [serialize_log(log) for log in query.all()]
+    
+    limit = max(1, min(limit, LOG_PAGE_MAX))
+    logs = query.limit(limit + 1).all()
+    if len(logs) > limit:
+        logs = logs[:limit]
+        response.headers["X-Next-Cursor"] = str(logs[-1].id)
+    return [serialize_log(log) for log in logs]
+
+@router.get('/logs/export')
+def export_logs(
+    format: str = 'ndjson',
+    user_id: Optional[int] = None,
+    action: Optional[str] = None,
+    from_time: Optional[str] = None,
+    to_time: Optional[str] = None
+):
+    """
+    خروجی کامل تاریخچه عملیات به صورت NDJSON یا CSV (استریم، بدون بارگذاری کل جدول در حافظه)
+    """
+    if format not in ('ndjson', 'csv'):
+        raise HTTPException(status_code=400, detail="فرمت خروجی باید ndjson یا csv باشد")
     
+    def generate():
+        # Own session: the response body is produced after the request dependencies have finished
+        db = SessionLocal()
+        try:
+            query = build_log_query(db, user_id, action, from_time, to_time)
+            if format == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                # BOM so Excel opens the Persian text as UTF-8
+                writer.writerow(["id", "timestamp", "username", "full_name", "action", "action_en", "details"])
+                yield '\ufeff' + buffer.getvalue()
+            for log in query.yield_per(LOG_EXPORT_BATCH):
+                item = serialize_log(log)
+                if format == 'ndjson':
+                    yield json.dumps(item, ensure_ascii=False) + "\n"
+                else:
+                    buffer.seek(0)
+                    buffer.truncate(0)
+                    writer.writerow([
+                        item["id"],
+                        item["timestamp"],
+                        item["user"]["username"] if item["user"] else "",
+                        item["user"]["full_name"] if item["user"] else "",
+                        item["action"],
+                        item["action_en"],
+                        item["details"]
+                    ])
+                    yield buffer.getvalue()
+        finally:
+            db.close()
+    
+    if format == 'csv':
+        return StreamingResponse(generate(), media_type='text/csv; charset=utf-8',
+                                 headers={"Content-Disposition": "attachment; filename=operation_logs.csv"})
+    return StreamingResponse(generate(), media_type='application/x-ndjson',
+                             headers={"Content-Disposition": "attachment; filename=operation_logs.ndjson"})
+
+# Drug image upload, stored once per content in the image store with 64/200/800px renditions
+def attach_drug_image(db: Session, drug_id: int, digest: str) -> dict:
     drug = db.query(Drug).get(drug_id)
     if not drug:
         raise HTTPException(status_code=404, detail="دارو یافت نشد")
     
+    previous_hash = drug.image_hash
+    if drug.image and not previous_hash:
+        remove_legacy_image(drug.image)
+    
+    drug.image_hash = digest
+    drug.image = imagestore.relative_path(digest)
+    # The store replaces the base64 copy in the database
+    drug.image_data = None
+    
+    log_operation(db, "Upload Drug Image", f"آپلود تصویر دارو: {drug.name}")
+    db.commit()
+    if previous_hash != digest:
+        imagestore.release(db, previous_hash)
+    path, _ = imagestore.rendition(digest, imagestore.FULL_SIZE)
+    return {"image": imagestore.relative_path(digest), "image_hash": digest, "size": os.path.getsize(path)}
+
+@router.post('/upload-drug-image')
+async def upload_drug_image(drug_id: int, file: UploadFile = File(...), db: Session = Depends(get_db)):
     ext = file.filename.split('.')[-1].lower()
     if ext not in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
         raise HTTPException(status_code=400, detail="فرمت تصویر باید JPG, PNG, GIF یا WebP باشد")
     
-    # Read and compress image
-    img = Image.open(file.file)
-    
-    # Convert RGBA to RGB if needed (for JPEG)
-    if img.mode == 'RGBA':
-        background = Image.new('RGB', img.size, (255, 255, 255))
-        background.paste(img, mask=img.split()[3])
-        img = background
-    
-    # Resize if too large (max 800x800)
-    max_size = 800
-    if img.width > max_size or img.height > max_size:
-        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-    
-    # Save to BytesIO for Base64 encoding
-    buffered = BytesIO()
-    img.save(buffered, format='JPEG', optimize=True, quality=75)
-    img_bytes = buffered.getvalue()
-    
-    # Check final size
-    if len(img_bytes) > 1 * 1024 * 1024:  # 1MB limit
-        # Try with lower quality
-        buffered = BytesIO()
-        img.save(buffered, format='JPEG', optimize=True, quality=60)
-        img_bytes = buffered.getvalue()
-        if len(img_bytes) > 1 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="حجم تصویر بعد از فشرده‌سازی بیش از ۱ مگابایت است")
-    
-    # Encode to Base64 and save in database
-    img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-    drug.image_data = f"data:image/jpeg;base64,{img_base64}"
-    
-    # Also save as file cache for faster access
-    save_path = f"images/drug_{drug_id}.jpg"
-    with open(save_path, "wb") as f:
-        f.write(img_bytes)
-    drug.image = save_path
+    if not await run_in_threadpool(db.get, Drug, drug_id):
+        raise HTTPException(status_code=404, detail="دارو یافت نشد")
     
-    db.commit()
-    log_operation(db, "Upload Drug Image", f"آپلود تصویر دارو: {drug.name}")
-    return {"image": save_path, "size": len(img_bytes)}
+    # Decoding and encoding run in the image worker pool, not on this request's thread
+    data = await read_upload(file)
+    with imagestore.pinned(imagestore.digest_of(data)):
+        digest = await ingest_image(data)
+        return await run_in_threadpool(attach_drug_image, db, drug_id, digest)
 
-# Get drug image with fallback to database
+def legacy_media_type(data: bytes) -> str:
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return Image.MIME.get(img.format, 'application/octet-stream')
+    except (OSError, ValueError):
+        return 'application/octet-stream'
+
+# Get drug image (read-only: images not in the store yet are moved there by migrate_db.py)
 @router.get('/drug-image/{drug_id}')
-def get_drug_image(drug_id: int, db: Session = Depends(get_db)):
-    import base64
-    from io import BytesIO
-    
+def get_drug_image(drug_id: int, request: Request, size: int = imagestore.FULL_SIZE, db: Session = Depends(get_db)):
     drug = db.query(Drug).get(drug_id)
     if not drug:
         raise HTTPException(status_code=404, detail="دارو یافت نشد")
     
-    # Try to read from file cache first
-    if drug.image and os.path.exists(drug.image):
-        return FileResponse(drug.image, media_type="image/jpeg")
+    if drug.image_hash and imagestore.exists(drug.image_hash):
+        # The drug's image can be replaced, so this URL is revalidated; /images/{hash} is immutable
+        return image_response(request, drug.image_hash, size, 'no-cache')
     
-    # Fallback to database if file doesn't exist
+    # Not extracted yet: the legacy file cache, then the base64 copy, served as stored
+    if drug.image and os.path.exists(drug.image):
+        return FileResponse(drug.image, headers={'Cache-Control': 'no-cache'})
     if drug.image_data:
-        # Extract base64 data
-        if ',' in drug.image_data:
-            base64_data = drug.image_data.split(',')[1]
-        else:
-            base64_data = drug.image_data
-        
-        # Decode and return
-        img_bytes = base64.b64decode(base64_data)
-        
-        # Recreate cache file
-        save_path = f"images/drug_{drug_id}.jpg"
-        with open(save_path, "wb") as f:
-            f.write(img_bytes)
-        drug.image = save_path
-        db.commit()
-        
-        return FileResponse(save_path, media_type="image/jpeg")
-    
+        data = decode_data_url(drug.image_data)
+        return Response(content=data, media_type=legacy_media_type(data), headers={'Cache-Control': 'no-cache'})
     raise HTTPException(status_code=404, detail="تصویر یافت نشد")
 
 # Inventory receipt and transfer
 # ... (implement endpoints for inventory receipt, transfer, and logs)
 
-# Backup database
+# Backup database (online copy in the background, see backups.py)
 @router.get('/backup-db')
-def backup_db(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    import os
-    
+def backup_db(current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """
+    ثبت درخواست بکاپ و بازگشت فوری
+    وضعیت بکاپ از /backups/jobs/{job_id} دریافت می‌شود
+    """
     # Only admin and superadmin can create backups
     if current_user.access_level not in ['admin', 'superadmin']:
         raise HTTPException(status_code=403, detail="فقط ادمین می‌تواند بکاپ ایجاد کند")
     
-    # Use absolute paths for database and backup directory
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    src = os.path.join(base_dir, 'pharmacy.db')
-    backup_dir = os.path.join(base_dir, 'db_backup')
-    
-    # Create backup directory if it doesn't exist
-    if not os.path.exists(backup_dir):
-        os.makedirs(backup_dir)
-    
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f'pharmacy_{timestamp}.db'
-    dst = os.path.join(backup_dir, filename)
-    
-    try:
-        shutil.copy(src, dst)
-        
-        # Log the backup operation
-        log = OperationLog(
-            user_id=current_user.id,
-            action="Backup Database",
-            details=f"بکاپ دیتابیس ایجاد شد: {filename}",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
-        db.add(log)
-        db.commit()
-        
-        return {"backup": filename, "message": f"بکاپ با موفقیت ایجاد شد: {filename}"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"خطا در ایجاد بکاپ: {str(e)}")
+    job = backups.enqueue('manual')
+    status = backups.job_status(job)
+    log_operation(db, "Backup Database", f"درخواست بکاپ دیتابیس ثبت شد: {job['file']}", current_user=current_user)
+    db.commit()
+    return dict(status, message=f"بکاپ در صف ایجاد قرار گرفت: {job['file']}")
+
+@router.get('/backups/jobs/{job_id}')
+def get_backup_job(job_id: str, current_user: Principal = Depends(get_current_user)):
+    if current_user.access_level not in ['admin', 'superadmin']:
+        raise HTTPException(status_code=403, detail="فقط ادمین به وضعیت بکاپ دسترسی دارد")
+    job = backups.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="درخواست بکاپ یافت نشد")
+    return backups.job_status(job)
+
+@router.get('/backups')
+def get_backups(current_user: Principal = Depends(get_current_user)):
+    """فهرست بکاپ‌های کامل نگهداری شده در db_backup (جدیدترین اول) همراه با بکاپ‌های افزایشی هر کدام"""
+    if current_user.access_level not in ['admin', 'superadmin']:
+        raise HTTPException(status_code=403, detail="فقط ادمین به فهرست بکاپ‌ها دسترسی دارد")
+    increments = {}
+    for taken_at, base, name in backups.list_increments():
+        increments.setdefault(base, []).append({
+            'backup': name,
+            'taken_at': taken_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'size': os.path.getsize(os.path.join(backups.BACKUP_DIR, name))
+        })
+    return [{
+        'backup': name,
+        'taken_at': taken_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'size': os.path.getsize(os.path.join(backups.BACKUP_DIR, name)),
+        'increments': increments.get(name, [])
+    } for taken_at, name in backups.list_backups()]
 
 # Expiring drugs dashboard
 @router.get('/expiring-drugs')
@@ -746,15 +1366,22 @@ def expiring_drugs(db: Session = Depends(get_db)):
     from datetime import datetime, timedelta
     
     # Get expiry warning days from settings (default 90 days)
-    warning_days_setting = db.query(SystemSettings).filter(SystemSettings.key == 'exp_warning_days').first()
-    warning_days = int(warning_days_setting.value) if warning_days_setting else 90
+    warning_days_setting = get_system_settings(db).get('exp_warning_days')
+    warning_days = int(warning_days_setting) if warning_days_setting else 90
     
     # Calculate cutoff date
     cutoff_date = datetime.now() + timedelta(days=warning_days)
     cutoff_str = cutoff_date.strftime('%Y-%m')
     
-    # Query inventory with expiring drugs, JOIN with drugs to filter has_expiry_date
-    results = db.query(Inventory).join(Drug).filter(
+    # Single joined query: drug and warehouse names come back with each lot
+    results = db.query(
+        Drug.name.label('drug_name'),
+        Warehouse.name.label('warehouse_name'),
+        Inventory.quantity,
+        Inventory.expire_date
+    ).select_from(Inventory).join(Drug, Inventory.drug_id == Drug.id).outerjoin(
+        Warehouse, Inventory.warehouse_id == Warehouse.id
+    ).filter(
         Drug.has_expiry_date == True,  # Only drugs that have expiry dates
         Inventory.expire_date.isnot(None),
         Inventory.expire_date <= cutoff_str,
@@ -762,54 +1389,64 @@ def expiring_drugs(db: Session = Depends(get_db)):
         Inventory.is_disposed == False  # Exclude disposed items
     ).all()
     
-    output = []
-    for inv in results:
-        drug = db.query(Drug).filter(Drug.id == inv.drug_id).first()
-        wh = db.query(Warehouse).filter(Warehouse.id == inv.warehouse_id).first()
-        output.append({
-            'name': drug.name if drug else 'نامشخص',
-            'warehouse': wh.name if wh else 'نامشخص',
-            'quantity': inv.quantity,
-            'expire': inv.expire_date
-        })
-    
-    return output
+    return [{
+        'name': r.drug_name or 'نامشخص',
+        'warehouse': r.warehouse_name or 'نامشخص',
+        'quantity': r.quantity,
+        'expire': r.expire_date
+    } for r in results]
 
 @router.get('/disposed-drugs')
 def disposed_drugs(db: Session = Depends(get_db)):
     """
     دریافت لیست داروهای معدوم شده
     """
-    results = db.query(Inventory).join(Drug).join(Warehouse).filter(
+    # Latest confirmed disposal transfer per lot, ranked in SQL instead of one lookup per row
+    ranked_disposals = db.query(
+        Transfer.id.label('transfer_id'),
+        Transfer.source_warehouse_id,
+        Transfer.drug_id,
+        Transfer.expire_date,
+        Transfer.confirmed_at,
+        func.row_number().over(
+            partition_by=(Transfer.source_warehouse_id, Transfer.drug_id, Transfer.expire_date),
+            order_by=Transfer.confirmed_at.desc()
+        ).label('rn')
+    ).filter(
+        Transfer.transfer_type == 'disposal',
+        Transfer.status == 'confirmed'
+    ).subquery()
+    
+    results = db.query(
+        Inventory.id,
+        Inventory.quantity,
+        Inventory.expire_date,
+        Inventory.entry_date,
+        Drug.name.label('drug_name'),
+        Warehouse.name.label('warehouse_name'),
+        ranked_disposals.c.transfer_id,
+        ranked_disposals.c.confirmed_at
+    ).select_from(Inventory).join(Drug, Inventory.drug_id == Drug.id).join(
+        Warehouse, Inventory.warehouse_id == Warehouse.id
+    ).outerjoin(ranked_disposals, and_(
+        ranked_disposals.c.source_warehouse_id == Inventory.warehouse_id,
+        ranked_disposals.c.drug_id == Inventory.drug_id,
+        ranked_disposals.c.expire_date.is_not_distinct_from(Inventory.expire_date),
+        ranked_disposals.c.rn == 1
+    )).filter(
         Inventory.is_disposed == True
     ).all()
     
-    output = []
-    for inv in results:
-        drug = db.query(Drug).filter(Drug.id == inv.drug_id).first()
-        wh = db.query(Warehouse).filter(Warehouse.id == inv.warehouse_id).first()
-        
-        # Find disposal transfer for this item
-        disposal_transfer = db.query(Transfer).filter(
-            Transfer.source_warehouse_id == inv.warehouse_id,
-            Transfer.drug_id == inv.drug_id,
-            Transfer.expire_date == inv.expire_date,
-            Transfer.transfer_type == 'disposal',
-            Transfer.status == 'confirmed'
-        ).order_by(Transfer.confirmed_at.desc()).first()
-        
-        output.append({
-            'id': inv.id,
-            'name': drug.name if drug else 'نامشخص',
-            'warehouse': wh.name if wh else 'نامشخص',
-            'quantity': inv.quantity,
-            'expire_date': inv.expire_date,
-            'entry_date': inv.entry_date,
-            'disposal_date': disposal_transfer.confirmed_at if disposal_transfer else None,
-            'disposal_transfer_id': disposal_transfer.id if disposal_transfer else None
-        })
-    
-    return output
+    return [{
+        'id': r.id,
+        'name': r.drug_name or 'نامشخص',
+        'warehouse': r.warehouse_name or 'نامشخص',
+        'quantity': r.quantity,
+        'expire_date': r.expire_date,
+        'entry_date': r.entry_date,
+        'disposal_date': r.confirmed_at,
+        'disposal_transfer_id': r.transfer_id
+    } for r in results]
 
 # Transfer/Havaleh endpoints
 @router.post('/transfer/create')
@@ -823,7 +1460,7 @@ def create_transfer(
     transfer_type: str = 'warehouse',
     transfer_date: Optional[str] = None,
     db: Session = Depends(get_db),
-    current_user: User = Depends(require_edit_permission)
+    current_user: Principal = Depends(require_edit_permission)
 ):
     # Log the request for debugging
     print(f"[DEBUG] Transfer Create Request:")
@@ -855,8 +1492,8 @@ def create_transfer(
         raise HTTPException(status_code=403, detail="شما فقط می‌توانید از انبار اختصاصی خود حواله صادر کنید")
     
     # Get transit warehouse
-    transit_wh = db.query(Warehouse).filter(Warehouse.code == "TRANSIT").first()
-    if not transit_wh:
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
         raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
     
     # Check if source has enough inventory
@@ -873,7 +1510,7 @@ def create_transfer(
     
     # Add to transit warehouse
     inv_transit = db.query(Inventory).filter(
-        Inventory.warehouse_id == transit_wh.id,
+        Inventory.warehouse_id == transit_wh_id,
         Inventory.drug_id == drug_id,
         Inventory.expire_date == expire_date
     ).first()
@@ -882,7 +1519,7 @@ def create_transfer(
         inv_transit.quantity += quantity
     else:
         inv_transit = Inventory(
-            warehouse_id=transit_wh.id,
+            warehouse_id=transit_wh_id,
             drug_id=drug_id,
             expire_date=expire_date,
             quantity=quantity,
@@ -908,14 +1545,162 @@ def create_transfer(
         confirmed_at=None
     )
     db.add(transfer)
+    log_operation(db, "Create Transfer", f"حواله {quantity} عدد دارو {drug_id} از انبار {source_warehouse_id} به کالای در راه")
     db.commit()
     db.refresh(transfer)
     
-    log_operation(db, "Create Transfer", f"حواله {quantity} عدد دارو {drug_id} از انبار {source_warehouse_id} به کالای در راه")
     return transfer
 
+def begin_write_transaction(db: Session):
+    """
+    Take SQLite's write lock before reading the rows a change depends on, so the lots validated
+    here cannot be changed by another request before the deductions are written.
+    The transaction is started with BEGIN IMMEDIATE by database.begin_sqlite_transaction; a read
+    transaction the request already began (e.g. while authorizing) is ended first.
+    """
+    if db.in_transaction():
+        db.commit()
+    db.connection(execution_options={SQLITE_BEGIN_OPTION: 'IMMEDIATE'})
+
+@router.post('/transfer/batch')
+def create_transfer_batch(data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(require_edit_permission)):
+    """
+    ثبت حواله چندقلمی در یک تراکنش - یا همه سطرها ثبت می‌شوند یا هیچ‌کدام
+    data: source_warehouse_id, destination_warehouse_id, consumer_id, transfer_type, transfer_date,
+          lines: [{drug_id, expire_date, quantity}, ...]
+    """
+    transfer_type = data.get('transfer_type') or 'warehouse'
+    transfer_date = data.get('transfer_date')
+    lines = data.get('lines')
+
+    if not data.get('source_warehouse_id'):
+        raise HTTPException(status_code=400, detail="انبار مبدا الزامی است")
+    # JSON may carry the ids as strings; the access check and the lot lookups need ints
+    try:
+        source_warehouse_id = int(data['source_warehouse_id'])
+        destination_warehouse_id = int(data['destination_warehouse_id']) if data.get('destination_warehouse_id') else None
+        consumer_id = int(data['consumer_id']) if data.get('consumer_id') else None
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="شناسه انبار یا مصرف‌کننده نامعتبر است")
+    if not isinstance(lines, list) or not lines:
+        raise HTTPException(status_code=400, detail="حواله باید حداقل یک سطر داشته باشد")
+    if not check_warehouse_access(current_user, source_warehouse_id):
+        raise HTTPException(status_code=403, detail="شما فقط می‌توانید از انبار اختصاصی خود حواله صادر کنید")
+    
+    begin_write_transaction(db)
+    
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
+        raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
+    
+    errors = []
+    parsed = []
+    for line_no, raw in enumerate(lines, 1):
+        try:
+            drug_id = int(raw['drug_id'])
+            quantity = int(raw['quantity'])
+        except (KeyError, TypeError, ValueError):
+            errors.append((line_no, "دارو و تعداد الزامی است"))
+            continue
+        if quantity <= 0:
+            errors.append((line_no, "تعداد باید بیشتر از صفر باشد"))
+            continue
+        parsed.append((line_no, drug_id, raw.get('expire_date') or None, quantity))
+    
+    # One query for the drugs and one for every source and TRANSIT lot the lines touch
+    drug_ids = {drug_id for _, drug_id, _, _ in parsed}
+    drugs = {d.id: d for d in db.query(Drug.id, Drug.has_expiry_date).filter(Drug.id.in_(drug_ids)).all()} if drug_ids else {}
+    lots = {
+        (inv.warehouse_id, inv.drug_id, inv.expire_date): inv
+        for inv in db.query(Inventory).filter(
+            Inventory.warehouse_id.in_([source_warehouse_id, transit_wh_id]),
+            Inventory.drug_id.in_(drug_ids)
+        ).all()
+    } if drug_ids else {}
+    
+    # Validate every line against the lot balance left by the lines before it
+    requested = {}
+    for line_no, drug_id, expire_date, quantity in parsed:
+        if drug_id not in drugs:
+            errors.append((line_no, "دارو یافت نشد"))
+            continue
+        if not expire_date and drugs[drug_id].has_expiry_date:
+            errors.append((line_no, "تاریخ انقضا برای این دارو الزامی است"))
+            continue
+        key = (source_warehouse_id, drug_id, expire_date)
+        inv_source = lots.get(key)
+        requested[key] = requested.get(key, 0) + quantity
+        if not inv_source or inv_source.quantity < requested[key]:
+            errors.append((line_no, "موجودی انبار مبدا کافی نیست"))
+    
+    if errors:
+        raise HTTPException(status_code=400, detail=[f"سطر {line_no}: {error}" for line_no, error in sorted(errors)])
+    
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    transfers = []
+    for line_no, drug_id, expire_date, quantity in parsed:
+        inv_source = lots[(source_warehouse_id, drug_id, expire_date)]
+        inv_source.quantity -= quantity
+        
+        transit_key = (transit_wh_id, drug_id, expire_date)
+        inv_transit = lots.get(transit_key)
+        if inv_transit:
+            inv_transit.quantity += quantity
+        else:
+            inv_transit = Inventory(
+                warehouse_id=transit_wh_id,
+                drug_id=drug_id,
+                expire_date=expire_date,
+                quantity=quantity,
+                supplier_id=inv_source.supplier_id
+            )
+            db.add(inv_transit)
+            lots[transit_key] = inv_transit
+        
+        transfer = Transfer(
+            source_warehouse_id=source_warehouse_id,
+            destination_warehouse_id=destination_warehouse_id,
+            consumer_id=consumer_id,
+            transfer_type=transfer_type,
+            drug_id=drug_id,
+            expire_date=expire_date,
+            transfer_date=transfer_date,
+            quantity_sent=quantity,
+            quantity_received=0,
+            status='pending',
+            created_by=current_user.username,
+            created_at=created_at,
+            confirmed_at=None
+        )
+        db.add(transfer)
+        transfers.append(transfer)
+    
+    log_operation(db, "Create Transfer Batch",
+                  f"حواله گروهی {len(transfers)} قلم، مجموع {sum(t.quantity_sent for t in transfers)} عدد از انبار {source_warehouse_id} به کالای در راه",
+                  current_user=current_user)
+    db.flush()
+    # Built before commit, which would expire the rows
+    result = [{
+        'id': t.id,
+        'source_warehouse_id': t.source_warehouse_id,
+        'destination_warehouse_id': t.destination_warehouse_id,
+        'consumer_id': t.consumer_id,
+        'transfer_type': t.transfer_type,
+        'drug_id': t.drug_id,
+        'expire_date': t.expire_date,
+        'transfer_date': t.transfer_date,
+        'quantity_sent': t.quantity_sent,
+        'quantity_received': t.quantity_received,
+        'status': t.status,
+        'created_by': t.created_by,
+        'created_at': t.created_at
+    } for t in transfers]
+    db.commit()
+    
+    return result
+
 @router.put('/transfer/{transfer_id}')
-def update_transfer(transfer_id: int, data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_transfer(transfer_id: int, data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     """ویرایش حواله pending - فقط صادرکننده می‌تواند ویرایش کند"""
     transfer = db.query(Transfer).filter(Transfer.id == transfer_id).first()
     if not transfer:
@@ -931,13 +1716,13 @@ def update_transfer(transfer_id: int, data: dict, db: Session = Depends(get_db),
             raise HTTPException(status_code=403, detail="فقط صادرکننده حواله می‌تواند آن را ویرایش کند")
     
     # Get transit warehouse
-    transit_wh = db.query(Warehouse).filter(Warehouse.code == "TRANSIT").first()
-    if not transit_wh:
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
         raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
     
     # Reverse old transfer (return from transit to source)
     old_transit_inv = db.query(Inventory).filter(
-        Inventory.warehouse_id == transit_wh.id,
+        Inventory.warehouse_id == transit_wh_id,
         Inventory.drug_id == transfer.drug_id,
         Inventory.expire_date == transfer.expire_date
     ).first()
@@ -984,7 +1769,7 @@ def update_transfer(transfer_id: int, data: dict, db: Session = Depends(get_db),
     
     # Add to transit
     new_transit_inv = db.query(Inventory).filter(
-        Inventory.warehouse_id == transit_wh.id,
+        Inventory.warehouse_id == transit_wh_id,
         Inventory.drug_id == new_drug_id,
         Inventory.expire_date == new_expire_date
     ).first()
@@ -993,7 +1778,7 @@ def update_transfer(transfer_id: int, data: dict, db: Session = Depends(get_db),
         new_transit_inv.quantity += new_quantity
     else:
         new_transit_inv = Inventory(
-            warehouse_id=transit_wh.id,
+            warehouse_id=transit_wh_id,
             drug_id=new_drug_id,
             expire_date=new_expire_date,
             quantity=new_quantity,
@@ -1005,14 +1790,14 @@ def update_transfer(transfer_id: int, data: dict, db: Session = Depends(get_db),
     for key, value in data.items():
         setattr(transfer, key, value)
     
+    log_operation(db, "Update Transfer", f"ویرایش حواله شماره {transfer_id}")
     db.commit()
     db.refresh(transfer)
     
-    log_operation(db, "Update Transfer", f"ویرایش حواله شماره {transfer_id}")
     return transfer
 
 @router.post('/transfer/{transfer_id}/confirm')
-def confirm_transfer(transfer_id: int, quantity_received: int, db: Session = Depends(get_db), current_user: User = Depends(require_edit_permission)):
+def confirm_transfer(transfer_id: int, quantity_received: int, db: Session = Depends(get_db), current_user: Principal = Depends(require_edit_permission)):
     """
     تایید حواله با مقدار دریافتی
     - اگر quantity_received == quantity_sent: وضعیت confirmed
@@ -1038,13 +1823,13 @@ def confirm_transfer(transfer_id: int, quantity_received: int, db: Session = Dep
         raise HTTPException(status_code=400, detail="تعداد دریافتی نمی‌تواند بیشتر از تعداد ارسالی باشد")
     
     # Get transit warehouse
-    transit_wh = db.query(Warehouse).filter(Warehouse.code == "TRANSIT").first()
-    if not transit_wh:
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
         raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
     
     # Get transit inventory
     inv_transit = db.query(Inventory).filter(
-        Inventory.warehouse_id == transit_wh.id,
+        Inventory.warehouse_id == transit_wh_id,
         Inventory.drug_id == transfer.drug_id,
         Inventory.expire_date == transfer.expire_date
     ).first()
@@ -1100,16 +1885,53 @@ def confirm_transfer(transfer_id: int, quantity_received: int, db: Session = Dep
         transfer.status = 'mismatch'
         # Mismatch: difference remains in TRANSIT for admin to resolve
     
-    db.commit()
     log_operation(db, "Confirm Transfer", f"حواله {transfer_id}: دریافت {quantity_received} عدد از {transfer.quantity_sent} عدد ارسالی")
+    db.commit()
     return transfer
 
+@router.get('/events')
+async def change_events(request: Request, token: Optional[str] = None, authorization: str = Header(None)):
+    """
+    جریان تغییرات حواله‌ها و موجودی (Server-Sent Events)
+    EventSource مرورگر هدر Authorization نمی‌فرستد، پس توکن از پارامتر token هم پذیرفته می‌شود
+    """
+    verify_token(authorization or (f"Bearer {token}" if token else None))
+    queue = events.broker.subscribe(request.headers.get('last-event-id'))
+    return StreamingResponse(
+        events.stream(queue),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@router.get('/sync')
+def sync_changes(since: int = 0, tables: Optional[str] = None, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
+    """
+    همگام‌سازی افزایشی: ردیف‌های درج، ویرایش و حذف شده بعد از نسخه since
+    - version پاسخ را در درخواست بعدی به عنوان since بفرستید
+    - since=0 (یا full=true در پاسخ) یعنی کل داده‌ها برگردانده شده و نسخه محلی باید جایگزین شود
+    - tables: فهرست جداول با کاما (پیش‌فرض: inventory, transfers, drugs, warehouses, tool_inventory)
+    """
+    requested = changelog.SYNC_TABLES
+    if tables:
+        requested = [t.strip() for t in tables.split(',') if t.strip()]
+        unknown = [t for t in requested if t not in changelog.SYNC_TABLES]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"جدول نامعتبر برای همگام‌سازی: {', '.join(unknown)}")
+    cursor = db.connection().connection.cursor()
+    try:
+        return changelog.changes_since(cursor, since, requested)
+    finally:
+        cursor.close()
+
 @router.get('/transfer/pending')
 def get_pending_transfers(db: Session = Depends(get_db)):
     return db.query(Transfer).filter(Transfer.status == 'pending').all()
 
 @router.get('/transfer/all')
-def get_all_transfers(db: Session = Depends(get_db)):
+def get_all_transfers(request: Request, response: Response, db: Session = Depends(get_db)):
+    not_modified = check_not_modified(request, response, ['transfers', 'warehouses', 'consumers', 'drugs'])
+    if not_modified:
+        return not_modified
     transfers = db.query(Transfer).all()
     result = []
     for t in transfers:
@@ -1142,16 +1964,16 @@ def get_transit_inventory(db: Session = Depends(get_db)):
     دریافت موجودی انبار کالای در راه (TRANSIT)
     فقط برای مدیریت و نظارت سیستم
     """
-    transit_wh = db.query(Warehouse).filter(Warehouse.code == "TRANSIT").first()
-    if not transit_wh:
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
         return []
     
     return db.query(Inventory).filter(
-        Inventory.warehouse_id == transit_wh.id
+        Inventory.warehouse_id == transit_wh_id
     ).order_by(Inventory.expire_date.asc()).all()
 
 @router.put('/transfer/{transfer_id}/confirm')
-def confirm_transfer_by_id(transfer_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def confirm_transfer_by_id(transfer_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     """تایید حواله با شناسه - تایید کامل با quantity_sent"""
     transfer = db.query(Transfer).filter(Transfer.id == transfer_id).first()
     if not transfer:
@@ -1166,13 +1988,13 @@ def confirm_transfer_by_id(transfer_id: int, db: Session = Depends(get_db), curr
         raise HTTPException(status_code=400, detail="فقط حواله‌های در انتظار قابل تایید هستند")
     
     # Get transit warehouse
-    transit_wh = db.query(Warehouse).filter(Warehouse.code == "TRANSIT").first()
-    if not transit_wh:
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
         raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
     
     # Deduct from transit
     inv_transit = db.query(Inventory).filter(
-        Inventory.warehouse_id == transit_wh.id,
+        Inventory.warehouse_id == transit_wh_id,
         Inventory.drug_id == transfer.drug_id,
         Inventory.expire_date == transfer.expire_date
     ).first()
@@ -1205,13 +2027,13 @@ def confirm_transfer_by_id(transfer_id: int, db: Session = Depends(get_db), curr
     transfer.status = 'confirmed'
     transfer.quantity_received = transfer.quantity_sent
     transfer.confirmed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_operation(db, "Confirm Transfer", f"تایید حواله شماره {transfer_id}")
     db.commit()
     
-    log_operation(db, "Confirm Transfer", f"تایید حواله شماره {transfer_id}")
     return transfer
 
 @router.put('/transfer/{transfer_id}/reject')
-def reject_transfer_by_id(transfer_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def reject_transfer_by_id(transfer_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     """رد حواله با شناسه - برگشت از کالای در راه به انبار مبدا"""
     transfer = db.query(Transfer).filter(Transfer.id == transfer_id).first()
     if not transfer:
@@ -1226,13 +2048,13 @@ def reject_transfer_by_id(transfer_id: int, db: Session = Depends(get_db), curre
         raise HTTPException(status_code=400, detail="فقط حواله‌های در انتظار قابل رد هستند")
     
     # Get transit warehouse
-    transit_wh = db.query(Warehouse).filter(Warehouse.code == "TRANSIT").first()
-    if not transit_wh:
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
         raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
     
     # Deduct from transit
     inv_transit = db.query(Inventory).filter(
-        Inventory.warehouse_id == transit_wh.id,
+        Inventory.warehouse_id == transit_wh_id,
         Inventory.drug_id == transfer.drug_id,
         Inventory.expire_date == transfer.expire_date
     ).first()
@@ -1263,13 +2085,148 @@ def reject_transfer_by_id(transfer_id: int, db: Session = Depends(get_db), curre
     
     transfer.status = 'rejected'
     transfer.confirmed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    log_operation(db, "Reject Transfer", f"رد حواله شماره {transfer_id}")
     db.commit()
     
-    log_operation(db, "Reject Transfer", f"رد حواله شماره {transfer_id}")
     return transfer
 
+@router.post('/transfer/receive')
+def receive_transfers(data: dict, db: Session = Depends(get_db), current_user: Principal = Depends(require_edit_permission)):
+    """
+    دریافت گروهی حواله‌ها در یک تراکنش - یا همه ثبت می‌شوند یا هیچ‌کدام
+    data: items: [{transfer_id, quantity_received (اختیاری، پیش‌فرض تعداد ارسالی), action: 'confirm' | 'reject'}, ...]
+    """
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="هیچ حواله‌ای انتخاب نشده است")
+    
+    errors = []
+    requests_by_id = {}
+    for raw in items:
+        try:
+            transfer_id = int(raw['transfer_id'])
+            quantity_received = raw.get('quantity_received')
+            quantity_received = int(quantity_received) if quantity_received not in (None, '') else None
+        except (KeyError, TypeError, ValueError):
+            errors.append("شناسه حواله یا تعداد دریافتی نامعتبر است")
+            continue
+        action = raw.get('action') or 'confirm'
+        if action not in ('confirm', 'reject'):
+            errors.append(f"حواله {transfer_id}: عملیات نامعتبر است")
+        elif transfer_id in requests_by_id:
+            errors.append(f"حواله {transfer_id}: بیش از یک بار انتخاب شده است")
+        else:
+            requests_by_id[transfer_id] = (action, quantity_received)
+    if errors:
+        raise HTTPException(status_code=400, detail=errors)
+    
+    begin_write_transaction(db)
+    
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
+        raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
+    
+    transfers = db.query(Transfer).filter(Transfer.id.in_(requests_by_id)).order_by(Transfer.id).all()
+    found = {t.id for t in transfers}
+    errors = [f"حواله {transfer_id}: حواله یافت نشد" for transfer_id in requests_by_id if transfer_id not in found]
+    
+    # One query for the TRANSIT lots and one for the destination/source lots of every transfer
+    drug_ids = {t.drug_id for t in transfers}
+    warehouse_ids = {t.destination_warehouse_id for t in transfers if t.transfer_type == 'warehouse'}
+    warehouse_ids |= {t.source_warehouse_id for t in transfers}
+    transit_lots = {
+        (inv.drug_id, inv.expire_date): inv
+        for inv in db.query(Inventory).filter(
+            Inventory.warehouse_id == transit_wh_id,
+            Inventory.drug_id.in_(drug_ids)
+        ).all()
+    } if drug_ids else {}
+    lots = {
+        (inv.warehouse_id, inv.drug_id, inv.expire_date): inv
+        for inv in db.query(Inventory).filter(
+            Inventory.warehouse_id.in_(warehouse_ids),
+            Inventory.drug_id.in_(drug_ids)
+        ).all()
+    } if drug_ids else {}
+    
+    def add_to_lot(warehouse_id, transfer, quantity, inv_transit):
+        key = (warehouse_id, transfer.drug_id, transfer.expire_date)
+        inv = lots.get(key)
+        if inv:
+            inv.quantity += quantity
+        else:
+            inv = Inventory(
+                warehouse_id=warehouse_id,
+                drug_id=transfer.drug_id,
+                expire_date=transfer.expire_date,
+                quantity=quantity,
+                supplier_id=inv_transit.supplier_id if inv_transit.supplier_id else 1
+            )
+            db.add(inv)
+            lots[key] = inv
+    
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    counts = {'confirmed': 0, 'mismatch': 0, 'rejected': 0}
+    for transfer in transfers:
+        action, quantity_received = requests_by_id[transfer.id]
+        if transfer.transfer_type == 'warehouse' and not check_warehouse_access(current_user, transfer.destination_warehouse_id):
+            errors.append(f"حواله {transfer.id}: شما فقط می‌توانید حواله‌های ورودی به انبار خود را دریافت کنید")
+            continue
+        if transfer.status != 'pending':
+            errors.append(f"حواله {transfer.id}: فقط حواله‌های در انتظار قابل دریافت هستند")
+            continue
+        
+        if action == 'reject':
+            quantity_received = transfer.quantity_sent
+        elif quantity_received is None:
+            quantity_received = transfer.quantity_sent
+        elif quantity_received <= 0 or quantity_received > transfer.quantity_sent:
+            errors.append(f"حواله {transfer.id}: تعداد دریافتی باید بین ۱ و تعداد ارسالی باشد")
+            continue
+        
+        # Lots are shared between transfers, so check against the balance left by the ones before
+        inv_transit = transit_lots.get((transfer.drug_id, transfer.expire_date))
+        if not inv_transit or inv_transit.quantity < quantity_received:
+            errors.append(f"حواله {transfer.id}: موجودی کالای در راه کافی نیست")
+            continue
+        if errors:
+            continue
+        inv_transit.quantity -= quantity_received
+        
+        if action == 'reject':
+            add_to_lot(transfer.source_warehouse_id, transfer, quantity_received, inv_transit)
+            transfer.status = 'rejected'
+            log_operation(db, "Reject Transfer", f"رد حواله شماره {transfer.id}", current_user=current_user)
+        else:
+            if transfer.transfer_type == 'disposal':
+                source_inv = lots.get((transfer.source_warehouse_id, transfer.drug_id, transfer.expire_date))
+                if source_inv:
+                    source_inv.is_disposed = True
+                    log_operation(db, "Dispose Inventory",
+                                  f"معدوم سازی {quantity_received} عدد دارو {transfer.drug_id} از انبار {transfer.source_warehouse_id}",
+                                  current_user=current_user)
+            elif transfer.transfer_type == 'warehouse':
+                add_to_lot(transfer.destination_warehouse_id, transfer, quantity_received, inv_transit)
+            transfer.quantity_received = quantity_received
+            # Mismatch: difference remains in TRANSIT for admin to resolve
+            transfer.status = 'confirmed' if quantity_received == transfer.quantity_sent else 'mismatch'
+            log_operation(db, "Confirm Transfer",
+                          f"حواله {transfer.id}: دریافت {quantity_received} عدد از {transfer.quantity_sent} عدد ارسالی",
+                          current_user=current_user)
+        transfer.confirmed_at = now
+        counts[transfer.status] += 1
+    
+    if errors:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=errors)
+    
+    result = [{'id': t.id, 'status': t.status, 'quantity_received': t.quantity_received} for t in transfers]
+    db.commit()
+    
+    return {**counts, 'transfers': result}
+
 @router.delete('/transfer/{transfer_id}')
-def delete_transfer(transfer_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_transfer(transfer_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     """حذف حواله - برگشت از کالای در راه به مبدا"""
     transfer = db.query(Transfer).filter(Transfer.id == transfer_id).first()
     if not transfer:
@@ -1284,15 +2241,15 @@ def delete_transfer(transfer_id: int, db: Session = Depends(get_db), current_use
             raise HTTPException(status_code=403, detail="فقط صادرکننده حواله می‌تواند آن را حذف کند")
     
     # Get transit warehouse
-    transit_wh = db.query(Warehouse).filter(Warehouse.code == "TRANSIT").first()
-    if not transit_wh:
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
         raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
     
     # If pending, return from transit to source
     if transfer.status == 'pending':
         # Deduct from transit
         inv_transit = db.query(Inventory).filter(
-            Inventory.warehouse_id == transit_wh.id,
+            Inventory.warehouse_id == transit_wh_id,
             Inventory.drug_id == transfer.drug_id,
             Inventory.expire_date == transfer.expire_date
         ).first()
@@ -1320,9 +2277,9 @@ def delete_transfer(transfer_id: int, db: Session = Depends(get_db), current_use
             db.add(inv_source)
     
     db.delete(transfer)
+    log_operation(db, "Delete Transfer", f"حذف حواله شماره {transfer_id}")
     db.commit()
     
-    log_operation(db, "Delete Transfer", f"حذف حواله شماره {transfer_id}")
     return {"message": "حواله حذف شد"}
 
 # Mismatch management endpoints
@@ -1350,8 +2307,8 @@ def resolve_mismatch(
         raise HTTPException(status_code=400, detail="فقط حواله‌های مغایرت‌دار قابل حل هستند")
     
     # Get transit warehouse
-    transit_wh = db.query(Warehouse).filter(Warehouse.code == "TRANSIT").first()
-    if not transit_wh:
+    transit_wh_id = get_transit_warehouse_id(db)
+    if not transit_wh_id:
         raise HTTPException(status_code=500, detail="انبار کالای در راه یافت نشد")
     
     # Calculate mismatch quantity
@@ -1362,7 +2319,7 @@ def resolve_mismatch(
     
     # Get transit inventory
     inv_transit = db.query(Inventory).filter(
-        Inventory.warehouse_id == transit_wh.id,
+        Inventory.warehouse_id == transit_wh_id,
         Inventory.drug_id == transfer.drug_id,
         Inventory.expire_date == transfer.expire_date
     ).first()
@@ -1431,8 +2388,8 @@ def resolve_mismatch(
     transfer.status = 'resolved'
     transfer.confirmed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    db.commit()
     log_operation(db, "Resolve Mismatch", log_msg)
+    db.commit()
     
     return {"message": "مغایرت با موفقیت حل شد", "action": action, "quantity": mismatch_qty}
 
@@ -1472,15 +2429,12 @@ def get_inventory_report(
         })
     return results
 
-@router.get('/export-excel')
-def export_excel(
-    warehouse_id: Optional[int] = None,
-    drug_id: Optional[int] = None,
-    expire_date_from: Optional[str] = None,
-    expire_date_to: Optional[str] = None,
-    db: Session = Depends(get_db)
-):
-    query = db.query(Inventory).filter(Inventory.is_disposed == False)
+EXCEL_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXPORT_BATCH_SIZE = 2000
+
+def apply_inventory_report_filters(query, warehouse_id: Optional[int], drug_id: Optional[int],
+                                   expire_date_from: Optional[str], expire_date_to: Optional[str]):
+    query = query.filter(Inventory.is_disposed == False)
     if warehouse_id:
         query = query.filter(Inventory.warehouse_id == warehouse_id)
     if drug_id:
@@ -1489,212 +2443,145 @@ def export_excel(
         query = query.filter(Inventory.expire_date >= expire_date_from)
     if expire_date_to:
         query = query.filter(Inventory.expire_date <= expire_date_to)
-        
-    inventory = query.all()
-    data = [{
-        'انبار': inv.warehouse.name,
-        'دارو': inv.drug.name,
-        'تاریخ انقضا': inv.expire_date,
-        'تعداد': inv.quantity
-    } for inv in inventory]
-    df = pd.DataFrame(data)
-    file_path = 'inventory_export.xlsx'
-    df.to_excel(file_path, index=False)
-    return FileResponse(file_path, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', filename=file_path)
+    return query
 
-@router.get('/export-pdf')
-def export_pdf(
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError as e:
+        print(f"Failed to remove temp file {path}: {e}")
+
+@router.get('/export-excel')
+def export_excel(
     warehouse_id: Optional[int] = None,
     drug_id: Optional[int] = None,
     expire_date_from: Optional[str] = None,
     expire_date_to: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
-    from reportlab.lib import colors
-    from reportlab.lib.units import cm
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.enums import TA_RIGHT, TA_CENTER
+    """
+    خروجی اکسل موجودی
+    ردیف‌ها با یک کوئری join شده خوانده و به صورت دسته‌ای در حالت write-only در یک فایل موقت اختصاصی نوشته می‌شوند
+    """
+    query = db.query(
+        Warehouse.name,
+        Drug.name,
+        Inventory.expire_date,
+        Inventory.quantity
+    ).select_from(Inventory).join(Warehouse, Inventory.warehouse_id == Warehouse.id).join(
+        Drug, Inventory.drug_id == Drug.id
+    )
+    query = apply_inventory_report_filters(query, warehouse_id, drug_id, expire_date_from, expire_date_to)
     
-    # Build query with filters
-    query = db.query(Inventory).filter(Inventory.is_disposed == False)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['انبار', 'دارو', 'تاریخ انقضا', 'تعداد'])
+    for row in query.yield_per(EXPORT_BATCH_SIZE):
+        sheet.append(list(row))
     
-    # Get warehouse name if filtered
+    # Per-request file so concurrent exports never overwrite each other
+    fd, file_path = tempfile.mkstemp(prefix='inventory_export_', suffix='.xlsx')
+    os.close(fd)
+    try:
+        workbook.save(file_path)
+    except Exception:
+        remove_file(file_path)
+        raise
+    return FileResponse(
+        file_path,
+        media_type=EXCEL_MEDIA_TYPE,
+        filename='inventory_export.xlsx',
+        background=BackgroundTask(remove_file, file_path)
+    )
+
+# Tables the inventory PDF is read from
+INVENTORY_REPORT_TABLES = ['inventory', 'drugs', 'warehouses']
+
+def fetch_inventory_pdf_rows(db: Session, warehouse_id: Optional[int], drug_id: Optional[int],
+                             expire_date_from: Optional[str], expire_date_to: Optional[str]):
+    """Report rows as plain (drug_name, expire_date, quantity) tuples, ready to ship to a render worker"""
     warehouse_name = None
     if warehouse_id:
-        query = query.filter(Inventory.warehouse_id == warehouse_id)
         warehouse = db.query(Warehouse).filter(Warehouse.id == warehouse_id).first()
         if warehouse:
             warehouse_name = warehouse.name
     
-    if drug_id:
-        query = query.filter(Inventory.drug_id == drug_id)
-    if expire_date_from:
-        query = query.filter(Inventory.expire_date >= expire_date_from)
-    if expire_date_to:
-        query = query.filter(Inventory.expire_date <= expire_date_to)
-        
-    inventory = query.all()
-    
-    # Register Persian font
-    font_path = os.path.join(os.path.dirname(__file__), 'fonts', 'Vazirmatn-Regular.ttf')
-    pdfmetrics.registerFont(TTFont('Vazirmatn', font_path))
-    
-    # Helper function to prepare Persian text
-    def prepare_persian_text(text):
-        if not text:
-            return ""
-        reshaped_text = arabic_reshaper.reshape(str(text))
-        bidi_text = get_display(reshaped_text)
-        return bidi_text
-    
-    # Helper function to get color based on expiry date
-    def get_expiry_color(expire_date):
-        if not expire_date:
-            return colors.grey
-        try:
-            exp_date = datetime.strptime(str(expire_date), '%Y-%m-%d')
-            days_until = (exp_date - datetime.now()).days
-            if days_until < 0:
-                return colors.Color(0.8, 0, 0)  # Dark red - expired
-            elif days_until < 30:
-                return colors.Color(1, 0.2, 0.2)  # Red
-            elif days_until < 90:
-                return colors.Color(1, 0.6, 0)  # Orange
-            else:
-                return colors.Color(0.2, 0.7, 0.2)  # Green
-        except:
-            return colors.grey
-    
-    # Custom page template with repeating header
-    def header_footer(canvas, doc):
-        canvas.saveState()
-        
-        # Add header on every page
-        canvas.setFont('Vazirmatn', 16)
-        canvas.setFillColor(colors.HexColor('#1976d2'))
-        title_text = prepare_persian_text("گزارش موجودی انبار دارویی")
-        canvas.drawCentredString(A4[0] / 2, A4[1] - 1.5*cm, title_text)
-        
-        # Add warehouse name if filtered
-        if warehouse_name:
-            canvas.setFont('Vazirmatn', 12)
-            canvas.setFillColor(colors.HexColor('#666666'))
-            wh_text = prepare_persian_text(f"انبار: {warehouse_name}")
-            canvas.drawCentredString(A4[0] / 2, A4[1] - 2.2*cm, wh_text)
-        
-        # Add date
-        canvas.setFont('Vazirmatn', 9)
-        canvas.setFillColor(colors.grey)
-        now = datetime.now()
-        jalali_now = jdatetime.datetime.fromgregorian(datetime=now)
-        current_date = jalali_now.strftime('%Y/%m/%d')
-        date_text = prepare_persian_text(f"تاریخ: {current_date}")
-        canvas.drawCentredString(A4[0] / 2, A4[1] - 2.8*cm, date_text)
-        
-        # Add page number in footer
-        canvas.setFont('Vazirmatn', 9)
-        page_text = prepare_persian_text(f"صفحه {doc.page}")
-        canvas.drawCentredString(A4[0] / 2, 1*cm, page_text)
-        
-        canvas.restoreState()
-    
-    # Create PDF
-    file_path = 'inventory_export.pdf'
-    doc = SimpleDocTemplate(
-        file_path, 
-        pagesize=A4, 
-        rightMargin=2*cm, 
-        leftMargin=2*cm, 
-        topMargin=3.5*cm,  # Increased for header
-        bottomMargin=2*cm
-    )
-    
-    # Story container
-    story = []
-    
-    # Prepare table data (without warehouse column)
-    table_data = []
-    
-    # Header row
-    headers = [
-        prepare_persian_text("تعداد"),
-        prepare_persian_text("تاریخ انقضا"),
-        prepare_persian_text("نام دارو"),
-        prepare_persian_text("ردیف")
-    ]
-    table_data.append(headers)
-    
-    # Data rows
-    for idx, inv in enumerate(inventory, 1):
-        row = [
-            prepare_persian_text(str(inv.quantity)),
-            str(inv.expire_date) if inv.expire_date else "-",
-            prepare_persian_text(inv.drug.name),
-            str(idx)
-        ]
-        table_data.append(row)
-    
-    # Create table with wider columns (no warehouse column)
-    table = Table(table_data, colWidths=[3.5*cm, 4*cm, 7*cm, 2.5*cm], repeatRows=1)
-    
-    # Table style with colors
-    table_style = [
-        # Header styling
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1976d2')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Vazirmatn'),
-        ('FONTSIZE', (0, 0), (-1, 0), 11),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('TOPPADDING', (0, 0), (-1, 0), 12),
-        
-        # Data rows styling
-        ('FONTNAME', (0, 1), (-1, -1), 'Vazirmatn'),
-        ('FONTSIZE', (0, 1), (-1, -1), 10),
-        ('ALIGN', (0, 1), (-1, -1), 'CENTER'),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f5f5f5')]),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('TOPPADDING', (0, 1), (-1, -1), 8),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
-    ]
-    
-    # Add expiry date colors
-    for idx, inv in enumerate(inventory, 1):
-        exp_color = get_expiry_color(inv.expire_date)
-        table_style.append(('TEXTCOLOR', (1, idx), (1, idx), exp_color))
-        table_style.append(('FONTNAME', (1, idx), (1, idx), 'Vazirmatn'))
-    
-    table.setStyle(TableStyle(table_style))
-    story.append(table)
-    
-    # Add summary footer
-    story.append(Spacer(1, 1*cm))
-    
-    total_items = len(inventory)
-    total_quantity = sum(inv.quantity for inv in inventory)
-    summary_text = prepare_persian_text(f"تعداد کل اقلام: {total_items} | مجموع تعداد: {total_quantity}")
-    
-    styles = getSampleStyleSheet()
-    summary_style = ParagraphStyle(
-        'Summary',
-        parent=styles['Normal'],
-        fontName='Vazirmatn',
-        fontSize=10,
-        textColor=colors.HexColor('#1976d2'),
-        alignment=TA_CENTER,
-        borderWidth=1,
-        borderColor=colors.HexColor('#1976d2'),
-        borderPadding=10,
-        backColor=colors.HexColor('#e3f2fd')
+    query = db.query(
+        Drug.name,
+        Inventory.expire_date,
+        Inventory.quantity
+    ).select_from(Inventory).join(Drug, Inventory.drug_id == Drug.id)
+    query = apply_inventory_report_filters(query, warehouse_id, drug_id, expire_date_from, expire_date_to)
+    rows = [tuple(r) for r in query.order_by(Inventory.id).all()]
+    return rows, warehouse_name
+
+def submit_inventory_pdf_job(db: Session, warehouse_id, drug_id, expire_date_from, expire_date_to):
+    params = {
+        'warehouse_id': warehouse_id,
+        'drug_id': drug_id,
+        'expire_date_from': expire_date_from,
+        'expire_date_to': expire_date_to
+    }
+    # Any committed change to these tables moves the version, so an unchanged report is found
+    # without reading its rows; the process id keeps files from an earlier run from matching
+    data_version = f"{ETAG_PROCESS_ID}-{table_versions(INVENTORY_REPORT_TABLES)}"
+    return reports.submit_inventory_pdf(
+        params, data_version,
+        lambda: fetch_inventory_pdf_rows(db, warehouse_id, drug_id, expire_date_from, expire_date_to)
     )
-    story.append(Paragraph(summary_text, summary_style))
-    
-    # Build PDF with custom header/footer
-    doc.build(story, onFirstPage=header_footer, onLaterPages=header_footer)
-    
-    return FileResponse(file_path, media_type='application/pdf', filename='inventory_export.pdf')
+
+@router.post('/reports/inventory-pdf')
+def create_inventory_pdf_job(
+    warehouse_id: Optional[int] = None,
+    drug_id: Optional[int] = None,
+    expire_date_from: Optional[str] = None,
+    expire_date_to: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    ثبت درخواست گزارش PDF موجودی
+    گزارش در پس‌زمینه ساخته می‌شود؛ وضعیت از /reports/jobs/{job_id} و فایل از /reports/jobs/{job_id}/download
+    """
+    job = submit_inventory_pdf_job(db, warehouse_id, drug_id, expire_date_from, expire_date_to)
+    return reports.job_status(job)
+
+@router.get('/reports/jobs/{job_id}')
+def get_report_job(job_id: str):
+    job = reports.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="درخواست گزارش یافت نشد")
+    return reports.job_status(job)
+
+@router.get('/reports/jobs/{job_id}/download')
+def download_report_job(job_id: str):
+    job = reports.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="درخواست گزارش یافت نشد")
+    if job['status'] == 'failed':
+        raise HTTPException(status_code=500, detail=f"خطا در ساخت گزارش: {job['error']}")
+    if job['status'] != 'done' or not os.path.exists(job['file']):
+        raise HTTPException(status_code=409, detail="گزارش هنوز آماده نشده است")
+    return FileResponse(job['file'], media_type='application/pdf', filename='inventory_export.pdf')
+
+@router.get('/export-pdf')
+async def export_pdf(
+    warehouse_id: Optional[int] = None,
+    drug_id: Optional[int] = None,
+    expire_date_from: Optional[str] = None,
+    expire_date_to: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    خروجی مستقیم PDF (سازگار با نسخه قبل)
+    رندر در process pool انجام می‌شود و در زمان انتظار هیچ thread ای از API اشغال نمی‌شود
+    """
+    job = await run_in_threadpool(submit_inventory_pdf_job, db, warehouse_id, drug_id, expire_date_from, expire_date_to)
+    if job['future'] is not None:
+        try:
+            await asyncio.wrap_future(job['future'])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"خطا در ساخت گزارش: {str(e)}")
+    return FileResponse(job['file'], media_type='application/pdf', filename='inventory_export.pdf')
 
 # User Management Endpoints
 @router.get('/users')
@@ -1711,17 +2598,10 @@ def get_users(db: Session = Depends(get_db)):
         })
     return result
 
-@router.post('/users')
-def add_user(data: dict, db: Session = Depends(get_db)):
-    # Convert username to lowercase for case-insensitive storage
-    username_lower = data['username'].lower()
-    
-    if db.query(User).filter(User.username == username_lower).first():
-        raise HTTPException(status_code=400, detail="نام کاربری تکراری است")
-    
+def create_user(db: Session, data: dict, username: str, hashed: str):
     user = User(
-        username=username_lower,
-        password=pwd_context.hash(data['password']),
+        username=username,
+        password=hashed,
         full_name=data.get('full_name'),
         access_level=data.get('access_level', 'viewer')
     )
@@ -1735,12 +2615,23 @@ def add_user(data: dict, db: Session = Depends(get_db)):
     db.refresh(user)
     return user
 
+@router.post('/users')
+async def add_user(data: dict, db: Session = Depends(get_db)):
+    # Convert username to lowercase for case-insensitive storage
+    username_lower = data['username'].lower()
+    
+    if await run_in_threadpool(find_user_by_username, db, username_lower):
+        raise HTTPException(status_code=400, detail="نام کاربری تکراری است")
+    
+    hashed = await passwords.hash_password(data['password'])
+    return await run_in_threadpool(create_user, db, data, username_lower, hashed)
+
 @router.put('/users/{user_id}')
 def update_user(
     user_id: int, 
     data: dict, 
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_user)
 ):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -1760,7 +2651,8 @@ def update_user(
             )
     
     if 'password' in data and data['password']:
-        user.password = pwd_context.hash(data['password'])
+        user.password = passwords.hash_password_blocking(data['password'])
+        user.token_version = (user.token_version or 0) + 1
     if 'full_name' in data:
         user.full_name = data['full_name']
     if 'access_level' in data:
@@ -1771,6 +2663,7 @@ def update_user(
         user.warehouses = warehouses
         
     db.commit()
+    principals.invalidate(user.id)
     db.refresh(user)
     return user
 
@@ -1786,10 +2679,11 @@ def delete_user(user_id: int, db: Session = Depends(get_db)):
         
     db.delete(user)
     db.commit()
+    principals.invalidate(user_id)
     return {"message": "کاربر با موفقیت حذف شد"}
 
 @router.post('/change-password')
-def change_password(data: dict, authorization: str = Header(None), db: Session = Depends(get_db)):
+async def change_password(data: dict, authorization: str = Header(None), db: Session = Depends(get_db)):
     # Extract user from token - users can only change their own password
     if not authorization or not authorization.startswith('Bearer '):
         raise HTTPException(status_code=401, detail="Authentication required")
@@ -1806,7 +2700,7 @@ def change_password(data: dict, authorization: str = Header(None), db: Session =
         raise HTTPException(status_code=401, detail="Invalid token")
     
     # Get current user and update their password
-    user = db.query(User).filter(User.username == username).first()
+    user = await run_in_threadpool(find_user_by_username, db, username)
     if not user:
         raise HTTPException(status_code=404, detail="کاربر یافت نشد")
     
@@ -1814,18 +2708,18 @@ def change_password(data: dict, authorization: str = Header(None), db: Session =
     if 'old_password' not in data or not data['old_password']:
         raise HTTPException(status_code=400, detail="رمز عبور قبلی الزامی است")
     
-    if not pwd_context.verify(data['old_password'], user.password):
+    valid, _ = await passwords.verify_password(data['old_password'], user.password)
+    if not valid:
         raise HTTPException(status_code=400, detail="رمز عبور قبلی اشتباه است")
     
-    # Update to new password
-    user.password = pwd_context.hash(data['new_password'])
-    db.commit()
-    return {"message": "رمز عبور با موفقیت تغییر یافت"}
+    # Update to new password; tokens issued before the change stop working, so hand out a new one
+    hashed = await passwords.hash_password(data['new_password'])
+    token = await run_in_threadpool(set_password, db, user, hashed)
+    return {"message": "رمز عبور با موفقیت تغییر یافت", "token": token}
 
 @router.get('/settings')
 def get_settings(db: Session = Depends(get_db)):
-    settings = db.query(SystemSettings).all()
-    return {s.key: s.value for s in settings}
+    return get_system_settings(db)
 
 @router.post('/settings')
 def update_settings(data: dict, db: Session = Depends(get_db)):
@@ -1839,6 +2733,20 @@ def update_settings(data: dict, db: Session = Depends(get_db)):
     db.commit()
     return {"message": "تنظیمات ذخیره شد"}
 
+@router.get('/cache/stats')
+def get_cache_stats(current_user: Principal = Depends(get_current_user)):
+    """آمار کش داده‌های پایه و کاربران احراز هویت شده (hit/miss)"""
+    if current_user.access_level not in ['admin', 'superadmin']:
+        raise HTTPException(status_code=403, detail="فقط مدیران به آمار کش دسترسی دارند")
+    return dict(refcache.stats(), principals=principals.stats())
+
+@router.get('/password-pool/stats')
+def get_password_pool_stats(current_user: Principal = Depends(get_current_user)):
+    """وضعیت صف هش رمز عبور (عمق صف، زمان انتظار و اجرا)"""
+    if current_user.access_level not in ['admin', 'superadmin']:
+        raise HTTPException(status_code=403, detail="فقط مدیران به آمار صف رمز عبور دسترسی دارند")
+    return passwords.stats()
+
 @router.get('/inventory/{inventory_id}/used')
 def check_inventory_used(inventory_id: int, db: Session = Depends(get_db)):
     inventory = db.query(Inventory).filter(Inventory.id == inventory_id).first()
@@ -1858,7 +2766,8 @@ def check_inventory_used(inventory_id: int, db: Session = Depends(get_db)):
 @router.get('/permissions')
 def get_all_permissions(db: Session = Depends(get_db)):
     """دریافت لیست تمام دسترسی‌های موجود"""
-    return db.query(Permission).all()
+    return refcache.get_or_load(db, 'permissions', ['permissions'],
+                                lambda: [row_dict(p) for p in db.query(Permission).all()])
 
 @router.post('/permissions')
 def create_permission(data: dict, db: Session = Depends(get_db)):
@@ -1894,6 +2803,7 @@ def assign_permissions_to_user(user_id: int, permission_ids: list, db: Session =
     permissions = db.query(Permission).filter(Permission.id.in_(permission_ids)).all()
     user.permissions = permissions
     db.commit()
+    principals.invalidate(user_id)
     
     return {"message": "دسترسی‌ها با موفقیت تخصیص داده شد"}
 
@@ -1908,6 +2818,7 @@ def remove_permission_from_user(user_id: int, permission_id: int, db: Session =
     if permission in user.permissions:
         user.permissions.remove(permission)
         db.commit()
+        principals.invalidate(user_id)
         return {"message": "دسترسی حذف شد"}
     
     raise HTTPException(status_code=404, detail="این دسترسی برای کاربر وجود ندارد")
@@ -1925,105 +2836,59 @@ def get_all_tools(db: Session = Depends(get_db)):
         'serial_number': t.serial_number,
         'manufacturer': t.manufacturer,
         'image': t.image,
+        'image_hash': t.image_hash,
         'description': t.description
     } for t in tools]
 
-@router.post('/tools')
-def create_tool(data: dict, db: Session = Depends(get_db)):
-    """ایجاد ابزار جدید"""
-    # Check if serial number already exists
-    if db.query(Tool).filter(Tool.serial_number == data['serial_number']).first():
-        raise HTTPException(status_code=400, detail="سریال تکراری است")
-    
-    # Handle image
-    image_path = None
-    image_data = data.get('image_data')
-    
-    if image_data:
-        import base64
-        import uuid
-        images_dir = os.path.join(os.path.dirname(__file__), 'images')
-        if not os.path.exists(images_dir):
-            os.makedirs(images_dir)
-        
-        image_filename = f"tool_{uuid.uuid4().hex[:8]}.jpg"
-        image_path = os.path.join('images', image_filename)
-        full_path = os.path.join(images_dir, image_filename)
-        
-        try:
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            with open(full_path, 'wb') as f:
-                f.write(base64.b64decode(image_data))
-        except Exception as e:
-            print(f"Error saving image: {e}")
-            image_path = None
-    
-    tool = Tool(
-        name=data['name'],
-        serial_number=data['serial_number'],
-        manufacturer=data.get('manufacturer', ''),
-        image=image_path,
-        image_data=data.get('image_data', ''),
-        description=data.get('description', '')
-    )
-    
-    db.add(tool)
-    db.commit()
-    db.refresh(tool)
-    
+def tool_dict(tool: Tool) -> dict:
     return {
         'id': tool.id,
         'name': tool.name,
         'serial_number': tool.serial_number,
         'manufacturer': tool.manufacturer,
         'image': tool.image,
+        'image_hash': tool.image_hash,
         'description': tool.description
     }
 
-@router.put('/tools/{tool_id}')
-def update_tool(tool_id: int, data: dict, db: Session = Depends(get_db)):
-    """ویرایش ابزار"""
+def check_tool_serial(db: Session, serial_number: str, tool_id: int = None):
+    """سریال تکراری - 400"""
+    query = db.query(Tool.id).filter(Tool.serial_number == serial_number)
+    if tool_id is not None:
+        query = query.filter(Tool.id != tool_id)
+    if query.first():
+        raise HTTPException(status_code=400, detail="سریال تکراری است")
+
+def get_tool_or_404(db: Session, tool_id: int) -> Tool:
     tool = db.query(Tool).filter(Tool.id == tool_id).first()
     if not tool:
         raise HTTPException(status_code=404, detail="ابزار یافت نشد")
+    return tool
+
+def save_new_tool(db: Session, data: dict, image_hash: Optional[str]) -> dict:
+    tool = Tool(
+        name=data['name'],
+        serial_number=data['serial_number'],
+        manufacturer=data.get('manufacturer', ''),
+        image=imagestore.relative_path(image_hash) if image_hash else None,
+        image_hash=image_hash,
+        description=data.get('description', '')
+    )
     
-    # Check serial uniqueness if changed
-    if 'serial_number' in data and data['serial_number'] != tool.serial_number:
-        if db.query(Tool).filter(Tool.serial_number == data['serial_number']).first():
-            raise HTTPException(status_code=400, detail="سریال تکراری است")
-    
-    # Handle image update
-    if 'image_data' in data and data['image_data']:
-        import base64
-        import uuid
-        images_dir = os.path.join(os.path.dirname(__file__), 'images')
-        if not os.path.exists(images_dir):
-            os.makedirs(images_dir)
-        
-        image_filename = f"tool_{uuid.uuid4().hex[:8]}.jpg"
-        image_path = os.path.join('images', image_filename)
-        full_path = os.path.join(images_dir, image_filename)
-        
-        try:
-            image_data = data['image_data']
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            with open(full_path, 'wb') as f:
-                f.write(base64.b64decode(image_data))
-            
-            # Delete old image if exists
-            if tool.image:
-                old_path = os.path.join(os.path.dirname(__file__), tool.image)
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-            
-            tool.image = image_path
-            tool.image_data = data['image_data']
-        except Exception as e:
-            print(f"Error updating image: {e}")
+    db.add(tool)
+    db.commit()
+    db.refresh(tool)
+    return tool_dict(tool)
+
+def save_tool_update(db: Session, tool: Tool, data: dict, image_hash: Optional[str]) -> dict:
+    # The previous store entry is released after commit
+    previous_hash = tool.image_hash
+    if image_hash:
+        if tool.image and not previous_hash:
+            remove_legacy_image(tool.image)
+        tool.image = imagestore.relative_path(image_hash)
+        tool.image_hash = image_hash
+        tool.image_data = None
     
     # Update fields
     if 'name' in data:
@@ -2036,16 +2901,40 @@ def update_tool(tool_id: int, data: dict, db: Session = Depends(get_db)):
         tool.description = data['description']
     
     db.commit()
+    if previous_hash != tool.image_hash:
+        imagestore.release(db, previous_hash)
     db.refresh(tool)
+    return tool_dict(tool)
+
+@router.post('/tools')
+async def create_tool(data: dict, db: Session = Depends(get_db)):
+    """ایجاد ابزار جدید"""
+    # Check if serial number already exists (before any time is spent on the image)
+    await run_in_threadpool(check_tool_serial, db, data['serial_number'])
     
-    return {
-        'id': tool.id,
-        'name': tool.name,
-        'serial_number': tool.serial_number,
-        'manufacturer': tool.manufacturer,
-        'image': tool.image,
-        'description': tool.description
-    }
+    # Handle image (base64 data URL) in the image worker pool
+    if not data.get('image_data'):
+        return await run_in_threadpool(save_new_tool, db, data, None)
+    image_bytes = decode_data_url(data['image_data'])
+    with imagestore.pinned(imagestore.digest_of(image_bytes)):
+        image_hash = await ingest_image(image_bytes)
+        return await run_in_threadpool(save_new_tool, db, data, image_hash)
+
+@router.put('/tools/{tool_id}')
+async def update_tool(tool_id: int, data: dict, db: Session = Depends(get_db)):
+    """ویرایش ابزار"""
+    tool = await run_in_threadpool(get_tool_or_404, db, tool_id)
+    
+    # Check serial uniqueness if changed
+    if 'serial_number' in data and data['serial_number'] != tool.serial_number:
+        await run_in_threadpool(check_tool_serial, db, data['serial_number'], tool_id)
+    
+    if not data.get('image_data'):
+        return await run_in_threadpool(save_tool_update, db, tool, data, None)
+    image_bytes = decode_data_url(data['image_data'])
+    with imagestore.pinned(imagestore.digest_of(image_bytes)):
+        image_hash = await ingest_image(image_bytes)
+        return await run_in_threadpool(save_tool_update, db, tool, data, image_hash)
 
 @router.delete('/tools/{tool_id}')
 def delete_tool(tool_id: int, db: Session = Depends(get_db)):
@@ -2058,14 +2947,14 @@ def delete_tool(tool_id: int, db: Session = Depends(get_db)):
     if db.query(ToolInventory).filter(ToolInventory.tool_id == tool_id).first():
         raise HTTPException(status_code=400, detail="این ابزار در موجودی استفاده شده و قابل حذف نیست")
     
-    # Delete image file if exists
-    if tool.image:
-        image_path = os.path.join(os.path.dirname(__file__), tool.image)
-        if os.path.exists(image_path):
-            os.remove(image_path)
+    # Delete image file if exists; store entries may be shared and are released after commit
+    image_hash = tool.image_hash
+    if tool.image and not image_hash:
+        remove_legacy_image(tool.image)
     
     db.delete(tool)
     db.commit()
+    imagestore.release(db, image_hash)
     return {"message": "ابزار حذف شد"}
 
 # Tool Inventory Management
@@ -2124,12 +3013,13 @@ def add_tool_to_inventory(data: dict, db: Session = Depends(get_db)):
     )
     
     db.add(inventory)
-    db.commit()
-    db.refresh(inventory)
+    db.flush()
     
     # Log the operation
-    log_operation(db, data.get('user_id'), 'add_tool_inventory', 
-                  f"افزودن ابزار {inventory.tool.serial_number} به انبار {inventory.warehouse.name}")
+    log_operation(db, "Add Tool Inventory",
+                  f"افزودن ابزار {inventory.tool.serial_number} به انبار {inventory.warehouse.name}",
+                  user_id=data.get('user_id'))
+    db.commit()
     
     return {"message": "ابزار به موجودی اضافه شد", "id": inventory.id}
 
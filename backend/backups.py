@@ -0,0 +1,780 @@
+"""
+Online backups of pharmacy.db.
+
+A backup is taken with SQLite's online backup API (sqlite3.Connection.backup), so the copy is
+a consistent snapshot even while the API keeps writing; copying the file could catch a
+transaction half-written. Pages are copied BACKUP_PAGES_PER_STEP at a time and the source lock
+is released between steps, so writers are never held up for the whole copy. A write from
+another connection makes SQLite restart the copy; after BACKUP_MAX_RESTARTS restarts the copy
+is done in a single step instead, which in WAL mode reads one snapshot without blocking writers.
+
+Each copy is checked with PRAGMA integrity_check, gzipped to db_backup/pharmacy_<time>.db.gz,
+and the compressed file is read back and compared with the checked copy. Backups run one at a
+time on a background thread: enqueue() returns at once with a job, like the PDF report jobs.
+
+An in-process scheduler takes a backup when the newest one is older than
+PHARMACY_BACKUP_INTERVAL_HOURS (0 turns it off). After every backup, retention keeps the newest
+backup of each of the last PHARMACY_BACKUP_KEEP_DAILY days and of each of the last
+PHARMACY_BACKUP_KEEP_MONTHLY months; older pharmacy_*.db.gz files are deleted. Files in other
+formats (the plain .db copies made before) are left alone.
+
+Between full backups, an incremental backup is taken every PHARMACY_BACKUP_INCREMENT_MINUTES
+(60; 0 turns them off). It holds only the rows changed since the previous backup of the chain,
+found through the row-level change log (changelog.py), read in one snapshot together with
+their change-log entries, and gzipped as JSON:
+
+    pharmacy_<full time>.db.gz                      full backup
+    pharmacy_<full time>.db.json                    its change version and schema fingerprint
+    pharmacy_<full time>_inc_<time>.json.gz         rows changed since the previous file
+
+The small tables without an id column (COPIED_TABLES) are copied whole into every increment;
+stock_summary is kept by its triggers during a restore and verified afterwards. An increment
+applies only to the schema it was taken with: after a migration the next increment is a full
+backup. Increments are deleted with their full backup.
+
+restore() writes the database as of any time covered by the backups: the newest full backup
+taken at or before it, plus its increments up to it. Command line:
+    python backups.py --list
+    python backups.py --full | --incremental                take a backup now
+    python backups.py --restore restored.db [--until "2026-10-17 13:00"]
+
+Images live in the image store (images/store), not in the database. Each backup copies the
+store entries its rows point at into db_backup/images, laid out like the store. Entries are
+content-addressed and never change, so each one is copied (and verified) once, however many
+backups use it. The manifest and each increment list them; restore() copies them back into the
+store, and entries no kept backup uses are deleted by retention.
+"""
+from datetime import datetime
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from database import BASE_DIR, DB_PATH
+import changelog
+import imagestore
+import stock_summary
+
+BACKUP_DIR = os.path.join(BASE_DIR, 'db_backup')
+BACKUP_INTERVAL_HOURS = float(os.environ.get('PHARMACY_BACKUP_INTERVAL_HOURS', 24))
+BACKUP_KEEP_DAILY = int(os.environ.get('PHARMACY_BACKUP_KEEP_DAILY', 7))
+BACKUP_KEEP_MONTHLY = int(os.environ.get('PHARMACY_BACKUP_KEEP_MONTHLY', 12))
+BACKUP_INCREMENT_MINUTES = float(os.environ.get('PHARMACY_BACKUP_INCREMENT_MINUTES', 60))
+BACKUP_PAGES_PER_STEP = int(os.environ.get('PHARMACY_BACKUP_PAGES_PER_STEP', 1024))
+BACKUP_MAX_RESTARTS = 3
+BACKUP_JOB_TTL_SECONDS = 24 * 60 * 60
+SCHEDULER_CHECK_SECONDS = 300
+
+BACKUP_NAME_RE = re.compile(r'pharmacy_(\d{8}_\d{6})\.db\.gz')
+INCREMENT_NAME_RE = re.compile(r'pharmacy_(\d{8}_\d{6})_inc_(\d{8}_\d{6})\.json\.gz')
+TIME_FORMAT = '%Y%m%d_%H%M%S'
+
+# Tables without an id column, copied whole into every increment
+COPIED_TABLES = ('user_warehouses', 'user_permissions')
+
+# Tables whose image_hash points into the image store
+IMAGE_TABLES = ('drugs', 'tools')
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_queue = queue.Queue()
+_worker = None
+_scheduler = None
+_stop = threading.Event()
+
+class BackupError(Exception):
+    pass
+
+class _TooManyRestarts(Exception):
+    pass
+
+# ---------- Taking a backup ----------
+
+def _copy_online(target_path):
+    """Consistent copy of the live database into target_path; returns the number of restarts"""
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+
+    source = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        for pages in (BACKUP_PAGES_PER_STEP, -1):
+            target = sqlite3.connect(target_path)
+            try:
+                source.backup(target, pages=pages, progress=progress if pages > 0 else None)
+                # A standalone file: no WAL to go with it
+                target.execute("PRAGMA journal_mode=DELETE")
+                return restarts
+            except _TooManyRestarts:
+                continue
+            finally:
+                target.close()
+    finally:
+        source.close()
+
+def _integrity_check(path):
+    conn = sqlite3.connect(path)
+    try:
+        result = [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+    finally:
+        conn.close()
+    if result != ['ok']:
+        raise BackupError(f"integrity_check failed: {'; '.join(result[:5])}")
+
+def _sha256_of(file_obj) -> str:
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file_obj.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def _compress(source_path, target_path):
+    """gzip source_path to target_path, then read the archive back and compare it with the source"""
+    tmp_path = f"{target_path}.tmp"
+    with open(source_path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    with open(source_path, 'rb') as src, gzip.open(tmp_path, 'rb') as archived:
+        if _sha256_of(src) != _sha256_of(archived):
+            os.remove(tmp_path)
+            raise BackupError("compressed backup does not match the checked copy")
+    os.replace(tmp_path, target_path)
+
+def _write_atomic(path, data: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _remove_leftovers():
+    """Partial files of a backup cut off by a shutdown; only one backup runs at a time"""
+    for name in os.listdir(BACKUP_DIR):
+        if (name.startswith('.pharmacy_') and name.endswith('.db')) or \
+                (name.startswith('pharmacy_') and name.endswith('.tmp')):
+            try:
+                os.remove(os.path.join(BACKUP_DIR, name))
+            except OSError:
+                pass
+
+def schema_fingerprint(cursor) -> str:
+    """sha256 of the schema (tables, indexes, triggers); increments only apply to the same schema"""
+    entries = cursor.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY type, name"
+    ).fetchall()
+    return hashlib.sha256(json.dumps(entries).encode('utf-8')).hexdigest()
+
+def _columns(cursor, table):
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+
+def _copy_tables(cursor) -> dict:
+    existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+    return {table: {
+        'columns': _columns(cursor, table),
+        'rows': [list(row) for row in cursor.execute(f"SELECT * FROM {table} ORDER BY rowid").fetchall()]
+    } for table in COPIED_TABLES if table in existing}
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def image_backup_dir() -> str:
+    return os.path.join(BACKUP_DIR, 'images')
+
+def referenced_images(cursor, tables=IMAGE_TABLES) -> list:
+    """Image store digests the rows of a database point at"""
+    digests = set()
+    for table in tables:
+        try:
+            digests.update(row[0] for row in cursor.execute(
+                f"SELECT DISTINCT image_hash FROM {table} WHERE image_hash IS NOT NULL").fetchall())
+        except sqlite3.OperationalError:
+            pass  # a database from before the image store
+    return sorted(digest for digest in digests if imagestore.is_digest(digest))
+
+def copy_images(digests, source_dir, target_dir) -> dict:
+    """
+    Copy image store entries between stores (live store and db_backup/images, either way).
+    Entries already in the target are skipped; each copy is verified against its checksums.
+    Returns the copied digests and those missing or damaged in the source.
+    """
+    copied, missing = [], []
+    for digest in digests:
+        if imagestore.exists(digest, target_dir):
+            continue
+        if not imagestore.verify(digest, source_dir):
+            missing.append(digest)
+            continue
+        target = imagestore.entry_dir(digest, target_dir)
+        tmp_path = f"{target}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.copytree(imagestore.entry_dir(digest, source_dir), tmp_path)
+        os.replace(tmp_path, target)
+        if imagestore.verify(digest, target_dir):
+            copied.append(digest)
+        else:
+            shutil.rmtree(target, ignore_errors=True)
+            missing.append(digest)
+    return {'copied': copied, 'missing': missing}
+
+def _manifest(path, filename) -> dict:
+    """What the next increment needs to know about a full backup, read from its checked copy"""
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.cursor()
+        try:
+            version = changelog.current_version(cursor)
+        except sqlite3.OperationalError:
+            version = None  # no change log in this database: increments cannot follow it
+        return {
+            'backup': filename,
+            'version': version,
+            'schema': schema_fingerprint(cursor),
+            'copied_sha256': _digest(_copy_tables(cursor)),
+            'images': referenced_images(cursor)
+        }
+    finally:
+        conn.close()
+
+def manifest_path(filename) -> str:
+    return os.path.join(BACKUP_DIR, filename[:-len('.gz')] + '.json')
+
+def read_manifest(filename):
+    try:
+        with open(manifest_path(filename), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def take_backup(filename) -> dict:
+    """Online copy, integrity check, compress, retention; returns the backup's details"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    _remove_leftovers()
+    copy_path = os.path.join(BACKUP_DIR, f".{filename}.{uuid.uuid4().hex[:8]}.db")
+    started = time.perf_counter()
+    try:
+        restarts = _copy_online(copy_path)
+        copied = time.perf_counter()
+        _integrity_check(copy_path)
+        manifest = _manifest(copy_path, filename)
+        checked = time.perf_counter()
+        _compress(copy_path, os.path.join(BACKUP_DIR, filename))
+        images = copy_images(manifest['images'], None, image_backup_dir())
+        if images['missing']:
+            print(f"⚠️  {len(images['missing'])} images of backup {filename} are missing from the image store")
+        _write_atomic(manifest_path(filename), json.dumps(manifest).encode('utf-8'))
+        database_bytes = os.path.getsize(copy_path)
+    finally:
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+    finished = time.perf_counter()
+    return {
+        'kind': 'full',
+        'file': filename,
+        'version': manifest['version'],
+        'database_bytes': database_bytes,
+        'backup_bytes': os.path.getsize(os.path.join(BACKUP_DIR, filename)),
+        'restarts': restarts,
+        'images': len(manifest['images']),
+        'images_copied': len(images['copied']),
+        'images_missing': images['missing'],
+        'copy_seconds': round(copied - started, 3),
+        'check_seconds': round(checked - copied, 3),
+        'compress_seconds': round(finished - checked, 3),
+        'deleted': apply_retention()
+    }
+
+# ---------- Incremental backups ----------
+
+def _fetch_rows(cursor, table, columns, ids):
+    rows = []
+    select = f"SELECT {', '.join(columns)} FROM {table}"
+    for start in range(0, len(ids), changelog.SYNC_BATCH_SIZE):
+        batch = ids[start:start + changelog.SYNC_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch))
+        rows.extend(list(row) for row in cursor.execute(
+            f"{select} WHERE id IN ({placeholders}) ORDER BY id", batch).fetchall())
+    return rows
+
+def read_changes(since: int) -> dict:
+    """Rows changed after change version `since`, with their change-log entries, from one snapshot"""
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    try:
+        cursor = conn.cursor()
+        # A single read transaction: the version, the log and the rows all belong to the same commit
+        cursor.execute("BEGIN")
+        changes = {
+            'to_version': changelog.current_version(cursor),
+            'schema': schema_fingerprint(cursor),
+            'tables': {},
+            'copied': _copy_tables(cursor)
+        }
+        for table in changelog.LOGGED_TABLES:
+            log = [list(entry) for entry in cursor.execute(
+                "SELECT row_id, created_version, version, deleted FROM change_log "
+                "WHERE table_name = ? AND version > ? ORDER BY row_id",
+                (table, since)
+            ).fetchall()]
+            if not log:
+                continue
+            columns = _columns(cursor, table)
+            changes['tables'][table] = {
+                'columns': columns,
+                'rows': _fetch_rows(cursor, table, columns, [row_id for row_id, _, _, deleted in log if not deleted]),
+                'deleted': [row_id for row_id, _, _, deleted in log if deleted],
+                'log': log
+            }
+        cursor.execute("COMMIT")
+        return changes
+    finally:
+        conn.close()
+
+def read_increment(name) -> dict:
+    with gzip.open(os.path.join(BACKUP_DIR, name), 'rb') as f:
+        return json.loads(f.read())
+
+def take_incremental(now=None) -> dict:
+    """
+    Rows changed since the previous backup of the newest chain, as pharmacy_<base>_inc_<time>.json.gz.
+    Takes a full backup instead when there is no usable base; writes nothing when nothing changed.
+    """
+    now = now or datetime.now()
+    full_name = f"pharmacy_{now.strftime(TIME_FORMAT)}.db.gz"
+    backups = list_backups()
+    manifest = read_manifest(backups[0][1]) if backups else None
+    if not manifest or manifest.get('version') is None:
+        return take_backup(full_name)
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    _remove_leftovers()
+    base = manifest['backup']
+    chain = list_increments(base)
+    previous = read_increment(chain[-1][2]) if chain else manifest
+    since = previous['to_version'] if chain else manifest['version']
+
+    started = time.perf_counter()
+    changes = read_changes(since)
+    read = time.perf_counter()
+    # After a migration, or when pharmacy.db was replaced by an older copy, start a new chain
+    if changes['schema'] != manifest['schema'] or changes['to_version'] < since:
+        return take_backup(full_name)
+    copied_sha256 = _digest(changes['copied'])
+    if changes['to_version'] == since and copied_sha256 == previous['copied_sha256']:
+        return {'kind': 'incremental', 'file': None, 'base': base, 'unchanged': True, 'version': since}
+
+    # Images the changed rows point at; entries the chain already copied are skipped
+    images = sorted({
+        row[changed['columns'].index('image_hash')]
+        for table, changed in changes['tables'].items()
+        if table in IMAGE_TABLES and 'image_hash' in changed['columns']
+        for row in changed['rows']
+        if imagestore.is_digest(row[changed['columns'].index('image_hash')])
+    })
+    image_copies = copy_images(images, None, image_backup_dir())
+    if image_copies['missing']:
+        print(f"⚠️  {len(image_copies['missing'])} images of this increment are missing from the image store")
+
+    filename = f"pharmacy_{base[len('pharmacy_'):-len('.db.gz')]}_inc_{now.strftime(TIME_FORMAT)}.json.gz"
+    increment = dict(changes, file=filename, base=base, taken_at=now.strftime('%Y-%m-%d %H:%M:%S'),
+                     from_version=since, copied_sha256=copied_sha256, images=images)
+    data = json.dumps(increment, separators=(',', ':')).encode('utf-8')
+    compressed = gzip.compress(data, compresslevel=6)
+    if gzip.decompress(compressed) != data:
+        raise BackupError("compressed increment does not match its data")
+    _write_atomic(os.path.join(BACKUP_DIR, filename), compressed)
+    finished = time.perf_counter()
+    return {
+        'kind': 'incremental',
+        'file': filename,
+        'base': base,
+        'from_version': since,
+        'version': changes['to_version'],
+        'rows': sum(len(t['rows']) for t in changes['tables'].values()),
+        'deleted_rows': sum(len(t['deleted']) for t in changes['tables'].values()),
+        'backup_bytes': len(compressed),
+        'images': len(images),
+        'images_copied': len(image_copies['copied']),
+        'images_missing': image_copies['missing'],
+        'read_seconds': round(read - started, 3),
+        'compress_seconds': round(finished - read, 3)
+    }
+
+# ---------- Restore ----------
+
+def _quoted(columns):
+    return ', '.join(f'"{column}"' for column in columns)
+
+def apply_increment(conn, increment):
+    """Replay one increment on a restored database that is at its from_version"""
+    cursor = conn.cursor()
+    version = changelog.current_version(cursor)
+    if version != increment['from_version']:
+        raise BackupError(f"{increment['file']} starts at change version {increment['from_version']}, "
+                          f"the database is at {version} (an increment is missing)")
+    if schema_fingerprint(cursor) != increment['schema']:
+        raise BackupError(f"{increment['file']} was taken with a different schema than its base")
+
+    # Deletes first: a unique value freed by a deleted row may be reused by an upserted one
+    for table, changes in increment['tables'].items():
+        deleted = changes['deleted']
+        for start in range(0, len(deleted), changelog.SYNC_BATCH_SIZE):
+            batch = deleted[start:start + changelog.SYNC_BATCH_SIZE]
+            cursor.execute(f"DELETE FROM {table} WHERE id IN ({', '.join('?' * len(batch))})", batch)
+    # Upserts fire the INSERT/UPDATE triggers, so stock_summary follows the inventory rows
+    for table, changes in increment['tables'].items():
+        columns = changes['columns']
+        updates = ', '.join(f'"{column}" = excluded."{column}"' for column in columns if column != 'id')
+        cursor.executemany(
+            f"INSERT INTO {table} ({_quoted(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT (id) DO UPDATE SET {updates}",
+            changes['rows']
+        )
+    for table, copied in increment['copied'].items():
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.executemany(
+            f"INSERT INTO {table} ({_quoted(copied['columns'])}) VALUES ({', '.join('?' * len(copied['columns']))})",
+            copied['rows']
+        )
+    # The replay went through the change-log triggers; put back the versions the live database had,
+    # so /api/sync clients see the restored database as the one they synced with
+    cursor.executemany(
+        "INSERT INTO change_log (table_name, row_id, created_version, version, deleted) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (table_name, row_id) DO UPDATE SET created_version = excluded.created_version, "
+        "version = excluded.version, deleted = excluded.deleted",
+        [(table, *entry) for table, changes in increment['tables'].items() for entry in changes['log']]
+    )
+    cursor.execute("UPDATE change_version SET version = ? WHERE id = 1", (increment['to_version'],))
+
+def restore_plan(until=None):
+    """(full backup, [increments]) that restore the state as of `until` (default: the newest)"""
+    until = until or datetime.max
+    fulls = [name for taken_at, name in list_backups() if taken_at <= until]
+    if not fulls:
+        raise BackupError(f"no full backup taken at or before {until}")
+    return fulls[0], [name for taken_at, _, name in list_increments(fulls[0]) if taken_at <= until]
+
+def restore(output_path, until=None) -> dict:
+    """
+    Write the database as of `until` to output_path, which must not exist yet, and put the
+    images it points at back into the image store (entries already there are left alone)
+    """
+    if os.path.exists(output_path):
+        raise BackupError(f"{output_path} already exists")
+    base, increments = restore_plan(until)
+    tmp_path = f"{output_path}.{uuid.uuid4().hex[:8]}.tmp"
+    started = time.perf_counter()
+    try:
+        with gzip.open(os.path.join(BACKUP_DIR, base), 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        unpacked = time.perf_counter()
+        conn = sqlite3.connect(tmp_path)
+        try:
+            cursor = conn.cursor()
+            for name in increments:
+                apply_increment(conn, read_increment(name))
+            mismatches = stock_summary.verify(cursor)
+            if mismatches:
+                stock_summary.rebuild(cursor)
+            conn.commit()
+            try:
+                version = changelog.current_version(cursor)
+            except sqlite3.OperationalError:
+                version = None
+            images = referenced_images(cursor)
+        finally:
+            conn.close()
+        replayed = time.perf_counter()
+        _integrity_check(tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    image_copies = copy_images(images, image_backup_dir(), None)
+    return {
+        'base': base,
+        'increments': increments,
+        'version': version,
+        'stock_summary_rebuilt': bool(mismatches),
+        'images': len(images),
+        'images_restored': len(image_copies['copied']),
+        'images_missing': image_copies['missing'],
+        'unpack_seconds': round(unpacked - started, 3),
+        'replay_seconds': round(replayed - unpacked, 3),
+        'check_seconds': round(time.perf_counter() - replayed, 3)
+    }
+
+# ---------- Retention ----------
+
+def list_backups():
+    """(datetime, filename) of the managed backups, newest first"""
+    try:
+        names = os.listdir(BACKUP_DIR)
+    except FileNotFoundError:
+        return []
+    backups = []
+    for name in names:
+        match = BACKUP_NAME_RE.fullmatch(name)
+        if match:
+            backups.append((datetime.strptime(match.group(1), TIME_FORMAT), name))
+    return sorted(backups, reverse=True)
+
+def list_increments(base=None):
+    """(datetime, base backup, filename) of the increments, of one base if given, oldest first"""
+    try:
+        names = os.listdir(BACKUP_DIR)
+    except FileNotFoundError:
+        return []
+    increments = []
+    for name in names:
+        match = INCREMENT_NAME_RE.fullmatch(name)
+        if match:
+            base_name = f"pharmacy_{match.group(1)}.db.gz"
+            if base is None or base_name == base:
+                increments.append((datetime.strptime(match.group(2), TIME_FORMAT), base_name, name))
+    return sorted(increments)
+
+def backups_to_keep(backups, keep_daily=BACKUP_KEEP_DAILY, keep_monthly=BACKUP_KEEP_MONTHLY) -> set:
+    """Newest backup of each of the last keep_daily days and keep_monthly months (backups: newest first)"""
+    keep = set()
+    days, months = set(), set()
+    for taken_at, name in backups:
+        day, month = taken_at.date(), (taken_at.year, taken_at.month)
+        if day not in days and len(days) < keep_daily:
+            days.add(day)
+            keep.add(name)
+        if month not in months and len(months) < keep_monthly:
+            months.add(month)
+            keep.add(name)
+    return keep
+
+def apply_retention() -> list:
+    """Delete the backups not kept, with their manifests and increments"""
+    backups = list_backups()
+    keep = backups_to_keep(backups, BACKUP_KEEP_DAILY, BACKUP_KEEP_MONTHLY)
+    deleted = []
+    for _, name in backups:
+        if name not in keep:
+            try:
+                os.remove(os.path.join(BACKUP_DIR, name))
+                deleted.append(name)
+            except OSError as e:
+                print(f"⚠️  Could not delete old backup {name}: {e}")
+                continue
+            if os.path.exists(manifest_path(name)):
+                os.remove(manifest_path(name))
+    # Increments are useless without their base
+    for _, base, name in list_increments():
+        if base not in keep:
+            try:
+                os.remove(os.path.join(BACKUP_DIR, name))
+                deleted.append(name)
+            except OSError as e:
+                print(f"⚠️  Could not delete old increment {name}: {e}")
+    prune_images()
+    return deleted
+
+def prune_images():
+    """Delete the image copies that no kept backup points at"""
+    keep = set()
+    for _, name in list_backups():
+        keep.update((read_manifest(name) or {}).get('images', []))
+    for _, _, name in list_increments():
+        keep.update(read_increment(name).get('images', []))
+    root = image_backup_dir()
+    if not os.path.isdir(root):
+        return
+    for prefix in os.listdir(root):
+        if not os.path.isdir(os.path.join(root, prefix)):
+            continue
+        for digest in os.listdir(os.path.join(root, prefix)):
+            if digest not in keep:
+                shutil.rmtree(os.path.join(root, prefix, digest), ignore_errors=True)
+
+# ---------- Jobs ----------
+
+def _prune_jobs():
+    cutoff = time.time() - BACKUP_JOB_TTL_SECONDS
+    for job_id in [j for j, job in _jobs.items() if job['created_at'] < cutoff and job['status'] in ('done', 'failed')]:
+        del _jobs[job_id]
+
+def _run_worker():
+    while True:
+        job_id = _queue.get()
+        if job_id is None:
+            return
+        with _jobs_lock:
+            job = _jobs[job_id]
+            job['status'] = 'running'
+        try:
+            result = take_incremental() if job['kind'] == 'incremental' else take_backup(job['file'])
+            with _jobs_lock:
+                job.update(status='done', result=result, file=result['file'])
+        except Exception as e:
+            with _jobs_lock:
+                job.update(status='failed', error=str(e))
+            print(f"❌ Backup {job['file'] or job['kind']} failed: {e}")
+        with _jobs_lock:
+            job['finished_at'] = time.time()
+
+def _ensure_worker():
+    global _worker
+    if _worker is None or not _worker.is_alive():
+        _worker = threading.Thread(target=_run_worker, name='backup-worker', daemon=True)
+        _worker.start()
+
+def enqueue(reason: str = 'manual', incremental: bool = False) -> dict:
+    """
+    Queue a backup and return its job at once. A full backup already queued or running is
+    reused, and so is any backup when an incremental one is asked for.
+    The file of an incremental job is known once it has run.
+    """
+    with _jobs_lock:
+        _prune_jobs()
+        for job in _jobs.values():
+            if job['status'] in ('queued', 'running') and (job['kind'] == 'full' or incremental):
+                return job
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'kind': 'incremental' if incremental else 'full',
+            'reason': reason,
+            'file': None if incremental else f"pharmacy_{datetime.now().strftime(TIME_FORMAT)}.db.gz",
+            'result': None,
+            'error': None,
+            'created_at': time.time(),
+            'finished_at': None
+        }
+        _jobs[job['id']] = job
+        _ensure_worker()
+    _queue.put(job['id'])
+    return job
+
+def get_job(job_id: str):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+def job_status(job: dict) -> dict:
+    with _jobs_lock:
+        return {
+            'job_id': job['id'],
+            'status': job['status'],
+            'kind': job['kind'],
+            'reason': job['reason'],
+            'backup': job['file'],
+            'result': job['result'],
+            'error': job['error']
+        }
+
+# ---------- Schedule ----------
+
+def backup_due(now=None) -> bool:
+    if BACKUP_INTERVAL_HOURS <= 0:
+        return False
+    backups = list_backups()
+    if not backups:
+        return True
+    now = now or datetime.now()
+    return (now - backups[0][0]).total_seconds() >= BACKUP_INTERVAL_HOURS * 3600
+
+def increment_due(now=None) -> bool:
+    """An increment is due when the newest full or incremental backup is older than the interval"""
+    if BACKUP_INCREMENT_MINUTES <= 0:
+        return False
+    backups = list_backups()
+    if not backups:
+        return False
+    increments = list_increments(backups[0][1])
+    newest = increments[-1][0] if increments else backups[0][0]
+    now = now or datetime.now()
+    return (now - newest).total_seconds() >= BACKUP_INCREMENT_MINUTES * 60
+
+def _run_scheduler():
+    while True:
+        try:
+            if backup_due():
+                enqueue('scheduled')
+            elif increment_due():
+                enqueue('scheduled', incremental=True)
+        except Exception as e:
+            print(f"⚠️  Backup scheduler: {e}")
+        if _stop.wait(SCHEDULER_CHECK_SECONDS):
+            return
+
+def start_scheduler():
+    global _scheduler
+    if (BACKUP_INTERVAL_HOURS <= 0 and BACKUP_INCREMENT_MINUTES <= 0) or \
+            (_scheduler is not None and _scheduler.is_alive()):
+        return
+    _stop.clear()
+    _scheduler = threading.Thread(target=_run_scheduler, name='backup-scheduler', daemon=True)
+    _scheduler.start()
+
+def stop_scheduler():
+    _stop.set()
+
+# ---------- Command line ----------
+
+def _megabytes(size) -> str:
+    return f"{size / 1024 / 1024:.2f} MB"
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Backups of pharmacy.db")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--list', action='store_true', help='list full backups and their increments')
+    action.add_argument('--full', action='store_true', help='take a full backup now')
+    action.add_argument('--incremental', action='store_true', help='take an incremental backup now')
+    action.add_argument('--restore', metavar='OUTPUT', help='write the restored database to OUTPUT')
+    parser.add_argument('--until', help='restore the state as of this time (YYYY-MM-DD HH:MM[:SS])')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for taken_at, name in reversed(list_backups()):
+            print(f"{taken_at}  {name}  {_megabytes(os.path.getsize(os.path.join(BACKUP_DIR, name)))}")
+            for increment_at, _, increment in list_increments(name):
+                print(f"  {increment_at}  {increment}  "
+                      f"{_megabytes(os.path.getsize(os.path.join(BACKUP_DIR, increment)))}")
+        return 0
+    try:
+        if args.full or args.incremental:
+            result = take_incremental() if args.incremental else take_backup(
+                f"pharmacy_{datetime.now().strftime(TIME_FORMAT)}.db.gz")
+            if result['file'] is None:
+                print(f"✅ Nothing changed since the last backup (change version {result['version']})")
+            else:
+                print(f"✅ {result['kind']} backup {result['file']}: {_megabytes(result['backup_bytes'])}")
+            return 0
+        if os.path.abspath(args.restore) == os.path.abspath(DB_PATH):
+            print("❌ Restore to another file, stop the server, then move it in place of pharmacy.db")
+            return 1
+        until = datetime.fromisoformat(args.until) if args.until else None
+        result = restore(args.restore, until)
+    except (BackupError, ValueError, OSError, sqlite3.Error) as e:
+        print(f"❌ {e}")
+        return 1
+    print(f"✅ Restored {result['base']} + {len(result['increments'])} increments to {args.restore} "
+          f"(change version {result['version']})")
+    if result['increments']:
+        print(f"   up to {result['increments'][-1]}")
+    if result['stock_summary_rebuilt']:
+        print("⚠️  stock_summary did not match inventory and was rebuilt")
+    print(f"   {result['images']} images, {result['images_restored']} copied back into {imagestore.STORE_DIR}")
+    if result['images_missing']:
+        print(f"⚠️  {len(result['images_missing'])} images are in neither the backups nor the image store")
+    print(f"   unpack {result['unpack_seconds']} s, replay {result['replay_seconds']} s, "
+          f"integrity check {result['check_seconds']} s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
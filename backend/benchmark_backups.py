@@ -0,0 +1,172 @@
+"""
+Incremental vs. full backups: size and time of each, and point-in-time restores.
+
+Seeds a scratch database the size of a busy pharmacy (lots, transfers, operation logs), takes
+a full backup, then simulates hours of work: lots changed and deleted, transfers added and
+confirmed, log rows written, a user's warehouses changed. After each hour it takes an
+increment and, for comparison, a full backup of the same state. Finally it restores the base
+plus the increments up to each hour and checks every table, change_log and stock_summary
+included, against the live database as it was at that hour.
+
+    python benchmark_backups.py --lots 60000 --transfers 40000 --logs 300000 --hours 3
+"""
+import argparse
+import hashlib
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+import backups
+import changelog
+import imagestore
+import stock_summary
+from models import Base
+
+WAREHOUSES = 5
+DRUGS = 138
+START = datetime(2026, 10, 17)
+
+def lot_expiry(n) -> str:
+    """The n-th expiry month from 2027-01; lots are unique per warehouse, drug and expiry"""
+    return f"{2027 + n // 12}-{1 + n % 12:02d}"
+
+def build(path, lots, transfers, logs, rng):
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    cursor = conn.cursor()
+    stock_summary.install(cursor)
+    changelog.install(cursor)
+    cursor.executemany("INSERT INTO warehouses (id, name, code) VALUES (?, ?, ?)",
+                       [(i, f'انبار {i}', f'W{i}') for i in range(1, WAREHOUSES + 1)])
+    cursor.executemany("INSERT INTO drugs (id, name, has_expiry_date) VALUES (?, ?, 1)",
+                       [(i, f'دارو {i}') for i in range(1, DRUGS + 1)])
+    cursor.execute("INSERT INTO suppliers (id, name) VALUES (1, 'پخش مرکزی')")
+    cursor.execute("INSERT INTO users (id, username, password, access_level) VALUES (1, 'admin', '-', 'superadmin')")
+    cursor.executemany(
+        "INSERT INTO inventory (warehouse_id, drug_id, supplier_id, expire_date, entry_date, quantity) "
+        "VALUES (?, ?, 1, ?, '1405/01/01', ?)",
+        ((1 + i % WAREHOUSES, 1 + i // WAREHOUSES % DRUGS, lot_expiry(i // (WAREHOUSES * DRUGS)), rng.randint(1, 500))
+         for i in range(lots))
+    )
+    cursor.executemany(
+        "INSERT INTO transfers (source_warehouse_id, destination_warehouse_id, drug_id, expire_date, transfer_date, "
+        "quantity_sent, quantity_received, status, created_at, created_by, item_type) "
+        "VALUES (1, 2, ?, '2027-01', '1405/01/01', 5, 5, 'confirmed', '2026-01-01 10:00:00', 'admin', 'drug')",
+        ((1 + i % DRUGS,) for i in range(transfers))
+    )
+    cursor.executemany(
+        "INSERT INTO operation_logs (user_id, action, details, timestamp) VALUES (1, 'Transfer', ?, '2026-01-01 10:00:00')",
+        ((f'انتقال دارو شماره {i} از انبار مرکزی به داروخانه با مقدار {i % 50}',) for i in range(logs))
+    )
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+def simulate_hour(conn, rng, lot_ids, hour, args):
+    """One hour of work; lot_ids is updated in place"""
+    stamp = (START + timedelta(hours=hour)).strftime('%Y-%m-%d %H:%M:%S')
+    conn.executemany("UPDATE inventory SET quantity = quantity - 1 WHERE id = ?",
+                     [(i,) for i in rng.sample(lot_ids, args.changed_lots)])
+    gone = set(rng.sample(lot_ids, args.deleted_lots))
+    lot_ids[:] = [i for i in lot_ids if i not in gone]
+    conn.executemany("DELETE FROM inventory WHERE id = ?", [(i,) for i in gone])
+    conn.executemany(
+        "INSERT INTO transfers (source_warehouse_id, destination_warehouse_id, drug_id, quantity_sent, status, "
+        "created_at, item_type) VALUES (1, 2, ?, 3, 'pending', ?, 'drug')",
+        [(1 + i % DRUGS, stamp) for i in range(args.new_transfers)]
+    )
+    conn.execute("UPDATE transfers SET status = 'confirmed', quantity_received = quantity_sent "
+                 "WHERE status = 'pending' AND id % 2 = 0")
+    conn.executemany("INSERT INTO operation_logs (user_id, action, details, timestamp) VALUES (1, 'Transfer', ?, ?)",
+                     [(f'log {hour} {i}', stamp) for i in range(args.new_logs)])
+    # user_warehouses has no id column; increments copy it whole
+    conn.execute("INSERT OR IGNORE INTO user_warehouses (user_id, warehouse_id) VALUES (1, ?)",
+                 (1 + hour % WAREHOUSES,))
+    conn.commit()
+
+def snapshot(path) -> dict:
+    """A digest of every table's rows"""
+    conn = sqlite3.connect(path)
+    try:
+        tables = [name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+        return {table: hashlib.sha256(repr(conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2").fetchall())
+                                      .encode('utf-8')).hexdigest() for table in tables}
+    finally:
+        conn.close()
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+def megabytes(size) -> str:
+    return f"{size / 1024 / 1024:.1f} MB" if size >= 1024 * 1024 else f"{size / 1024:.0f} KB"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lots', type=int, default=60000)
+    parser.add_argument('--transfers', type=int, default=40000)
+    parser.add_argument('--logs', type=int, default=300000, help='operation log rows')
+    parser.add_argument('--hours', type=int, default=3, help='simulated hours, one increment each')
+    parser.add_argument('--changed-lots', type=int, default=300, help='lots updated per hour')
+    parser.add_argument('--deleted-lots', type=int, default=20, help='lots deleted per hour')
+    parser.add_argument('--new-transfers', type=int, default=100, help='transfers added per hour')
+    parser.add_argument('--new-logs', type=int, default=300, help='log rows added per hour')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'pharmacy.db')
+        build(db_path, args.lots, args.transfers, args.logs, rng)
+        backups.DB_PATH = db_path
+        backups.BACKUP_DIR = os.path.join(tmp, 'db_backup')
+        imagestore.STORE_DIR = os.path.join(tmp, 'images')
+        print(f"database: {megabytes(os.path.getsize(db_path))}")
+
+        base, seconds = timed(backups.take_backup, START.strftime('pharmacy_%Y%m%d_%H%M%S.db.gz'))
+        print(f"full backup: {megabytes(base['backup_bytes'])} in {seconds:.2f} s")
+
+        conn = sqlite3.connect(db_path, timeout=30)
+        lot_ids = [row[0] for row in conn.execute("SELECT id FROM inventory")]
+        expected = {}
+        for hour in range(1, args.hours + 1):
+            simulate_hour(conn, rng, lot_ids, hour, args)
+            when = START + timedelta(hours=hour)
+            expected[when] = snapshot(db_path)
+            increment, inc_seconds = timed(backups.take_incremental, now=when)
+            # A full backup of the same state, kept apart so it does not start a new chain
+            chain_dir = backups.BACKUP_DIR
+            backups.BACKUP_DIR = os.path.join(tmp, 'full_copies')
+            try:
+                full, full_seconds = timed(backups.take_backup, when.strftime('pharmacy_%Y%m%d_%H%M%S.db.gz'))
+            finally:
+                backups.BACKUP_DIR = chain_dir
+            print(f"hour {hour}: increment {megabytes(increment['backup_bytes'])} in {inc_seconds:.2f} s "
+                  f"({increment['rows']} rows, {increment['deleted_rows']} deleted), "
+                  f"full {megabytes(full['backup_bytes'])} in {full_seconds:.2f} s")
+        conn.close()
+
+        failed = False
+        for when, tables in expected.items():
+            out = os.path.join(tmp, f"restored_{when.strftime('%H%M')}.db")
+            restored, seconds = timed(backups.restore, out, until=when + timedelta(minutes=30))
+            got = snapshot(out)
+            mismatched = sorted(table for table in set(got) | set(tables) if got.get(table) != tables.get(table))
+            failed = failed or bool(mismatched)
+            print(f"restore to {when:%H:%M} (base + {len(restored['increments'])}): {seconds:.2f} s, "
+                  + (f"MISMATCH in {', '.join(mismatched)}" if mismatched else "matches the live database"))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Login throughput vs. read latency, against a running server.
+
+Fires logins from several threads while one thread keeps reading a list endpoint, then reports
+logins per second and the latency of the reads. With bcrypt in the shared threadpool, the reads
+slowed down with the logins; with the password pool they should not.
+
+    python benchmark_login.py --url http://127.0.0.1:8000 --username admin --password admin
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+def login(base_url, username, password):
+    query = urllib.parse.urlencode({'username': username, 'password': password})
+    request = urllib.request.Request(f"{base_url}/api/login?{query}", method='POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())['token']
+
+def timed_get(url, token):
+    started = time.perf_counter()
+    request = urllib.request.Request(url, headers={'Authorization': f'Bearer {token}'})
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return (time.perf_counter() - started) * 1000
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def read_latencies(url, token, stop, seconds=None):
+    latencies = []
+    deadline = time.perf_counter() + seconds if seconds else None
+    while not stop.is_set() and (deadline is None or time.perf_counter() < deadline):
+        latencies.append(timed_get(url, token))
+    return latencies
+
+def summary(latencies):
+    return (f"{len(latencies)} reads, p50 {percentile(latencies, 0.5):.1f} ms, "
+            f"p95 {percentile(latencies, 0.95):.1f} ms, max {max(latencies, default=0):.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--logins', type=int, default=40, help='total logins')
+    parser.add_argument('--concurrency', type=int, default=20, help='login threads')
+    parser.add_argument('--read-path', default='/api/warehouses')
+    args = parser.parse_args()
+
+    token = login(args.url, args.username, args.password)
+    read_url = args.url + args.read_path
+    never = threading.Event()
+
+    baseline = read_latencies(read_url, token, never, seconds=3)
+    print(f"reads, idle:        {summary(baseline)}")
+
+    stop = threading.Event()
+    under_load = []
+    reader = threading.Thread(target=lambda: under_load.extend(read_latencies(read_url, token, stop)))
+    reader.start()
+
+    remaining = [args.logins]
+    lock = threading.Lock()
+
+    def login_worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            login(args.url, args.username, args.password)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=login_worker) for _ in range(args.concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    reader.join()
+
+    print(f"logins:             {args.logins} in {elapsed:.2f} s ({args.logins / elapsed:.1f}/s)")
+    print(f"reads, during load: {summary(under_load)}")
+
+if __name__ == '__main__':
+    main()
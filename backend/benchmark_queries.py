@@ -0,0 +1,80 @@
+"""
+Statements and time per call of the expiring-drugs and disposed-drugs endpoints.
+
+Seeds a scratch database with lots close to expiry, a share of them disposed through two
+confirmed disposal transfers each, then calls the endpoint functions directly and counts the
+SQL statements each one sends (BEGIN aside). Both lists used to issue a lookup per row.
+
+    python benchmark_queries.py --lots 60 --disposed 20 --repeat 50
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import api
+import database
+from models import Base, Drug, Inventory, Transfer, Warehouse
+
+def seed(db, lots, disposed):
+    expire = datetime.now().strftime('%Y-%m')
+    db.add_all([Warehouse(id=i, name=f'انبار {i}', code=f'W{i}') for i in (1, 2, 3)])
+    db.add_all([Drug(id=i, name=f'دارو {i}', has_expiry_date=True) for i in range(1, lots + 1)])
+    for i in range(1, lots + 1):
+        warehouse_id = i % 3 + 1
+        db.add(Inventory(warehouse_id=warehouse_id, drug_id=i, expire_date=expire, quantity=10,
+                         is_disposed=i <= disposed))
+        if i <= disposed:
+            for day in (1, 2):
+                db.add(Transfer(source_warehouse_id=warehouse_id, drug_id=i, expire_date=expire,
+                                transfer_type='disposal', status='confirmed', quantity_sent=5,
+                                created_at=f'2026-01-0{day} 10:00:00', confirmed_at=f'2026-01-0{day} 12:00:00'))
+    db.commit()
+
+def measure(engine, db, endpoint, repeat):
+    statements = []
+
+    def listener(conn, cursor, statement, *args):
+        if not statement.startswith('BEGIN'):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        endpoint(db)
+        per_call = len(statements)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            result = endpoint(db)
+        elapsed = time.perf_counter() - started
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    return per_call, elapsed * 1000 / repeat, len(result)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lots', type=int, default=60)
+    parser.add_argument('--disposed', type=int, default=20, help='lots marked disposed')
+    parser.add_argument('--repeat', type=int, default=50, help='timed calls per endpoint')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'pharmacy.db')}")
+        event.listen(engine, 'connect', database.set_sqlite_pragmas)
+        event.listen(engine, 'begin', database.begin_sqlite_transaction)
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+        try:
+            seed(db, args.lots, args.disposed)
+            for label, endpoint in (('expiring-drugs', api.expiring_drugs), ('disposed-drugs', api.disposed_drugs)):
+                statements, ms, rows = measure(engine, db, endpoint, args.repeat)
+                print(f"{label + ':':<16} {rows} rows, {statements} statements, {ms:.2f} ms/call")
+        finally:
+            db.close()
+            engine.dispose()
+
+if __name__ == '__main__':
+    main()
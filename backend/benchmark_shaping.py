@@ -0,0 +1,60 @@
+"""
+Persian text shaping cost per report row: per-cell reshape + bidi vs. persian_text.
+
+Builds (drug name, quantity) rows from a pool of repeating names, the way inventory reports
+look, and shapes both columns three ways: calling arabic_reshaper and bidi for every cell,
+shape_column with an empty cache, and shape with a warm cache. The outputs must match.
+
+    python benchmark_shaping.py --rows 50000 --names 800
+"""
+import argparse
+import random
+import time
+
+import arabic_reshaper
+from bidi.algorithm import get_display
+
+import persian_text
+
+WORDS = ['آموکسی‌سیلین', 'استامینوفن', 'ایبوپروفن', 'سرم', 'قرص', 'کپسول', 'شربت', 'آمپول', 'پماد', 'قطره']
+
+def make_rows(count, names, seed):
+    rng = random.Random(seed)
+    pool = [f"{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.randint(5, 1000)}" for _ in range(names)]
+    return [(rng.choice(pool), str(rng.randint(1, 500))) for _ in range(count)]
+
+def per_row(rows):
+    return [(get_display(arabic_reshaper.reshape(name)), get_display(arabic_reshaper.reshape(quantity)))
+            for name, quantity in rows]
+
+def by_column(rows):
+    names = persian_text.shape_column(name for name, _ in rows)
+    quantities = persian_text.shape_column(quantity for _, quantity in rows)
+    return list(zip(names, quantities))
+
+def cached(rows):
+    return [(persian_text.shape(name), persian_text.shape(quantity)) for name, quantity in rows]
+
+def timed(label, func, rows):
+    started = time.perf_counter()
+    result = func(rows)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed * 1e6 / len(rows):8.2f} us/row ({elapsed:.2f} s)")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--names', type=int, default=800, help='distinct drug names')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows, args.names, args.seed)
+    expected = timed("per-row reshape + bidi:", per_row, rows)
+    persian_text._shape.cache_clear()
+    assert timed("shape_column, cold cache:", by_column, rows) == expected
+    assert timed("shape, warm cache:", cached, rows) == expected
+    print(f"cache: {persian_text.cache_info()}")
+
+if __name__ == '__main__':
+    main()
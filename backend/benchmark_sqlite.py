@@ -0,0 +1,96 @@
+"""
+Read latency under a concurrent writer, SQLite defaults vs. the engine's connect pragmas.
+
+Builds a scratch database, then runs one writer holding short transactions and several
+readers scanning the lots table for a fixed time, once with SQLite's defaults (rollback
+journal) and once with database.set_sqlite_pragmas (WAL, synchronous=NORMAL, ...).
+Reports reads and writes completed and the read latency.
+
+    python benchmark_sqlite.py --rows 20000 --readers 4 --hold-ms 10 --seconds 3
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import database
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def build(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE inventory (id INTEGER PRIMARY KEY, warehouse_id INTEGER, drug_id INTEGER, quantity INTEGER)")
+    conn.executemany(
+        "INSERT INTO inventory (warehouse_id, drug_id, quantity) VALUES (?, ?, ?)",
+        ((i % 20, i % 800, i % 97) for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+def connect(path, tuned):
+    conn = sqlite3.connect(path, timeout=database.DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    if tuned:
+        database.set_sqlite_pragmas(conn, None)
+    else:
+        conn.execute("PRAGMA journal_mode=DELETE")
+    conn.isolation_level = None
+    return conn
+
+def run(path, tuned, readers, hold_ms, seconds):
+    stop = threading.Event()
+    latencies = []
+    writes = [0]
+    lock = threading.Lock()
+
+    def reader():
+        conn = connect(path, tuned)
+        local = []
+        while not stop.is_set():
+            started = time.perf_counter()
+            conn.execute("SELECT warehouse_id, SUM(quantity) FROM inventory GROUP BY warehouse_id").fetchall()
+            local.append((time.perf_counter() - started) * 1000)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    def writer():
+        conn = connect(path, tuned)
+        while not stop.is_set():
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE inventory SET quantity = quantity + 1 WHERE id = ?", (writes[0] % 1000 + 1,))
+            time.sleep(hold_ms / 1000)
+            conn.execute("COMMIT")
+            writes[0] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, writes[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--hold-ms', type=float, default=10, help='how long each write transaction stays open')
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, tuned in (('default', False), ('tuned', True)):
+            path = os.path.join(tmp, f'{label}.db')
+            build(path, args.rows)
+            latencies, writes = run(path, tuned, args.readers, args.hold_ms, args.seconds)
+            print(f"{label + ':':<9} {len(latencies)} reads, {writes} writes, "
+                  f"read p50 {percentile(latencies, 0.5):.1f} ms, p99 {percentile(latencies, 0.99):.1f} ms")
+
+if __name__ == '__main__':
+    main()
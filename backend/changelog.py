@@ -0,0 +1,151 @@
+"""
+Row-level change log for incremental sync (/api/sync) and incremental backups (backups.py).
+
+SQLite triggers on the logged tables record, inside the transaction that makes the change,
+the latest change version of every row that was inserted, updated or deleted. Each write
+bumps a single counter, so versions increase monotonically across all tables. The log keeps
+one entry per row (the newest), so it grows with the number of rows, not the number of writes:
+
+    change_log(table_name, row_id, created_version, version, deleted)
+
+A client that last synced at version S gets, per table, the rows whose version is above S:
+deleted entries as ids, the rest as full rows, split into inserted (created after S) and updated.
+Rows that existed before the log was installed have no entries; clients start with since=0,
+which returns a full snapshot.
+
+Sync only reads SYNC_TABLES; the other id-keyed tables are logged too, so that an incremental
+backup can pick up every row changed since the previous backup.
+"""
+SYNC_TABLES = ('inventory', 'transfers', 'drugs', 'warehouses', 'tool_inventory')
+LOGGED_TABLES = SYNC_TABLES + ('operation_logs', 'users', 'permissions', 'suppliers', 'consumers',
+                               'tools', 'system_settings')
+
+# Never shipped through sync: base64 copies of the images, served by /drug-image
+EXCLUDED_COLUMNS = {'drugs': {'image_data'}}
+
+SYNC_BATCH_SIZE = 500
+
+CREATE_LOG_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS change_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    """,
+    "INSERT OR IGNORE INTO change_version (id, version) VALUES (1, 0)",
+    """
+    CREATE TABLE IF NOT EXISTS change_log (
+        table_name TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        created_version INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (table_name, row_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_change_log_version ON change_log (version)",
+]
+
+def _trigger_sql(table, op):
+    row = 'OLD' if op == 'DELETE' else 'NEW'
+    if op == 'INSERT':
+        upsert = f"""
+            INSERT INTO change_log (table_name, row_id, created_version, version, deleted)
+            SELECT '{table}', NEW.id, version, version, 0 FROM change_version WHERE id = 1
+            ON CONFLICT (table_name, row_id) DO UPDATE SET
+                created_version = excluded.version, version = excluded.version, deleted = 0;"""
+    else:
+        deleted = 1 if op == 'DELETE' else 0
+        upsert = f"""
+            INSERT INTO change_log (table_name, row_id, created_version, version, deleted)
+            SELECT '{table}', {row}.id, version, version, {deleted} FROM change_version WHERE id = 1
+            ON CONFLICT (table_name, row_id) DO UPDATE SET
+                version = excluded.version, deleted = {deleted};"""
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS trg_change_log_{table}_{op.lower()}
+        AFTER {op} ON {table}
+        BEGIN
+            UPDATE change_version SET version = version + 1 WHERE id = 1;{upsert}
+        END
+    """
+
+LOG_TRIGGERS = {
+    f"trg_change_log_{table}_{op.lower()}": _trigger_sql(table, op)
+    for table in LOGGED_TABLES for op in ('INSERT', 'UPDATE', 'DELETE')
+}
+
+def install(cursor):
+    """Create the change log tables and triggers (idempotent)"""
+    for sql in CREATE_LOG_TABLES:
+        cursor.execute(sql)
+    for sql in LOG_TRIGGERS.values():
+        cursor.execute(sql)
+
+def install_on_engine(engine):
+    # engine.begin() so the install runs in one transaction (the engine's connections autocommit)
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        install(cursor)
+        cursor.close()
+
+def current_version(cursor) -> int:
+    return cursor.execute("SELECT version FROM change_version WHERE id = 1").fetchone()[0]
+
+def _columns(cursor, table):
+    excluded = EXCLUDED_COLUMNS.get(table, set())
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall() if row[1] not in excluded]
+
+def _fetch_rows(cursor, table, columns, ids=None):
+    """Rows as dicts; all rows when ids is None, otherwise the given ids in batches"""
+    select = f"SELECT {', '.join(columns)} FROM {table}"
+    if ids is None:
+        return [dict(zip(columns, row)) for row in cursor.execute(f"{select} ORDER BY id").fetchall()]
+    rows = []
+    ids = list(ids)
+    for start in range(0, len(ids), SYNC_BATCH_SIZE):
+        batch = ids[start:start + SYNC_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch))
+        rows.extend(dict(zip(columns, row)) for row in cursor.execute(
+            f"{select} WHERE id IN ({placeholders}) ORDER BY id", batch).fetchall())
+    return rows
+
+def changes_since(cursor, since: int, tables=SYNC_TABLES) -> dict:
+    """
+    Changes after version `since`, as {'version', 'full', 'tables': {table: {inserted, updated, deleted}}}.
+    since <= 0, or a version this database never reached (e.g. after a restore), returns every row
+    as inserted with full=True: the client should replace its replica.
+    """
+    # A single read transaction, as in backups.read_changes: the version, the log and the rows
+    # all belong to the same commit. A transaction the caller already began is used as is.
+    owns_transaction = not cursor.connection.in_transaction
+    if owns_transaction:
+        cursor.execute("BEGIN")
+    try:
+        return _read_changes(cursor, since, tables)
+    finally:
+        if owns_transaction:
+            cursor.execute("COMMIT")
+
+def _read_changes(cursor, since, tables):
+    version = current_version(cursor)
+    full = since <= 0 or since > version
+    result = {'version': version, 'full': full, 'tables': {}}
+    for table in tables:
+        columns = _columns(cursor, table)
+        if full:
+            result['tables'][table] = {'inserted': _fetch_rows(cursor, table, columns), 'updated': [], 'deleted': []}
+            continue
+        entries = cursor.execute(
+            "SELECT row_id, created_version, deleted FROM change_log WHERE table_name = ? AND version > ?",
+            (table, since)
+        ).fetchall()
+        deleted = [row_id for row_id, created, is_deleted in entries if is_deleted and created <= since]
+        inserted_ids = {row_id for row_id, created, is_deleted in entries if not is_deleted and created > since}
+        live_ids = [row_id for row_id, _, is_deleted in entries if not is_deleted]
+        rows = _fetch_rows(cursor, table, columns, live_ids)
+        result['tables'][table] = {
+            'inserted': [row for row in rows if row['id'] in inserted_ids],
+            'updated': [row for row in rows if row['id'] not in inserted_ids],
+            'deleted': sorted(deleted)
+        }
+    return result
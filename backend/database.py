@@ -1,6 +1,8 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from models import Base
+import stock_summary
+import changelog
 import os
 
 # Use absolute path to database in project root
@@ -8,11 +10,63 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DB_PATH = os.path.join(BASE_DIR, 'pharmacy.db')
 SQLITE_URL = f'sqlite:///{DB_PATH}'
 
-engine = create_engine(SQLITE_URL, connect_args={"check_same_thread": False})
+# Connection pool and SQLite tuning (override with environment variables if needed)
+DB_POOL_SIZE = int(os.environ.get('PHARMACY_DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('PHARMACY_DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('PHARMACY_DB_POOL_TIMEOUT', 30))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('PHARMACY_DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get('PHARMACY_DB_CACHE_SIZE_KB', 20000))
+DB_MMAP_SIZE = int(os.environ.get('PHARMACY_DB_MMAP_SIZE', 256 * 1024 * 1024))
+
+# Execution option naming the BEGIN mode of a session's transaction (see begin_sqlite_transaction)
+SQLITE_BEGIN_OPTION = 'sqlite_begin'
+SQLITE_BEGIN_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+engine = create_engine(
+    SQLITE_URL,
+    connect_args={"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT_MS / 1000},
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_pre_ping=True
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL lets report reads run while a transfer is committing;
+    synchronous=NORMAL is durable in WAL mode and avoids an fsync per commit
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+    # SQLAlchemy emits BEGIN itself (begin_sqlite_transaction); pysqlite's own, which only
+    # begins at the first INSERT/UPDATE, is turned off
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(engine, "begin")
+def begin_sqlite_transaction(conn):
+    """
+    BEGIN DEFERRED by default. A session that reads rows and then writes based on them asks for
+    BEGIN IMMEDIATE, taking the write lock up front:
+        db.connection(execution_options={SQLITE_BEGIN_OPTION: 'IMMEDIATE'})
+    """
+    mode = conn.get_execution_options().get(SQLITE_BEGIN_OPTION, 'DEFERRED')
+    if mode not in SQLITE_BEGIN_MODES:
+        raise ValueError(f"unknown SQLite BEGIN mode: {mode}")
+    conn.exec_driver_sql(f"BEGIN {mode}")
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    stock_summary.install_on_engine(engine)
+    changelog.install_on_engine(engine)
 
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,184 @@
+"""
+Change feed for transfers and inventory lots, published to Server-Sent Events subscribers.
+
+Changes are picked up from the ORM flush (new, changed and deleted Transfer / Inventory /
+ToolInventory rows), staged on the session and published only when it commits, so clients
+never see a change that was rolled back. Writes that bypass the ORM (bulk upserts) call
+record() themselves.
+
+The broker runs on the server's event loop: every subscriber is an asyncio.Queue, so idle
+connections cost no thread. Publishing is thread-safe and never blocks the request that
+committed. Each event is encoded once and the same frame is shared by every subscriber.
+A subscriber that falls too far behind, or reconnects after its Last-Event-ID has left
+the replay buffer, receives a 'resync' event and should reload its lists.
+
+Event ids are "<epoch>-<sequence>". The epoch is new in every server process, so a client
+that reconnects after a restart, whose id belongs to a sequence that no longer exists, gets
+a resync instead of waiting for the new sequence to catch up with its old id.
+"""
+from collections import deque
+from itertools import chain
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import Transfer, Inventory, ToolInventory
+
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('PHARMACY_EVENTS_QUEUE_SIZE', 1000))
+REPLAY_BUFFER_SIZE = int(os.environ.get('PHARMACY_EVENTS_REPLAY_SIZE', 2000))
+KEEPALIVE_SECONDS = 20
+
+_STAGED_EVENTS = 'events_staged'
+
+TRANSFER_FIELDS = ('id', 'status', 'transfer_type', 'item_type', 'source_warehouse_id', 'destination_warehouse_id',
+                   'consumer_id', 'drug_id', 'tool_id', 'expire_date', 'quantity_sent',
+                   'quantity_received', 'created_at', 'confirmed_at')
+LOT_FIELDS = {
+    'inventory': ('id', 'warehouse_id', 'drug_id', 'expire_date', 'quantity', 'is_disposed'),
+    'tool_inventory': ('id', 'warehouse_id', 'tool_id', 'quantity', 'is_disposed'),
+}
+
+# New transfer status -> event type
+TRANSFER_STATUS_EVENTS = {
+    'confirmed': 'transfer.confirmed',
+    'mismatch': 'transfer.confirmed',
+    'rejected': 'transfer.rejected',
+    'resolved': 'transfer.resolved',
+}
+
+class Broker:
+    def __init__(self):
+        self._loop = None
+        self._subscribers = set()
+        self._buffer = deque(maxlen=REPLAY_BUFFER_SIZE)
+        self._seq = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+
+    def publish(self, events):
+        """Queue events for every subscriber; safe to call from any thread"""
+        with self._lock:
+            loop = self._loop
+        if loop is None or loop.is_closed() or not events:
+            return
+        loop.call_soon_threadsafe(self._fan_out, events)
+
+    def _fan_out(self, events):
+        # Runs on the event loop thread only, so the sequence and buffer need no lock
+        for payload in events:
+            self._seq += 1
+            frame = f"id: {self.event_id()}\ndata: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+            self._buffer.append((self._seq, frame))
+            for queue in list(self._subscribers):
+                try:
+                    queue.put_nowait(frame)
+                except asyncio.QueueFull:
+                    _drain(queue)
+                    queue.put_nowait(resync_frame(self.event_id()))
+
+    def event_id(self, seq=None) -> str:
+        return f"{self.epoch}-{self._seq if seq is None else seq}"
+
+    def _last_seq(self, last_event_id):
+        """Sequence number of a Last-Event-ID from this process, or None"""
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+            return None
+        return int(seq)
+
+    def subscribe(self, last_event_id: str = None) -> asyncio.Queue:
+        """Register a subscriber; must be called on the event loop"""
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        if last_event_id:
+            last_seq = self._last_seq(last_event_id)
+            missed = [frame for seq, frame in self._buffer if last_seq is not None and seq > last_seq]
+            oldest = self._buffer[0][0] if self._buffer else self._seq + 1
+            if last_seq is None or last_seq + 1 < oldest or len(missed) >= SUBSCRIBER_QUEUE_SIZE:
+                queue.put_nowait(resync_frame(self.event_id()))
+            else:
+                for frame in missed:
+                    queue.put_nowait(frame)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def stats(self) -> dict:
+        return {'subscribers': len(self._subscribers), 'last_event_id': self.event_id()}
+
+broker = Broker()
+
+def _drain(queue):
+    while not queue.empty():
+        queue.get_nowait()
+
+def resync_frame(event_id) -> str:
+    """Carries the current id, so the client's next reconnect resumes from here"""
+    return f"id: {event_id}\ndata: {json.dumps({'type': 'resync', 'at': time.time()})}\n\n"
+
+async def stream(queue):
+    """SSE frames for one subscriber, with a comment line as keep-alive"""
+    try:
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        broker.unsubscribe(queue)
+
+# ---------- Collecting changes from the session ----------
+
+def record(session: Session, event_type: str, **payload):
+    """Stage an event on the session; it is published when the session commits"""
+    key = (event_type, payload.get('id'))
+    session.info.setdefault(_STAGED_EVENTS, {})[key] = dict(payload, type=event_type)
+
+def _snapshot(obj, fields) -> dict:
+    return {field: getattr(obj, field, None) for field in fields}
+
+def _changed(obj, *fields) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[field].history.has_changes() for field in fields)
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, flush_context):
+    # Runs while new/dirty/deleted and attribute history still describe this flush
+    for obj in chain(session.new, session.dirty, session.deleted):
+        deleted = obj in session.deleted
+        created = obj in session.new
+        if isinstance(obj, Transfer):
+            if deleted:
+                record(session, 'transfer.deleted', id=obj.id)
+            elif created:
+                record(session, 'transfer.created', **_snapshot(obj, TRANSFER_FIELDS))
+            elif _changed(obj, 'status'):
+                record(session, TRANSFER_STATUS_EVENTS.get(obj.status, 'transfer.updated'),
+                       **_snapshot(obj, TRANSFER_FIELDS))
+            elif session.is_modified(obj):
+                record(session, 'transfer.updated', **_snapshot(obj, TRANSFER_FIELDS))
+        elif isinstance(obj, (Inventory, ToolInventory)):
+            kind = 'inventory' if isinstance(obj, Inventory) else 'tool_inventory'
+            if deleted:
+                record(session, f'{kind}.lot_deleted', **_snapshot(obj, LOT_FIELDS[kind]))
+            elif created or _changed(obj, 'quantity', 'is_disposed', 'warehouse_id'):
+                record(session, f'{kind}.lot', **_snapshot(obj, LOT_FIELDS[kind]))
+
+@event.listens_for(Session, 'after_commit')
+def _publish_on_commit(session):
+    staged = session.info.pop(_STAGED_EVENTS, None)
+    if staged:
+        broker.publish(list(staged.values()))
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_on_rollback(session):
+    session.info.pop(_STAGED_EVENTS, None)
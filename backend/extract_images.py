@@ -0,0 +1,189 @@
+"""
+Moves the base64 image copies (drugs.image_data, tools.image_data) into the image store and
+compacts pharmacy.db.
+
+Rows are read in batches of BATCH_SIZE, so only one batch of blobs is in memory. For each
+row the image is written to the store (imagestore.py) and the entry's checksums are verified.
+Only then are image_hash/image set and image_data cleared; each batch is committed. Store
+entries are content-addressed, so an interrupted run simply picks up the rows whose image_data
+is still set. Rows whose data is not a readable image are left untouched and reported.
+
+When anything was cleared, or the file has a lot of free pages left by an interrupted run,
+the database is VACUUMed. The report gives the bytes reclaimed and the time of the catalog
+query behind GET /api/drugs before and after.
+
+Runs at the end of migrate_db.py (the server is not running yet). Command line:
+    python extract_images.py
+"""
+import base64
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import time
+
+import imagestore
+
+TABLES = ('drugs', 'tools')
+BATCH_SIZE = 50
+
+# VACUUM without new extractions once this share of the file is free pages
+FREE_PAGE_RATIO = 0.1
+
+# The lean projection of GET /api/drugs
+CATALOG_QUERY = ("SELECT id, name, dose, package_type, image, image_hash, description, has_expiry_date "
+                 "FROM drugs ORDER BY id")
+
+def pending_count(cursor, table) -> int:
+    return cursor.execute(
+        f"SELECT COUNT(*) FROM {table} WHERE image_data IS NOT NULL AND image_data != ''").fetchone()[0]
+
+def database_size(db_path) -> int:
+    return sum(os.path.getsize(path) for path in (db_path, f"{db_path}-wal") if os.path.exists(path))
+
+def time_catalog_query(db_path, repeats=5) -> float:
+    """Median milliseconds of the catalog query, each run on a fresh connection (cold page cache)"""
+    timings = []
+    for _ in range(repeats):
+        conn = sqlite3.connect(db_path)
+        try:
+            started = time.perf_counter()
+            conn.execute(CATALOG_QUERY).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            conn.close()
+    return statistics.median(timings)
+
+def _store(data: bytes) -> str:
+    """Put image bytes in the store and verify the entry; a damaged existing entry is rewritten once"""
+    digest = imagestore.put(data)
+    if not imagestore.verify(digest):
+        shutil.rmtree(imagestore.entry_dir(digest), ignore_errors=True)
+        digest = imagestore.put(data)
+        if not imagestore.verify(digest):
+            raise ValueError(f"checksum mismatch in image store entry {digest}")
+    return digest
+
+def _remove_legacy_file(path):
+    """images/drug_X.jpg style copies; paths inside the store are left alone"""
+    if not path:
+        return 0
+    full_path = os.path.abspath(os.path.join(imagestore.BASE_DIR, path))
+    if full_path.startswith(os.path.abspath(imagestore.STORE_DIR) + os.sep) or not os.path.isfile(full_path):
+        return 0
+    size = os.path.getsize(full_path)
+    os.remove(full_path)
+    return size
+
+def extract_table(conn, table, batch_size=BATCH_SIZE) -> dict:
+    cursor = conn.cursor()
+    result = {'extracted': 0, 'reused': 0, 'failed': [], 'base64_bytes': 0, 'legacy_file_bytes': 0}
+    last_id = 0
+    while True:
+        rows = cursor.execute(
+            f"SELECT id, image_data, image_hash, image FROM {table} "
+            f"WHERE image_data IS NOT NULL AND image_data != '' AND id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        for row_id, image_data, image_hash, image in rows:
+            last_id = row_id
+            try:
+                if image_hash and imagestore.verify(image_hash):
+                    # Already in the store; only the base64 copy is left
+                    digest = image_hash
+                    result['reused'] += 1
+                else:
+                    payload = image_data.split(',', 1)[1] if ',' in image_data else image_data
+                    digest = _store(base64.b64decode(payload))
+                    result['extracted'] += 1
+            except Exception as e:
+                result['failed'].append((row_id, str(e)))
+                continue
+            cursor.execute(
+                f"UPDATE {table} SET image_hash = ?, image = ?, image_data = NULL WHERE id = ?",
+                (digest, imagestore.relative_path(digest), row_id)
+            )
+            result['base64_bytes'] += len(image_data)
+            try:
+                result['legacy_file_bytes'] += _remove_legacy_file(image)
+            except OSError as e:
+                print(f"⚠️  Could not delete {image}: {e}")
+        conn.commit()
+    return result
+
+def compact(conn):
+    """VACUUM, then fold the WAL back into the file so the space is returned to the disk"""
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def free_page_ratio(cursor) -> float:
+    page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    return free_pages / page_count if page_count else 0.0
+
+def run(conn, db_path) -> dict:
+    """Extract every pending image, then compact if worthwhile; prints a report"""
+    cursor = conn.cursor()
+    pending = {table: pending_count(cursor, table) for table in TABLES}
+    if not any(pending.values()) and free_page_ratio(cursor) < FREE_PAGE_RATIO:
+        print("✅ No base64 images left in the database")
+        return {}
+
+    print(f"Extracting base64 images into {imagestore.STORE_DIR}: "
+          + ", ".join(f"{table} {count}" for table, count in pending.items()))
+    size_before = database_size(db_path)
+    query_before = time_catalog_query(db_path)
+
+    started = time.perf_counter()
+    results = {table: extract_table(conn, table) for table in TABLES}
+    for table, result in results.items():
+        print(f"✅ {table}: {result['extracted']} extracted, {result['reused']} already in the store, "
+              f"{result['base64_bytes'] / 1024 / 1024:.1f} MB of base64 cleared")
+        for row_id, error in result['failed'][:20]:
+            print(f"⚠️  {table} {row_id} left as is: {error}")
+    extract_seconds = time.perf_counter() - started
+
+    # Rows that keep failing must not cost a VACUUM on every start
+    cleared = sum(result['extracted'] + result['reused'] for result in results.values())
+    vacuum_seconds = 0
+    if cleared or free_page_ratio(cursor) >= FREE_PAGE_RATIO:
+        started = time.perf_counter()
+        compact(conn)
+        vacuum_seconds = time.perf_counter() - started
+    size_after = database_size(db_path)
+    reclaimed = size_before - size_after
+    query_after = time_catalog_query(db_path)
+
+    legacy_bytes = sum(result['legacy_file_bytes'] for result in results.values())
+    print(f"✅ Database {size_before / 1024 / 1024:.1f} MB -> {size_after / 1024 / 1024:.1f} MB "
+          f"({reclaimed / 1024 / 1024:.1f} MB reclaimed; extraction {extract_seconds:.1f} s, VACUUM {vacuum_seconds:.1f} s)")
+    if legacy_bytes:
+        print(f"✅ Removed {legacy_bytes / 1024 / 1024:.1f} MB of old per-item image files")
+    print(f"✅ GET /api/drugs catalog query: {query_before:.1f} ms -> {query_after:.1f} ms")
+    return {
+        'tables': results,
+        'bytes_reclaimed': reclaimed,
+        'legacy_file_bytes': legacy_bytes,
+        'catalog_query_ms': (query_before, query_after)
+    }
+
+def main(argv):
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(base_dir, 'pharmacy.db')
+    conn = sqlite3.connect(db_path)
+    try:
+        report = run(conn, db_path)
+        failed = sum(len(result['failed']) for result in report.get('tables', {}).values())
+        return 1 if failed else 0
+    except sqlite3.OperationalError as e:
+        print(f"❌ Image extraction failed (run migrate_db.py first?): {e}")
+        return 1
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,239 @@
+"""
+Content-addressed store for drug and tool images.
+
+An image is stored once, under the SHA-256 of its uploaded bytes, however many drugs and tools
+use it. Each entry holds precomputed renditions (64px for list grids, 200px previews, 800px for
+the full view), encoded as WebP when this Pillow build supports it and as JPEG otherwise, and a
+meta.json with the checksum of every rendition:
+
+    images/store/ab/abcdef.../64.webp, 200.webp, 800.webp, meta.json
+
+Renditions are written under temporary names and renamed into place; meta.json is written last,
+so an entry exists only once it is complete. Entries never change afterwards, which is what lets
+/api/images/{digest} be served with an immutable Cache-Control.
+
+Drugs and tools point at an entry through their image_hash column; release() deletes an entry
+once nothing points at it any more. An upload holds pinned(digest) from before its put() until
+its reference is committed, and release() skips pinned entries and deletes under the same lock,
+so an upload of an image being released never ends up pointing at deleted files.
+
+Uploads are decoded and encoded in a small process pool (submit()), never on an API thread.
+JPEGs are decoded with Pillow's draft mode, which lets libjpeg scale down by 1/2 to 1/8 while
+decoding, so a 12 MP phone photo is never fully decoded. At most IMAGE_QUEUE_LIMIT uploads
+wait for or occupy a worker; beyond that submit() raises PoolBusy instead of queueing.
+"""
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import uuid
+
+from PIL import Image, ImageOps, features
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STORE_DIR = os.environ.get('PHARMACY_IMAGE_STORE', os.path.join(BASE_DIR, 'images', 'store'))
+
+RENDITION_SIZES = (64, 200, 800)
+FULL_SIZE = RENDITION_SIZES[-1]
+WEBP_QUALITY = 80
+JPEG_QUALITY = 75
+
+if features.check('webp'):
+    FORMAT, EXTENSION = 'WEBP', 'webp'
+else:
+    FORMAT, EXTENSION = 'JPEG', 'jpg'
+
+MEDIA_TYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+
+MAX_UPLOAD_BYTES = int(os.environ.get('PHARMACY_MAX_IMAGE_UPLOAD_MB', 10)) * 1024 * 1024
+MAX_IMAGE_PIXELS = int(os.environ.get('PHARMACY_MAX_IMAGE_PIXELS', 50_000_000))
+IMAGE_WORKERS = int(os.environ.get('PHARMACY_IMAGE_WORKERS', 2))
+IMAGE_QUEUE_LIMIT = int(os.environ.get('PHARMACY_IMAGE_QUEUE_LIMIT', 8))
+
+class PoolBusy(Exception):
+    """IMAGE_QUEUE_LIMIT uploads are already being processed"""
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(IMAGE_QUEUE_LIMIT)
+_pins = Counter()
+_pins_lock = threading.Lock()
+
+_DIGEST_RE = re.compile(r'[0-9a-f]{64}')
+
+def digest_of(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def is_digest(value) -> bool:
+    return isinstance(value, str) and _DIGEST_RE.fullmatch(value) is not None
+
+def entry_dir(digest: str, store_dir: str = None) -> str:
+    return os.path.join(store_dir or STORE_DIR, digest[:2], digest)
+
+def exists(digest: str, store_dir: str = None) -> bool:
+    return os.path.exists(os.path.join(entry_dir(digest, store_dir), 'meta.json'))
+
+# ---------- Encoding ----------
+
+def _flatten(img):
+    """RGB with transparent areas on white, the way uploads have always been stored"""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        return background
+    return img.convert('RGB')
+
+def _encode(img) -> bytes:
+    buffered = BytesIO()
+    if FORMAT == 'WEBP':
+        img.save(buffered, format='WEBP', quality=WEBP_QUALITY, method=4)
+    else:
+        img.save(buffered, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return buffered.getvalue()
+
+def render(img) -> dict:
+    """
+    Encoded renditions of a decoded image, as {size: bytes}.
+    Each size is scaled down from the next larger one, never up.
+    """
+    img = _flatten(ImageOps.exif_transpose(img))
+    renditions = {}
+    for size in sorted(RENDITION_SIZES, reverse=True):
+        if img.width > size or img.height > size:
+            img = img.copy()
+            img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        renditions[size] = _encode(img)
+    return renditions
+
+def open_image(data: bytes):
+    """Open image bytes; JPEGs are set to decode at the smallest scale that still covers FULL_SIZE"""
+    img = Image.open(BytesIO(data))
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        img.close()
+        raise ValueError(f"image has more than {MAX_IMAGE_PIXELS} pixels")
+    scale = FULL_SIZE / max(img.size)
+    if img.format == 'JPEG' and scale < 1:
+        img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+    return img
+
+def render_bytes(data: bytes) -> dict:
+    with open_image(data) as img:
+        return render(img)
+
+# ---------- Writing and reading entries ----------
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def save(digest: str, renditions: dict, source_bytes: int):
+    """Write an entry from rendered bytes; a no-op when the entry already exists"""
+    if exists(digest):
+        return
+    directory = entry_dir(digest)
+    os.makedirs(directory, exist_ok=True)
+    meta = {'format': EXTENSION, 'source_bytes': source_bytes, 'renditions': {}}
+    for size, data in renditions.items():
+        _write_atomic(os.path.join(directory, f"{size}.{EXTENSION}"), data)
+        meta['renditions'][str(size)] = {'bytes': len(data), 'sha256': digest_of(data)}
+    _write_atomic(os.path.join(directory, 'meta.json'), json.dumps(meta).encode('utf-8'))
+
+def put(data: bytes) -> str:
+    """Store an image (raises PIL/OSError errors for data that is not an image); returns its digest"""
+    digest = digest_of(data)
+    if not exists(digest):
+        save(digest, render_bytes(data), len(data))
+    return digest
+
+def rendition(digest: str, size: int):
+    """(path, media type) of a stored rendition, or None"""
+    if not is_digest(digest) or not exists(digest):
+        return None
+    for extension in (EXTENSION, *(e for e in MEDIA_TYPES if e != EXTENSION)):
+        path = os.path.join(entry_dir(digest), f"{size}.{extension}")
+        if os.path.exists(path):
+            return path, MEDIA_TYPES[extension]
+    return None
+
+def relative_path(digest: str, size: int = FULL_SIZE) -> str:
+    """Path stored in Drug.image / Tool.image, relative to the backend directory like the old images/drug_X.jpg"""
+    found = rendition(digest, size)
+    path = found[0] if found else os.path.join(entry_dir(digest), f"{size}.{EXTENSION}")
+    return os.path.relpath(path, BASE_DIR).replace(os.sep, '/')
+
+def verify(digest: str, store_dir: str = None) -> bool:
+    """True when the entry is complete and every rendition matches its recorded checksum"""
+    directory = entry_dir(digest, store_dir)
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'rb') as f:
+            meta = json.load(f)
+        for size, info in meta['renditions'].items():
+            with open(os.path.join(directory, f"{size}.{meta['format']}"), 'rb') as f:
+                if digest_of(f.read()) != info['sha256']:
+                    return False
+        return True
+    except (OSError, ValueError, KeyError):
+        return False
+
+@contextmanager
+def pinned(digest: str):
+    """Keep release() off an entry while an upload stores it and commits a reference to it"""
+    with _pins_lock:
+        _pins[digest] += 1
+    try:
+        yield digest
+    finally:
+        with _pins_lock:
+            _pins[digest] -= 1
+            if not _pins[digest]:
+                del _pins[digest]
+
+def release(db, digest):
+    """Delete an entry no drug or tool uses; call after committing the change that dropped it"""
+    from models import Drug, Tool
+    if not is_digest(digest):
+        return
+    with _pins_lock:
+        # References are checked under the lock, so no upload can pin the entry in between
+        if _pins[digest] or db.query(Drug.id).filter(Drug.image_hash == digest).first() or \
+                db.query(Tool.id).filter(Tool.image_hash == digest).first():
+            return
+        shutil.rmtree(entry_dir(digest), ignore_errors=True)
+
+# ---------- Worker pool (runs in the API process) ----------
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        return _executor
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def submit(data: bytes):
+    """put() in the worker pool; returns a concurrent.futures.Future of the digest or raises PoolBusy"""
+    if not _slots.acquire(blocking=False):
+        raise PoolBusy()
+    try:
+        future = get_executor().submit(put, data)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda f: _slots.release())
+    return future
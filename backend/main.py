@@ -2,10 +2,14 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from api import router
+from api import router, UploadSizeLimit, UPLOAD_BODY_LIMITS
 from database import SessionLocal, init_db
 from models import User, Warehouse
-from passlib.context import CryptContext
+import reports
+import passwords
+import imagestore
+import backups
+from passwords import pwd_context
 import os
 
 app = FastAPI()
@@ -24,6 +28,9 @@ async def serve_test_page():
         return FileResponse(test_file)
     return {"error": "Test page not found"}
 
+# Oversized image uploads are refused while they stream in; added first so CORS headers still wrap the 413
+app.add_middleware(UploadSizeLimit, limits=UPLOAD_BODY_LIMITS)
+
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
@@ -31,6 +38,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count", "X-Next-Cursor", "ETag"],
 )
 
 app.include_router(router, prefix="/api")
@@ -39,7 +47,6 @@ app.include_router(router, prefix="/api")
 def create_default_users():
     init_db()
     db = SessionLocal()
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
     
     # Create superadmin if not exists
     if not db.query(User).filter(User.username == "superadmin").first():
@@ -72,6 +79,17 @@ def create_default_users():
     db.commit()
     db.close()
 
+@app.on_event("startup")
+def start_backup_schedule():
+    backups.start_scheduler()
+
+@app.on_event("shutdown")
+def stop_report_workers():
+    reports.shutdown_executor()
+    passwords.shutdown_executor()
+    imagestore.shutdown_executor()
+    backups.stop_scheduler()
+
 # Serve React App
 build_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'frontend', 'build')
 static_path = os.path.join(build_path, "static")
@@ -1,5 +1,35 @@
 import sqlite3
 import os
+import stock_summary
+import changelog
+import extract_images
+
+# Secondary indexes for the hot lookup paths. Names match the Index() entries in models.py
+# so fresh databases (create_all) and migrated ones end up with the same schema.
+# Bump INDEX_SET_VERSION whenever this list changes. tests/test_indexes.py checks with
+# EXPLAIN QUERY PLAN that the hot queries use them.
+INDEX_SET_VERSION = 1
+INDEXES = [
+    ("ix_transfers_status", "transfers", "status"),
+    ("ix_transfers_source_drug_expiry", "transfers", "source_warehouse_id, drug_id, expire_date"),
+    ("ix_transfers_tool", "transfers", "tool_id"),
+    ("ix_inventory_drug", "inventory", "drug_id"),
+    ("ix_inventory_disposed_expiry", "inventory", "is_disposed, expire_date"),
+]
+
+def apply_indexes(cursor):
+    """Create the secondary index set idempotently and record its version in PRAGMA user_version"""
+    applied = True
+    for name, table, columns in INDEXES:
+        try:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+        except sqlite3.OperationalError as e:
+            applied = False
+            print(f"⚠️  Index {name} could not be created: {e}")
+    if applied:
+        cursor.execute(f"PRAGMA user_version = {INDEX_SET_VERSION}")
+        print(f"✅ Index set v{INDEX_SET_VERSION} applied ({len(INDEXES)} indexes)")
+    return applied
 
 def migrate():
     # Use absolute path to database in project root
@@ -115,7 +145,45 @@ def migrate():
     except sqlite3.OperationalError as e:
         print(f"⚠️  Column item_type might already exist: {e}")
 
+    try:
+        cursor.execute("ALTER TABLE users ADD COLUMN token_version INTEGER DEFAULT 0")
+        print("✅ Added token_version column to users table")
+    except sqlite3.OperationalError as e:
+        print(f"⚠️  Column token_version might already exist: {e}")
+
+    # Content-addressed image store references (imagestore.py)
+    for table in ('drugs', 'tools'):
+        try:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN image_hash VARCHAR")
+            print(f"✅ Added image_hash column to {table} table")
+        except sqlite3.OperationalError as e:
+            print(f"⚠️  Column image_hash might already exist on {table}: {e}")
+
+    # Warehouse × drug totals maintained by triggers on inventory
+    try:
+        if stock_summary.install(cursor):
+            print("✅ Built stock_summary table from inventory")
+    except sqlite3.OperationalError as e:
+        print(f"⚠️  stock_summary could not be installed: {e}")
+
+    # Row-level change log behind /api/sync
+    try:
+        changelog.install(cursor)
+        print("✅ change_log triggers installed")
+    except sqlite3.OperationalError as e:
+        print(f"⚠️  change_log could not be installed: {e}")
+
+    # Secondary indexes for transfer and inventory lookups
+    apply_indexes(cursor)
+
     conn.commit()
+
+    # Move base64 image copies into the image store and compact the file
+    try:
+        extract_images.run(conn, db_path)
+    except sqlite3.OperationalError as e:
+        print(f"⚠️  Images could not be extracted: {e}")
+
     conn.close()
     print("\n🎉 Migration completed successfully!")
     print(f"Database: {db_path}")
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, Text, Boolean, Table, UniqueConstraint
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Column, Integer, String, Date, ForeignKey, Text, Boolean, Table, UniqueConstraint, Index
+from sqlalchemy.orm import declarative_base, relationship, deferred
 
 Base = declarative_base()
 
@@ -29,6 +29,7 @@ class User(Base):
     full_name = Column(String)
     is_active = Column(Boolean, default=True)
     access_level = Column(String, default='warehouseman')  # Still keep for legacy support
+    token_version = Column(Integer, default=0)  # Bumped on password change; tokens carry it as 'tv'
     warehouses = relationship('Warehouse', secondary=user_warehouses, back_populates='users')
     permissions = relationship('Permission', secondary=user_permissions, backref='users')
 
@@ -68,8 +69,9 @@ class Drug(Base):
     name = Column(String, nullable=False)
     dose = Column(String)
     package_type = Column(String)
-    image = Column(String)  # Path to cached file (images/drug_X.jpg)
-    image_data = Column(Text)  # Base64 encoded image data for backup
+    image = Column(String)  # Path to cached file (images/drug_X.jpg, or the 800px rendition in the image store)
+    image_data = deferred(Column(Text))  # Base64 encoded image data for backup, loaded only on access
+    image_hash = Column(String)  # Image store entry (see imagestore.py)
     description = Column(Text)
     has_expiry_date = Column(Boolean, default=True)  # True: requires expiry date, False: no expiry needed
 
@@ -77,6 +79,8 @@ class Inventory(Base):
     __tablename__ = 'inventory'
     __table_args__ = (
         UniqueConstraint('warehouse_id', 'drug_id', 'expire_date', name='uq_inventory_warehouse_drug_expiry'),
+        Index('ix_inventory_drug', 'drug_id'),
+        Index('ix_inventory_disposed_expiry', 'is_disposed', 'expire_date'),
     )
     id = Column(Integer, primary_key=True)
     warehouse_id = Column(Integer, ForeignKey('warehouses.id'))
@@ -90,6 +94,14 @@ class Inventory(Base):
     drug = relationship('Drug')
     supplier = relationship('Supplier')
 
+class StockSummary(Base):
+    """Warehouse × drug totals over non-disposed lots, maintained by SQLite triggers (see stock_summary.py)"""
+    __tablename__ = 'stock_summary'
+    warehouse_id = Column(Integer, ForeignKey('warehouses.id'), primary_key=True)
+    drug_id = Column(Integer, ForeignKey('drugs.id'), primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+    lot_count = Column(Integer, nullable=False, default=0)
+
 class OperationLog(Base):
     __tablename__ = 'operation_logs'
     id = Column(Integer, primary_key=True)
@@ -105,8 +117,9 @@ class Tool(Base):
     name = Column(String, nullable=False)
     serial_number = Column(String, nullable=False, unique=True)  # Unique serial for each tool unit
     manufacturer = Column(String)
-    image = Column(String)  # Path to cached file (images/tool_X.jpg)
-    image_data = Column(Text)  # Base64 encoded image data for backup
+    image = Column(String)  # Path to cached file (images/tool_X.jpg, or the 800px rendition in the image store)
+    image_data = deferred(Column(Text))  # Base64 encoded image data for backup, loaded only on access
+    image_hash = Column(String)  # Image store entry (see imagestore.py)
     description = Column(Text)
 
 class ToolInventory(Base):
@@ -127,6 +140,11 @@ class ToolInventory(Base):
 
 class Transfer(Base):
     __tablename__ = 'transfers'
+    __table_args__ = (
+        Index('ix_transfers_status', 'status'),
+        Index('ix_transfers_source_drug_expiry', 'source_warehouse_id', 'drug_id', 'expire_date'),
+        Index('ix_transfers_tool', 'tool_id'),
+    )
     id = Column(Integer, primary_key=True)
     source_warehouse_id = Column(Integer, ForeignKey('warehouses.id'))
     destination_warehouse_id = Column(Integer, ForeignKey('warehouses.id'), nullable=True)
@@ -0,0 +1,130 @@
+"""
+Password hashing in a dedicated process pool.
+
+bcrypt is deliberately slow. Run in FastAPI's shared threadpool, a burst of logins at shift
+change took every thread and inventory reads queued behind them. Hashing and verification
+now run in a small process pool of their own, and the async endpoints await the result, so a
+waiting login holds no API thread.
+
+PHARMACY_BCRYPT_ROUNDS sets the bcrypt cost. Hashes made with another cost still verify,
+and verify_password() hands back a replacement hash so login can upgrade them transparently.
+
+benchmark_login.py measures login throughput against read latency on a running server.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import os
+import threading
+import time
+
+from passlib.context import CryptContext
+
+HASH_WORKERS = int(os.environ.get('PHARMACY_HASH_WORKERS', 2))
+BCRYPT_ROUNDS = int(os.environ.get('PHARMACY_BCRYPT_ROUNDS', 12))
+
+# min = max = default: any hash with a different cost is reported as needing an update
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    'submitted': 0,
+    'completed': 0,
+    'failed': 0,
+    'peak_queue_depth': 0,
+    'queue_wait_ms_total': 0.0,
+    'run_ms_total': 0.0,
+    'rehashed': 0
+}
+
+# ---------- Runs inside the worker processes ----------
+
+def _timed(func, *args):
+    started = time.time()
+    return started, func(*args)
+
+def _hash(password):
+    return pwd_context.hash(password)
+
+def _verify_and_update(password, hashed):
+    return pwd_context.verify_and_update(password, hashed)
+
+# ---------- Pool management (runs in the API process) ----------
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        return _executor
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def _in_flight():
+    return _stats['submitted'] - _stats['completed'] - _stats['failed']
+
+def _submit(func, *args):
+    submitted_at = time.time()
+    with _stats_lock:
+        _stats['submitted'] += 1
+        _stats['peak_queue_depth'] = max(_stats['peak_queue_depth'], _in_flight() - HASH_WORKERS)
+    future = get_executor().submit(_timed, func, *args)
+
+    def finished(f):
+        finished_at = time.time()
+        with _stats_lock:
+            if f.cancelled() or f.exception() is not None:
+                _stats['failed'] += 1
+                return
+            started_at = f.result()[0]
+            _stats['completed'] += 1
+            _stats['queue_wait_ms_total'] += max(0.0, started_at - submitted_at) * 1000
+            _stats['run_ms_total'] += max(0.0, finished_at - started_at) * 1000
+
+    future.add_done_callback(finished)
+    return future
+
+async def hash_password(password: str) -> str:
+    return (await asyncio.wrap_future(_submit(_hash, password)))[1]
+
+async def verify_password(password: str, hashed: str):
+    """Returns (valid, new_hash); new_hash is set when the stored hash uses outdated parameters"""
+    valid, new_hash = (await asyncio.wrap_future(_submit(_verify_and_update, password, hashed)))[1]
+    if new_hash:
+        with _stats_lock:
+            _stats['rehashed'] += 1
+    return valid, new_hash
+
+def hash_password_blocking(password: str) -> str:
+    """For sync endpoints: the hash still runs in the pool, the calling thread just waits"""
+    return _submit(_hash, password).result()[1]
+
+def stats() -> dict:
+    with _stats_lock:
+        completed = _stats['completed']
+        in_flight = _in_flight()
+        return {
+            'workers': HASH_WORKERS,
+            'bcrypt_rounds': BCRYPT_ROUNDS,
+            'in_flight': in_flight,
+            'queue_depth': max(0, in_flight - HASH_WORKERS),
+            'peak_queue_depth': _stats['peak_queue_depth'],
+            'submitted': _stats['submitted'],
+            'completed': completed,
+            'failed': _stats['failed'],
+            'rehashed': _stats['rehashed'],
+            'avg_queue_wait_ms': round(_stats['queue_wait_ms_total'] / completed, 1) if completed else None,
+            'avg_run_ms': round(_stats['run_ms_total'] / completed, 1) if completed else None
+        }
@@ -0,0 +1,38 @@
+"""
+Persian text shaping for reports (PDF and any other writer that draws RTL text itself).
+
+arabic_reshaper + bidi are slow per call and report columns repeat the same values
+(drug names, warehouse names, quantities) across thousands of rows, so results are
+memoized in a bounded LRU cache.
+"""
+from functools import lru_cache
+import os
+
+import arabic_reshaper
+from bidi.algorithm import get_display
+
+SHAPE_CACHE_SIZE = int(os.environ.get('PHARMACY_SHAPE_CACHE_SIZE', 8192))
+
+@lru_cache(maxsize=SHAPE_CACHE_SIZE)
+def _shape(text: str) -> str:
+    return get_display(arabic_reshaper.reshape(text))
+
+def shape(text) -> str:
+    """Reshape and reorder text for left-to-right renderers; empty values become ''"""
+    if not text:
+        return ""
+    return _shape(str(text))
+
+def shape_column(values) -> list:
+    """Shape a whole column, computing each distinct value only once"""
+    shaped = {}
+    result = []
+    for value in values:
+        key = "" if not value else str(value)
+        if key not in shaped:
+            shaped[key] = _shape(key) if key else ""
+        result.append(shaped[key])
+    return result
+
+def cache_info():
+    return _shape.cache_info()
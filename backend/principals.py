@@ -0,0 +1,73 @@
+"""
+Short-lived cache of authenticated users (principals).
+
+get_current_user used to load the User row on every request, and check_warehouse_access then
+lazy-loaded user.warehouses. A Principal holds what authorization needs (access level,
+warehouse ids, permission names) as plain values. It is cached by (user id, token version),
+so an authenticated request costs no query while the entry is fresh.
+
+Entries expire after PRINCIPAL_TTL_SECONDS. The user endpoints call invalidate() after they
+commit a change to a user's role, warehouses, permissions or password. Password changes also
+bump users.token_version, so tokens issued before the change no longer match any entry.
+"""
+import os
+import threading
+import time
+
+PRINCIPAL_TTL_SECONDS = int(os.environ.get('PHARMACY_PRINCIPAL_TTL_SECONDS', 60))
+
+class Principal:
+    """The authenticated user as seen by authorization checks; detached from any session"""
+    __slots__ = ('id', 'username', 'full_name', 'access_level', 'warehouse_ids', 'permissions', 'token_version')
+
+    def __init__(self, id, username, full_name, access_level, warehouse_ids, permissions, token_version):
+        self.id = id
+        self.username = username
+        self.full_name = full_name
+        self.access_level = access_level
+        self.warehouse_ids = frozenset(warehouse_ids)
+        self.permissions = frozenset(permissions)
+        self.token_version = token_version
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.full_name, user.access_level,
+                   (w.id for w in user.warehouses), (p.name for p in user.permissions),
+                   user.token_version or 0)
+
+_lock = threading.Lock()
+_cache = {}
+_generations = {}
+_stats = {'hits': 0, 'misses': 0}
+
+def get(user_id: int, token_version: int, loader):
+    """
+    Cached principal for (user_id, token_version); loader() returns a Principal or raises
+    (user deleted, token older than the last password change), in which case nothing is cached.
+    """
+    key = (user_id, token_version)
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > now:
+            _stats['hits'] += 1
+            return entry[1]
+        _stats['misses'] += 1
+        generation = _generations.get(user_id, 0)
+    principal = loader()
+    with _lock:
+        # Skip storing if the user was invalidated while loading
+        if _generations.get(user_id, 0) == generation:
+            _cache[key] = (now + PRINCIPAL_TTL_SECONDS, principal)
+    return principal
+
+def invalidate(user_id: int):
+    """Drop every cached principal of a user; call after committing a change to that user"""
+    with _lock:
+        _generations[user_id] = _generations.get(user_id, 0) + 1
+        for key in [k for k in _cache if k[0] == user_id]:
+            del _cache[key]
+
+def stats() -> dict:
+    with _lock:
+        return {'hits': _stats['hits'], 'misses': _stats['misses'], 'entries': len(_cache)}
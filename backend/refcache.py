@@ -0,0 +1,106 @@
+"""
+In-process cache for reference data: warehouses, drugs, suppliers, consumers, permissions,
+system settings and the TRANSIT warehouse id.
+
+Every table has a version that is bumped when a session that wrote to it commits (see the
+Session events at the bottom), so the add/update/delete endpoints invalidate the cache just by
+committing. A cached value remembers the versions of the tables it was built from and is
+reloaded as soon as one of them moves. The same versions drive the ETags of the list
+endpoints and the keys of the cached PDF reports. Values are plain dicts/lists shared between requests; callers must not modify them.
+
+The cache lives in the API process. Writes made outside a Session (restoring a backup,
+running migrations against a live server) must call invalidate_all().
+"""
+from itertools import chain
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_mapper
+
+_WRITTEN_TABLES = 'refcache_written_tables'
+
+_lock = threading.Lock()
+_versions = {}
+_entries = {}
+_stats = {'hits': 0, 'misses': 0}
+
+def table_version(table: str) -> int:
+    with _lock:
+        return _versions.get(table, 0)
+
+def bump(tables):
+    """Mark tables as changed; every cached value built from them is reloaded on next use"""
+    with _lock:
+        for table in tables:
+            _versions[table] = _versions.get(table, 0) + 1
+
+def invalidate_all():
+    """Drop every cached value ('*' is part of every entry's version key)"""
+    bump(['*'])
+
+def get_or_load(db: Session, key, tables, loader):
+    """
+    Return the cached value for key, calling loader() on a miss.
+    tables: the tables the value is read from.
+    A session holding uncommitted writes to those tables reads through without caching,
+    so rolled-back data is never shared.
+    """
+    if _written(db) & set(tables):
+        return loader()
+    tables = ('*', *tables)
+    with _lock:
+        versions = tuple(_versions.get(table, 0) for table in tables)
+        entry = _entries.get(key)
+        if entry is not None and entry[0] == versions:
+            _stats['hits'] += 1
+            return entry[1]
+        _stats['misses'] += 1
+    value = loader()
+    with _lock:
+        # A write committed while loading: keep serving from the database until the next call
+        if tuple(_versions.get(table, 0) for table in tables) == versions:
+            _entries[key] = (versions, value)
+    return value
+
+def stats() -> dict:
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses']
+        return {
+            'hits': _stats['hits'],
+            'misses': _stats['misses'],
+            'hit_ratio': round(_stats['hits'] / lookups, 4) if lookups else None,
+            'entries': len(_entries),
+            'versions': dict(_versions)
+        }
+
+# ---------- Write tracking ----------
+
+def _written(session: Session) -> set:
+    return session.info.setdefault(_WRITTEN_TABLES, set())
+
+@event.listens_for(Session, 'after_flush')
+def _track_flush(session, flush_context):
+    # new/dirty/deleted still describe what this flush wrote
+    written = _written(session)
+    for obj in chain(session.new, session.dirty, session.deleted):
+        mapper = object_mapper(obj)
+        written.update(table.name for table in mapper.tables)
+        written.update(rel.secondary.name for rel in mapper.relationships if rel.secondary is not None)
+
+@event.listens_for(Session, 'do_orm_execute')
+def _track_statement(orm_execute_state):
+    # Core/bulk INSERT, UPDATE and DELETE run through session.execute()
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None:
+            _written(orm_execute_state.session).add(table.name)
+
+@event.listens_for(Session, 'after_commit')
+def _bump_on_commit(session):
+    written = session.info.pop(_WRITTEN_TABLES, None)
+    if written:
+        bump(written)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_on_rollback(session):
+    session.info.pop(_WRITTEN_TABLES, None)
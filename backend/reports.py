@@ -0,0 +1,341 @@
+"""
+Background PDF report rendering.
+
+Reports are rendered in a process pool so large PDFs never tie up the API threads.
+Finished files are cached on disk, keyed by the report parameters plus the data version of
+the tables the report reads, so asking again for an unchanged report is served straight from
+disk without querying the rows.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+REPORT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report_cache')
+REPORT_WORKERS = int(os.environ.get('PHARMACY_REPORT_WORKERS', 2))
+REPORT_CACHE_MAX_FILES = int(os.environ.get('PHARMACY_REPORT_CACHE_MAX_FILES', 50))
+REPORT_JOB_TTL_SECONDS = 60 * 60
+
+_executor = None
+_executor_lock = threading.Lock()
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+# ---------- Rendering (runs inside the worker processes) ----------
+
+_font_registered = False
+
+def _register_font():
+    """Register Vazirmatn once per worker process instead of on every report"""
+    global _font_registered
+    if _font_registered:
+        return
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    font_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'Vazirmatn-Regular.ttf')
+    pdfmetrics.registerFont(TTFont('Vazirmatn', font_path))
+    _font_registered = True
+
+def render_inventory_pdf(rows, warehouse_name, file_path):
+    """
+    Render the inventory report to file_path.
+    rows: list of (drug_name, expire_date, quantity) tuples
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.units import cm
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.enums import TA_CENTER
+    import jdatetime
+    from persian_text import shape as prepare_persian_text, shape_column
+
+    _register_font()
+
+    # Helper function to get color based on expiry date
+    def get_expiry_color(expire_date):
+        if not expire_date:
+            return colors.grey
+        try:
+            exp_date = datetime.strptime(str(expire_date), '%Y-%m-%d')
+            days_until = (exp_date - datetime.now()).days
+            if days_until < 0:
+                return colors.Color(0.8, 0, 0)  # Dark red - expired
+            elif days_until < 30:
+                return colors.Color(1, 0.2, 0.2)  # Red
+            elif days_until < 90:
+                return colors.Color(1, 0.6, 0)  # Orange
+            else:
+                return colors.Color(0.2, 0.7, 0.2)  # Green
+        except:
+            return colors.grey
+
+    # Custom page template with repeating header
+    def header_footer(canvas, doc):
+        canvas.saveState()
+
+        # Add header on every page
+        canvas.setFont('Vazirmatn', 16)
+        canvas.setFillColor(colors.HexColor('#1976d2'))
+        title_text = prepare_persian_text("گزارش موجودی انبار دارویی")
+        canvas.drawCentredString(A4[0] / 2, A4[1] - 1.5*cm, title_text)
+
+        # Add warehouse name if filtered
+        if warehouse_name:
+            canvas.setFont('Vazirmatn', 12)
+            canvas.setFillColor(colors.HexColor('#666666'))
+            wh_text = prepare_persian_text(f"انبار: {warehouse_name}")
+            canvas.drawCentredString(A4[0] / 2, A4[1] - 2.2*cm, wh_text)
+
+        # Add date
+        canvas.setFont('Vazirmatn', 9)
+        canvas.setFillColor(colors.grey)
+        now = datetime.now()
+        jalali_now = jdatetime.datetime.fromgregorian(datetime=now)
+        current_date = jalali_now.strftime('%Y/%m/%d')
+        date_text = prepare_persian_text(f"تاریخ: {current_date}")
+        canvas.drawCentredString(A4[0] / 2, A4[1] - 2.8*cm, date_text)
+
+        # Add page number in footer
+        canvas.setFont('Vazirmatn', 9)
+        page_text = prepare_persian_text(f"صفحه {doc.page}")
+        canvas.drawCentredString(A4[0] / 2, 1*cm, page_text)
+
+        canvas.restoreState()
+
+    doc = SimpleDocTemplate(
+        file_path,
+        pagesize=A4,
+        rightMargin=2*cm,
+        leftMargin=2*cm,
+        topMargin=3.5*cm,  # Increased for header
+        bottomMargin=2*cm
+    )
+
+    # Story container
+    story = []
+
+    # Prepare table data (without warehouse column)
+    table_data = []
+
+    # Header row
+    headers = [
+        prepare_persian_text("تعداد"),
+        prepare_persian_text("تاریخ انقضا"),
+        prepare_persian_text("نام دارو"),
+        prepare_persian_text("ردیف")
+    ]
+    table_data.append(headers)
+
+    # Data rows - names and quantities repeat a lot, so shape each column in one pass
+    shaped_quantities = shape_column(str(quantity) for _, _, quantity in rows)
+    shaped_names = shape_column(drug_name for drug_name, _, _ in rows)
+    for idx, (_, expire_date, _) in enumerate(rows, 1):
+        row = [
+            shaped_quantities[idx - 1],
+            str(expire_date) if expire_date else "-",
+            shaped_names[idx - 1],
+            str(idx)
+        ]
+        table_data.append(row)
+
+    # Create table with wider columns (no warehouse column)
+    table = Table(table_data, colWidths=[3.5*cm, 4*cm, 7*cm, 2.5*cm], repeatRows=1)
+
+    # Table style with colors
+    table_style = [
+        # Header styling
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1976d2')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Vazirmatn'),
+        ('FONTSIZE', (0, 0), (-1, 0), 11),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('TOPPADDING', (0, 0), (-1, 0), 12),
+
+        # Data rows styling
+        ('FONTNAME', (0, 1), (-1, -1), 'Vazirmatn'),
+        ('FONTSIZE', (0, 1), (-1, -1), 10),
+        ('ALIGN', (0, 1), (-1, -1), 'CENTER'),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#f5f5f5')]),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('TOPPADDING', (0, 1), (-1, -1), 8),
+        ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
+    ]
+
+    # Add expiry date colors
+    for idx, (_, expire_date, _) in enumerate(rows, 1):
+        exp_color = get_expiry_color(expire_date)
+        table_style.append(('TEXTCOLOR', (1, idx), (1, idx), exp_color))
+        table_style.append(('FONTNAME', (1, idx), (1, idx), 'Vazirmatn'))
+
+    table.setStyle(TableStyle(table_style))
+    story.append(table)
+
+    # Add summary footer
+    story.append(Spacer(1, 1*cm))
+
+    total_items = len(rows)
+    total_quantity = sum(quantity for _, _, quantity in rows)
+    summary_text = prepare_persian_text(f"تعداد کل اقلام: {total_items} | مجموع تعداد: {total_quantity}")
+
+    styles = getSampleStyleSheet()
+    summary_style = ParagraphStyle(
+        'Summary',
+        parent=styles['Normal'],
+        fontName='Vazirmatn',
+        fontSize=10,
+        textColor=colors.HexColor('#1976d2'),
+        alignment=TA_CENTER,
+        borderWidth=1,
+        borderColor=colors.HexColor('#1976d2'),
+        borderPadding=10,
+        backColor=colors.HexColor('#e3f2fd')
+    )
+    story.append(Paragraph(summary_text, summary_style))
+
+    # Build PDF with custom header/footer
+    doc.build(story, onFirstPage=header_footer, onLaterPages=header_footer)
+    return file_path
+
+def _render_to_cache(rows, warehouse_name, cache_path):
+    # Render next to the final path and move it into place so readers never see a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        render_inventory_pdf(rows, warehouse_name, tmp_path)
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return cache_path
+
+# ---------- Job management (runs in the API process) ----------
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=REPORT_WORKERS)
+        return _executor
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def report_cache_key(kind: str, params: dict, data_version: str) -> str:
+    """
+    Filter parameters + the data version of the report's tables + today's date,
+    because the rendered header carries the print date
+    """
+    payload = json.dumps([kind, params, data_version, datetime.now().strftime('%Y-%m-%d')],
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _cache_path(cache_key: str) -> str:
+    return os.path.join(REPORT_CACHE_DIR, f"{cache_key}.pdf")
+
+def _prune_cache():
+    try:
+        files = [os.path.join(REPORT_CACHE_DIR, f) for f in os.listdir(REPORT_CACHE_DIR) if f.endswith('.pdf')]
+    except FileNotFoundError:
+        return
+    if len(files) <= REPORT_CACHE_MAX_FILES:
+        return
+    files.sort(key=os.path.getmtime)
+    for path in files[:len(files) - REPORT_CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _prune_jobs():
+    cutoff = time.time() - REPORT_JOB_TTL_SECONDS
+    for job_id in [j for j, job in _jobs.items() if job['created_at'] < cutoff and job['status'] in ('done', 'failed')]:
+        del _jobs[job_id]
+
+def _on_job_finished(job_id, future):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        error = future.exception()
+        if error is None:
+            job['status'] = 'done'
+        else:
+            job['status'] = 'failed'
+            job['error'] = str(error)
+        job['finished_at'] = time.time()
+    _prune_cache()
+
+def _existing_job(job, cache_path):
+    """A render in flight for the same file, or job marked done when the file is cached (under _jobs_lock)"""
+    for other in _jobs.values():
+        if other['file'] == cache_path and other['status'] in ('queued', 'running'):
+            return other
+    if os.path.exists(cache_path):
+        os.utime(cache_path)
+        job.update(status='done', cached=True, finished_at=time.time())
+        _jobs[job['id']] = job
+        return job
+    return None
+
+def submit_inventory_pdf(params: dict, data_version: str, load_rows):
+    """
+    Queue an inventory PDF; returns the job dict (already 'done' on a cache hit).
+    load_rows() -> (rows, warehouse_name) is only called when the report has to be rendered.
+    """
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    cache_key = report_cache_key('inventory_pdf', params, data_version)
+    cache_path = _cache_path(cache_key)
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'status': 'queued',
+        'cached': False,
+        'file': cache_path,
+        'error': None,
+        'created_at': time.time(),
+        'finished_at': None,
+        'future': None
+    }
+
+    with _jobs_lock:
+        _prune_jobs()
+        existing = _existing_job(job, cache_path)
+        if existing:
+            return existing
+
+    # The rows are read outside the lock; a request for the same key may have started meanwhile
+    rows, warehouse_name = load_rows()
+    with _jobs_lock:
+        existing = _existing_job(job, cache_path)
+        if existing:
+            return existing
+        # Submitted under the lock so a concurrent request never sees the job without its future
+        job['future'] = get_executor().submit(_render_to_cache, list(rows), warehouse_name, cache_path)
+        job['status'] = 'running'
+        _jobs[job_id] = job
+
+    # Outside the lock: the callback runs immediately if the render already finished
+    job['future'].add_done_callback(lambda f: _on_job_finished(job_id, f))
+    return job
+
+def get_job(job_id: str):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+def job_status(job: dict) -> dict:
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'cached': job['cached'],
+        'error': job['error']
+    }
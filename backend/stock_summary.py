@@ -0,0 +1,151 @@
+"""
+Warehouse × drug stock totals, kept in the stock_summary table.
+
+The table is maintained by SQLite triggers on inventory, so every change to a lot
+(ORM flushes, bulk upserts, transfers, mismatch resolution) updates the totals inside
+the same transaction. Disposed lots are excluded, matching what the inventory screens show.
+
+Command line:
+    python stock_summary.py --verify    compare the table with SUM(quantity) over the lots
+    python stock_summary.py --rebuild   recompute the table from the lots, then verify
+"""
+import os
+import sqlite3
+import sys
+
+SUMMARY_TRIGGERS = {
+    "trg_stock_summary_insert": """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_summary_insert
+        AFTER INSERT ON inventory
+        WHEN COALESCE(NEW.is_disposed, 0) = 0 AND NEW.warehouse_id IS NOT NULL AND NEW.drug_id IS NOT NULL
+        BEGIN
+            INSERT INTO stock_summary (warehouse_id, drug_id, quantity, lot_count)
+            VALUES (NEW.warehouse_id, NEW.drug_id, COALESCE(NEW.quantity, 0), 1)
+            ON CONFLICT (warehouse_id, drug_id) DO UPDATE SET
+                quantity = quantity + excluded.quantity,
+                lot_count = lot_count + 1;
+        END
+    """,
+    "trg_stock_summary_update": """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_summary_update
+        AFTER UPDATE OF warehouse_id, drug_id, quantity, is_disposed ON inventory
+        BEGIN
+            UPDATE stock_summary SET
+                quantity = quantity - COALESCE(OLD.quantity, 0),
+                lot_count = lot_count - 1
+            WHERE warehouse_id IS OLD.warehouse_id AND drug_id IS OLD.drug_id
+              AND COALESCE(OLD.is_disposed, 0) = 0;
+            INSERT INTO stock_summary (warehouse_id, drug_id, quantity, lot_count)
+            SELECT NEW.warehouse_id, NEW.drug_id, COALESCE(NEW.quantity, 0), 1
+            WHERE COALESCE(NEW.is_disposed, 0) = 0 AND NEW.warehouse_id IS NOT NULL AND NEW.drug_id IS NOT NULL
+            ON CONFLICT (warehouse_id, drug_id) DO UPDATE SET
+                quantity = quantity + excluded.quantity,
+                lot_count = lot_count + 1;
+            DELETE FROM stock_summary
+            WHERE warehouse_id IS OLD.warehouse_id AND drug_id IS OLD.drug_id AND lot_count <= 0;
+        END
+    """,
+    "trg_stock_summary_delete": """
+        CREATE TRIGGER IF NOT EXISTS trg_stock_summary_delete
+        AFTER DELETE ON inventory
+        WHEN COALESCE(OLD.is_disposed, 0) = 0
+        BEGIN
+            UPDATE stock_summary SET
+                quantity = quantity - COALESCE(OLD.quantity, 0),
+                lot_count = lot_count - 1
+            WHERE warehouse_id IS OLD.warehouse_id AND drug_id IS OLD.drug_id;
+            DELETE FROM stock_summary
+            WHERE warehouse_id IS OLD.warehouse_id AND drug_id IS OLD.drug_id AND lot_count <= 0;
+        END
+    """,
+}
+
+CREATE_SUMMARY_TABLE = """
+    CREATE TABLE IF NOT EXISTS stock_summary (
+        warehouse_id INTEGER NOT NULL REFERENCES warehouses(id),
+        drug_id INTEGER NOT NULL REFERENCES drugs(id),
+        quantity INTEGER NOT NULL DEFAULT 0,
+        lot_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (warehouse_id, drug_id)
+    )
+"""
+
+LOT_TOTALS_QUERY = """
+    SELECT warehouse_id, drug_id, SUM(COALESCE(quantity, 0)), COUNT(*)
+    FROM inventory
+    WHERE COALESCE(is_disposed, 0) = 0 AND warehouse_id IS NOT NULL AND drug_id IS NOT NULL
+    GROUP BY warehouse_id, drug_id
+"""
+
+def _normalized(sql):
+    """Trigger SQL as sqlite_master stores it: without IF NOT EXISTS, whitespace aside"""
+    return ' '.join(sql.replace('IF NOT EXISTS ', '').split())
+
+def install(cursor):
+    """
+    Create the summary table and its triggers (idempotent); triggers with an older definition
+    are replaced. When a trigger is (re)installed the table is rebuilt from the existing lots.
+    Returns True if a rebuild was done.
+    """
+    existing = dict(cursor.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_stock_summary_%'"
+    ).fetchall())
+    cursor.execute(CREATE_SUMMARY_TABLE)
+    for name, sql in SUMMARY_TRIGGERS.items():
+        if name in existing and _normalized(existing[name]) != _normalized(sql):
+            cursor.execute(f"DROP TRIGGER {name}")
+            del existing[name]
+        cursor.execute(sql)
+    if set(existing) != set(SUMMARY_TRIGGERS):
+        rebuild(cursor)
+        return True
+    return False
+
+def rebuild(cursor):
+    """Recompute every total from the lots"""
+    cursor.execute("DELETE FROM stock_summary")
+    cursor.execute(
+        "INSERT INTO stock_summary (warehouse_id, drug_id, quantity, lot_count) " + LOT_TOTALS_QUERY
+    )
+
+def verify(cursor):
+    """Return the (warehouse_id, drug_id) pairs whose summary differs from SUM(quantity) over the lots"""
+    expected = {(w, d): (q, c) for w, d, q, c in cursor.execute(LOT_TOTALS_QUERY).fetchall()}
+    actual = {(w, d): (q, c) for w, d, q, c in cursor.execute(
+        "SELECT warehouse_id, drug_id, quantity, lot_count FROM stock_summary"
+    ).fetchall()}
+    return sorted(key for key in set(expected) | set(actual) if expected.get(key) != actual.get(key))
+
+def install_on_engine(engine):
+    # engine.begin() so the install runs in one transaction (the engine's connections autocommit)
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        install(cursor)
+        cursor.close()
+
+def main(argv):
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    db_path = os.path.join(base_dir, 'pharmacy.db')
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    try:
+        if install(cursor):
+            print("✅ stock_summary installed and built from inventory")
+        if '--rebuild' in argv:
+            rebuild(cursor)
+            print("✅ stock_summary rebuilt from inventory")
+        conn.commit()
+        mismatches = verify(cursor)
+        if mismatches:
+            print(f"❌ stock_summary differs from inventory for {len(mismatches)} warehouse/drug pairs:")
+            for warehouse_id, drug_id in mismatches[:20]:
+                print(f"   warehouse {warehouse_id}, drug {drug_id}")
+            return 1
+        count = cursor.execute("SELECT COUNT(*) FROM stock_summary").fetchone()[0]
+        print(f"✅ stock_summary matches SUM(quantity) over inventory ({count} warehouse/drug pairs)")
+        return 0
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
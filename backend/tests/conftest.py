@@ -0,0 +1,47 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+
+import changelog
+import stock_summary
+from models import Base
+
+@pytest.fixture
+def db_path(tmp_path):
+    """A fresh pharmacy database with the current schema, summary and change-log triggers"""
+    path = str(tmp_path / 'pharmacy.db')
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+    conn = sqlite3.connect(path)
+    stock_summary.install(conn.cursor())
+    changelog.install(conn.cursor())
+    conn.commit()
+    conn.close()
+    return path
+
+@pytest.fixture
+def conn(db_path):
+    conn = sqlite3.connect(db_path)
+    yield conn
+    conn.close()
+
+@pytest.fixture
+def session(db_path):
+    from sqlalchemy.orm import sessionmaker
+    engine = create_engine(f'sqlite:///{db_path}')
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield db
+    db.close()
+    engine.dispose()
+
+@pytest.fixture
+def admin():
+    from principals import Principal
+    return Principal(1, 'admin', 'Admin', 'superadmin', [], [], 0)
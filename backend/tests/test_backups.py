@@ -0,0 +1,78 @@
+from datetime import datetime
+import gzip
+import os
+import shutil
+import sqlite3
+from io import BytesIO
+
+from PIL import Image
+import pytest
+
+import backups
+import imagestore
+
+@pytest.fixture
+def backup_env(db_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(backups, 'DB_PATH', db_path)
+    monkeypatch.setattr(backups, 'BACKUP_DIR', str(tmp_path / 'db_backup'))
+    monkeypatch.setattr(imagestore, 'STORE_DIR', str(tmp_path / 'store'))
+    return db_path
+
+def add_drug_with_image(db_path, drug_id, color):
+    buffer = BytesIO()
+    Image.new('RGB', (20, 20), color).save(buffer, format='PNG')
+    digest = imagestore.put(buffer.getvalue())
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO drugs (id, name, image_hash) VALUES (?, ?, ?)", (drug_id, f'drug {drug_id}', digest))
+    conn.commit()
+    conn.close()
+    return digest
+
+def test_full_backup_copies_the_images_it_points_at(backup_env):
+    digest = add_drug_with_image(backup_env, 1, 'red')
+    result = backups.take_backup('pharmacy_20261017_000000.db.gz')
+    assert result['images'] == 1 and result['images_copied'] == 1 and result['images_missing'] == []
+    assert imagestore.verify(digest, backups.image_backup_dir())
+    assert backups.read_manifest('pharmacy_20261017_000000.db.gz')['images'] == [digest]
+    # Content-addressed: the next backup does not copy it again
+    assert backups.take_backup('pharmacy_20261017_010000.db.gz')['images_copied'] == 0
+
+def test_retention_prunes_images_no_kept_backup_uses(backup_env, monkeypatch):
+    old = add_drug_with_image(backup_env, 1, 'red')
+    backups.take_backup('pharmacy_20261015_000000.db.gz')
+    conn = sqlite3.connect(backup_env)
+    conn.execute("UPDATE drugs SET image_hash = NULL")
+    conn.commit()
+    conn.close()
+    new = add_drug_with_image(backup_env, 2, 'blue')
+    monkeypatch.setattr(backups, 'BACKUP_KEEP_DAILY', 1)
+    monkeypatch.setattr(backups, 'BACKUP_KEEP_MONTHLY', 0)
+    result = backups.take_backup('pharmacy_20261017_000000.db.gz')
+    assert 'pharmacy_20261015_000000.db.gz' in result['deleted']
+    assert not imagestore.exists(old, backups.image_backup_dir())
+    assert imagestore.verify(new, backups.image_backup_dir())
+
+def test_missing_store_entry_is_reported(backup_env):
+    digest = add_drug_with_image(backup_env, 1, 'red')
+    shutil.rmtree(imagestore.entry_dir(digest))
+    result = backups.take_backup('pharmacy_20261017_000000.db.gz')
+    assert result['images_missing'] == [digest]
+    with gzip.open(os.path.join(backups.BACKUP_DIR, 'pharmacy_20261017_000000.db.gz')) as f:
+        assert f.read(16) == b'SQLite format 3\x00'
+
+def test_increment_copies_new_images_and_restore_puts_them_back(backup_env, tmp_path, monkeypatch):
+    first = add_drug_with_image(backup_env, 1, 'red')
+    backups.take_backup('pharmacy_20261017_000000.db.gz')
+    second = add_drug_with_image(backup_env, 2, 'blue')
+    result = backups.take_incremental(now=datetime(2026, 10, 17, 1))
+    assert result['kind'] == 'incremental' and result['images_copied'] == 1
+    assert backups.read_increment(result['file'])['images'] == [second]
+
+    # The store is lost with the server; the restore brings both images back
+    monkeypatch.setattr(imagestore, 'STORE_DIR', str(tmp_path / 'new_store'))
+    restored = backups.restore(str(tmp_path / 'restored.db'))
+    assert restored['images'] == 2 and restored['images_restored'] == 2 and restored['images_missing'] == []
+    assert imagestore.verify(first) and imagestore.verify(second)
+    conn = sqlite3.connect(str(tmp_path / 'restored.db'))
+    assert conn.execute("SELECT id, image_hash FROM drugs ORDER BY id").fetchall() == [(1, first), (2, second)]
+    conn.close()
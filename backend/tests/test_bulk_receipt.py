@@ -0,0 +1,60 @@
+from datetime import datetime
+from io import BytesIO
+from types import SimpleNamespace
+
+from openpyxl import Workbook
+import pytest
+
+import api
+from models import Drug, Inventory, Warehouse
+
+HEADER = ['warehouse_id', 'drug_id', 'expire_date', 'quantity']
+
+@pytest.fixture
+def stocked(session):
+    session.add_all([Warehouse(id=1, name='Central', code='C1'), Drug(id=1, name='Amoxicillin', has_expiry_date=True)])
+    session.add(Inventory(warehouse_id=1, drug_id=1, expire_date='2027-01', quantity=5))
+    session.commit()
+    return session
+
+def xlsx_upload(*rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(HEADER)
+    for row in rows:
+        sheet.append(row)
+    buffer = BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    return SimpleNamespace(filename='receipt.xlsx', file=buffer)
+
+def lots(session):
+    return [(inv.expire_date, inv.quantity) for inv in session.query(Inventory).order_by(Inventory.id)]
+
+def test_xlsx_date_cell_merges_into_the_existing_lot(stocked, admin):
+    lines = api.parse_receipt_file(xlsx_upload([1, 1, datetime(2027, 1, 1), 3]))
+    assert isinstance(lines[0][1]['expire_date'], datetime)
+    result = api.import_inventory_lines(stocked, admin, lines)
+    assert result['errors'] == []
+    assert lots(stocked) == [('2027-01', 8)]
+
+@pytest.mark.parametrize('text', ['2027-01', '2027-1', '2027-01-15', '2027/01/31', '2027-01-01 00:00:00'])
+def test_string_expiry_dates_are_normalized(stocked, admin, text):
+    result = api.import_inventory_lines(stocked, admin, [(1, {'warehouse_id': 1, 'drug_id': 1, 'expire_date': text, 'quantity': 1})])
+    assert result['errors'] == []
+    assert lots(stocked) == [('2027-01', 6)]
+
+def test_unparsable_expiry_date_is_a_row_error(stocked, admin):
+    result = api.import_inventory_lines(stocked, admin, [
+        (2, {'warehouse_id': 1, 'drug_id': 1, 'expire_date': 'next spring', 'quantity': 1}),
+        (3, {'warehouse_id': 1, 'drug_id': 1, 'expire_date': '2027-13', 'quantity': 1}),
+    ])
+    assert [error['line'] for error in result['errors']] == [2, 3]
+    assert lots(stocked) == [('2027-01', 5)]
+
+def test_fractional_quantity_is_rejected(stocked, admin):
+    lines = api.parse_receipt_file(xlsx_upload([1, 1, '2027-01', 2.5], [1, 1, '2027-01', 4.0]))
+    lines.append((4, {'warehouse_id': 1, 'drug_id': 1, 'expire_date': '2027-01', 'quantity': '1.5'}))
+    result = api.import_inventory_lines(stocked, admin, lines)
+    assert [error['line'] for error in result['errors']] == [2, 4]
+    assert lots(stocked) == [('2027-01', 9)]
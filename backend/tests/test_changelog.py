@@ -0,0 +1,60 @@
+import sqlite3
+
+import pytest
+
+import changelog
+
+class InterleavingCursor:
+    """Commits `write` from another connection right after the change version is read"""
+
+    def __init__(self, cursor, write):
+        self._cursor = cursor
+        self._write = write
+
+    def execute(self, sql, *args):
+        result = self._cursor.execute(sql, *args)
+        if 'FROM change_version' in sql and self._write:
+            self._write()
+            self._write = None
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+@pytest.fixture
+def wal_conn(conn, db_path):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("INSERT INTO drugs (id, name) VALUES (1, 'Amoxicillin')")
+    conn.commit()
+    return conn
+
+def insert_drug(db_path):
+    def write():
+        other = sqlite3.connect(db_path, timeout=0)
+        other.execute("INSERT INTO drugs (id, name) VALUES (2, 'Ibuprofen')")
+        other.commit()
+        other.close()
+    return write
+
+def drug_ids(changes):
+    return [row['id'] for row in changes['tables']['drugs']['inserted'] + changes['tables']['drugs']['updated']]
+
+@pytest.mark.parametrize('since', [0, 'current'])
+def test_rows_come_from_the_version_snapshot(wal_conn, db_path, since):
+    version = changelog.current_version(wal_conn.cursor())
+    since = version - 1 if since == 'current' else since
+    cursor = InterleavingCursor(wal_conn.cursor(), insert_drug(db_path))
+    changes = changelog.changes_since(cursor, since, ['drugs'])
+    assert changes['version'] == version
+    assert drug_ids(changes) == [1]
+    assert not wal_conn.in_transaction
+
+    # The concurrent insert is picked up by the next sync
+    changes = changelog.changes_since(wal_conn.cursor(), version, ['drugs'])
+    assert drug_ids(changes) == [2]
+
+def test_caller_transaction_is_kept(wal_conn):
+    wal_conn.execute("BEGIN")
+    changelog.changes_since(wal_conn.cursor(), 0, ['drugs'])
+    assert wal_conn.in_transaction
+    wal_conn.rollback()
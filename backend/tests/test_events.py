@@ -0,0 +1,45 @@
+import asyncio
+import json
+
+import events
+
+def frames(queue):
+    result = []
+    while not queue.empty():
+        result.append(queue.get_nowait())
+    return result
+
+def is_resync(frame):
+    return json.loads(frame.split('data: ', 1)[1])['type'] == 'resync'
+
+def run(scenario):
+    async def main():
+        broker = events.Broker()
+        broker.subscribe()  # binds the loop
+        broker.publish([{'type': 'transfer.created', 'id': n} for n in range(1, 4)])
+        await asyncio.sleep(0)
+        return scenario(broker)
+    return asyncio.run(main())
+
+def test_reconnect_replays_missed_events():
+    queue = run(lambda broker: broker.subscribe(broker.event_id(1)))
+    received = frames(queue)
+    assert len(received) == 2 and not any(is_resync(f) for f in received)
+    assert received[-1].startswith('id: ') and received[-1].split('\n')[0].endswith('-3')
+
+def test_reconnect_with_id_from_a_previous_process_resyncs():
+    # After a restart the sequence starts again; an old id must not be taken as "up to date"
+    queue = run(lambda broker: broker.subscribe('0badc0de-500'))
+    received = frames(queue)
+    assert len(received) == 1 and is_resync(received[0])
+
+def test_reconnect_with_id_ahead_of_the_sequence_resyncs():
+    queue = run(lambda broker: broker.subscribe(broker.event_id(500)))
+    assert [is_resync(f) for f in frames(queue)] == [True]
+
+def test_resync_frame_carries_the_current_id():
+    def scenario(broker):
+        frame = frames(broker.subscribe('garbage'))[0]
+        return frame, broker.event_id()
+    frame, current = run(scenario)
+    assert frame.startswith(f"id: {current}\n")
@@ -0,0 +1,60 @@
+import base64
+from io import BytesIO
+import os
+
+from PIL import Image
+import pytest
+
+import api
+import imagestore
+from models import Drug
+
+@pytest.fixture(autouse=True)
+def store_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(imagestore, 'STORE_DIR', str(tmp_path / 'store'))
+
+def png_bytes(color='red'):
+    buffer = BytesIO()
+    Image.new('RGB', (40, 30), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def test_put_writes_verified_renditions():
+    digest = imagestore.put(png_bytes())
+    assert digest == imagestore.digest_of(png_bytes())
+    assert imagestore.verify(digest)
+    assert imagestore.rendition(digest, 64) is not None
+
+def test_release_deletes_only_unreferenced_unpinned_entries(session):
+    digest = imagestore.put(png_bytes())
+    session.add(Drug(id=1, name='Amoxicillin', image_hash=digest))
+    session.commit()
+    imagestore.release(session, digest)
+    assert imagestore.exists(digest)
+
+    session.query(Drug).delete()
+    session.commit()
+    with imagestore.pinned(digest):
+        # An upload of the same image is about to reference the entry
+        imagestore.release(session, digest)
+        assert imagestore.exists(digest)
+    imagestore.release(session, digest)
+    assert not imagestore.exists(digest)
+
+def test_pin_taken_before_release_keeps_the_files_for_the_upload(session):
+    data = png_bytes('blue')
+    digest = imagestore.put(data)
+    with imagestore.pinned(imagestore.digest_of(data)):
+        imagestore.release(session, digest)
+        assert imagestore.put(data) == digest
+        assert imagestore.verify(digest)
+
+def test_drug_image_get_does_not_write(session):
+    data = png_bytes()
+    session.add(Drug(id=1, name='Amoxicillin', image_data='data:image/png;base64,' + base64.b64encode(data).decode()))
+    session.commit()
+    response = api.get_drug_image(1, request=None, db=session)
+    assert response.body == data and response.media_type == 'image/png'
+    session.expire_all()
+    assert session.get(Drug, 1).image_hash is None
+    assert not os.path.exists(imagestore.STORE_DIR)
+    assert not session.dirty and not session.new
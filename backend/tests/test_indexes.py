@@ -0,0 +1,37 @@
+"""EXPLAIN QUERY PLAN checks: each hot lookup is served by an index, never a full table scan"""
+import pytest
+
+import migrate_db
+
+# (query, fragment expected in its plan)
+PLAN_CHECKS = [
+    ("SELECT id FROM inventory WHERE warehouse_id = 1 AND drug_id = 1 AND expire_date = '2025-01'",
+     "(warehouse_id=? AND drug_id=? AND expire_date=?)"),
+    ("SELECT id FROM transfers WHERE status = 'pending'",
+     "ix_transfers_status"),
+    ("SELECT id FROM transfers WHERE source_warehouse_id = 1 AND drug_id = 1 AND expire_date = '2025-01'",
+     "ix_transfers_source_drug_expiry"),
+    ("SELECT id FROM transfers WHERE tool_id = 1",
+     "ix_transfers_tool"),
+    ("SELECT id FROM inventory WHERE drug_id = 1",
+     "ix_inventory_drug"),
+    ("SELECT id FROM inventory WHERE is_disposed = 0 AND expire_date <= '2025-01'",
+     "ix_inventory_disposed_expiry"),
+]
+
+@pytest.fixture(params=['create_all', 'migrated'])
+def indexed_conn(request, conn):
+    """The schema of a fresh install, or of a database that got its indexes from migrate_db"""
+    if request.param == 'migrated':
+        for name, _, _ in migrate_db.INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+        assert migrate_db.apply_indexes(conn.cursor())
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == migrate_db.INDEX_SET_VERSION
+    return conn
+
+@pytest.mark.parametrize('query, expected', PLAN_CHECKS)
+def test_query_uses_index(indexed_conn, query, expected):
+    plan = " ".join(row[-1] for row in indexed_conn.execute(f"EXPLAIN QUERY PLAN {query}").fetchall())
+    table = query.split(' FROM ')[1].split()[0]
+    assert f"SCAN {table}" not in plan
+    assert expected in plan
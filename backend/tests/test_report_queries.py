@@ -0,0 +1,30 @@
+import pytest
+from sqlalchemy import event
+
+import api
+from benchmark_queries import seed
+
+@pytest.fixture
+def statements(session):
+    seed(session, lots=12, disposed=4)
+    sent = []
+    engine = session.get_bind()
+    listener = lambda conn, cursor, statement, *args: sent.append(statement)
+    event.listen(engine, 'before_cursor_execute', listener)
+    yield sent
+    event.remove(engine, 'before_cursor_execute', listener)
+
+def test_expiring_drugs_is_one_query(session, statements):
+    rows = api.expiring_drugs(session)
+    assert len(rows) == 8
+    # The other statement is the settings lookup, cached after the first call
+    assert len(statements) <= 2
+    statements.clear()
+    api.expiring_drugs(session)
+    assert len(statements) == 1
+
+def test_disposed_drugs_is_one_query(session, statements):
+    rows = api.disposed_drugs(session)
+    assert len(rows) == 4
+    assert all(row['disposal_date'] == '2026-01-02 12:00:00' for row in rows)
+    assert len(statements) == 1
@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import event
+
+import api
+import reports
+from models import Drug, Inventory, Warehouse
+
+@pytest.fixture
+def rendered(monkeypatch, tmp_path):
+    """Renders recorded instead of drawn, on a thread instead of the process pool"""
+    calls = []
+
+    def fake_render(rows, warehouse_name, cache_path):
+        calls.append(rows)
+        with open(cache_path, 'wb') as f:
+            f.write(b'%PDF-1.4')
+        return cache_path
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(reports, 'REPORT_CACHE_DIR', str(tmp_path / 'report_cache'))
+    monkeypatch.setattr(reports, '_render_to_cache', fake_render)
+    monkeypatch.setattr(reports, 'get_executor', lambda: executor)
+    yield calls
+    executor.shutdown()
+
+@pytest.fixture
+def stocked(session):
+    session.add_all([Warehouse(id=1, name='Central', code='C1'), Drug(id=1, name='Amoxicillin')])
+    session.add(Inventory(warehouse_id=1, drug_id=1, expire_date='2027-01', quantity=5))
+    session.commit()
+    return session
+
+def submit(session):
+    job = api.submit_inventory_pdf_job(session, 1, None, None, None)
+    if job['future'] is not None:
+        job['future'].result()
+    return job
+
+def test_unchanged_report_is_served_without_reading_rows(stocked, rendered):
+    first = submit(stocked)
+    assert not first['cached'] and rendered == [[('Amoxicillin', '2027-01', 5)]]
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(stocked.get_bind(), 'before_cursor_execute', listener)
+    try:
+        second = submit(stocked)
+    finally:
+        event.remove(stocked.get_bind(), 'before_cursor_execute', listener)
+    assert second['cached'] and second['file'] == first['file']
+    assert statements == []
+    assert len(rendered) == 1
+
+def test_committed_change_renders_a_new_report(stocked, rendered):
+    first = submit(stocked)
+    stocked.query(Inventory).one().quantity = 7
+    stocked.commit()
+    second = submit(stocked)
+    assert not second['cached'] and second['file'] != first['file']
+    assert rendered[-1] == [('Amoxicillin', '2027-01', 7)]
+
+def test_rows_are_not_loaded_for_a_cached_file(rendered):
+    job = reports.submit_inventory_pdf({'warehouse_id': 1}, 'v1', lambda: ([('A', None, 1)], None))
+    job['future'].result()
+    cached = reports.submit_inventory_pdf({'warehouse_id': 1}, 'v1', lambda: pytest.fail('rows loaded'))
+    assert cached['cached']
+    assert reports.submit_inventory_pdf({'warehouse_id': 1}, 'v2', lambda: ([('A', None, 2)], None))['file'] != job['file']
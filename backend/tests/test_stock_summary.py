@@ -0,0 +1,39 @@
+import stock_summary
+
+def summary(conn):
+    return conn.execute("SELECT warehouse_id, drug_id, quantity, lot_count FROM stock_summary ORDER BY 1, 2").fetchall()
+
+def test_lots_are_summed_per_warehouse_and_drug(conn):
+    conn.executemany("INSERT INTO inventory (warehouse_id, drug_id, expire_date, quantity) VALUES (?, ?, ?, ?)",
+                     [(1, 1, '2027-01-01', 5), (1, 1, '2027-02-01', 7), (2, 1, '2027-01-01', 3)])
+    conn.execute("UPDATE inventory SET quantity = 10 WHERE warehouse_id = 2")
+    assert summary(conn) == [(1, 1, 12, 2), (2, 1, 10, 1)]
+    assert stock_summary.verify(conn.cursor()) == []
+
+def test_lot_without_warehouse_or_drug_is_left_out(conn):
+    conn.execute("INSERT INTO inventory (drug_id, warehouse_id, quantity) VALUES (NULL, 1, 5)")
+    conn.execute("INSERT INTO inventory (drug_id, warehouse_id, quantity) VALUES (1, NULL, 4)")
+    conn.execute("UPDATE inventory SET quantity = quantity + 1")
+    assert summary(conn) == []
+    # Giving the lot a drug brings it into the totals, taking it away removes it again
+    conn.execute("UPDATE inventory SET drug_id = 2 WHERE drug_id IS NULL")
+    assert summary(conn) == [(1, 2, 6, 1)]
+    conn.execute("UPDATE inventory SET drug_id = NULL WHERE drug_id = 2")
+    assert summary(conn) == []
+    conn.execute("DELETE FROM inventory")
+    assert stock_summary.verify(conn.cursor()) == []
+
+def test_install_replaces_outdated_triggers(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP TRIGGER trg_stock_summary_insert")
+    cursor.execute("""
+        CREATE TRIGGER trg_stock_summary_insert AFTER INSERT ON inventory
+        BEGIN
+            INSERT INTO stock_summary (warehouse_id, drug_id, quantity, lot_count)
+            VALUES (NEW.warehouse_id, NEW.drug_id, COALESCE(NEW.quantity, 0), 1);
+        END
+    """)
+    assert stock_summary.install(cursor) is True
+    assert stock_summary.install(cursor) is False
+    conn.execute("INSERT INTO inventory (drug_id, warehouse_id, quantity) VALUES (NULL, 1, 5)")
+    assert summary(conn) == []
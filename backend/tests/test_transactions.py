@@ -0,0 +1,59 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import database
+from api import begin_write_transaction
+from models import Warehouse
+
+@pytest.fixture
+def engine(db_path):
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", database.set_sqlite_pragmas)
+    event.listen(engine, "begin", database.begin_sqlite_transaction)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def db(engine):
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield db
+    db.close()
+
+def write_lock_taken(db_path):
+    other = sqlite3.connect(db_path, timeout=0, isolation_level=None)
+    try:
+        other.execute("BEGIN IMMEDIATE")
+        other.execute("ROLLBACK")
+        return False
+    except sqlite3.OperationalError as exc:
+        assert 'locked' in str(exc)
+        return True
+    finally:
+        other.close()
+
+def test_reads_do_not_take_the_write_lock(db, db_path):
+    db.query(Warehouse).all()
+    assert db.in_transaction()
+    assert not write_lock_taken(db_path)
+
+def test_write_transaction_after_a_read(db, db_path):
+    db.query(Warehouse).all()
+    begin_write_transaction(db)
+    assert write_lock_taken(db_path)
+    db.add(Warehouse(name='Main', code='W1'))
+    db.commit()
+    assert not write_lock_taken(db_path)
+    assert [w.name for w in db.query(Warehouse).all()] == ['Main']
+
+def test_write_transaction_on_a_fresh_session(db, db_path):
+    begin_write_transaction(db)
+    assert write_lock_taken(db_path)
+    db.rollback()
+    assert not write_lock_taken(db_path)
+
+def test_unknown_begin_mode(db):
+    with pytest.raises(ValueError):
+        db.connection(execution_options={database.SQLITE_BEGIN_OPTION: 'SHARED'})
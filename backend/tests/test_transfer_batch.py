@@ -0,0 +1,49 @@
+from fastapi import HTTPException
+import pytest
+
+import api
+from models import Drug, Inventory, Warehouse
+from principals import Principal
+
+@pytest.fixture
+def stocked(session):
+    session.add_all([
+        Warehouse(id=1, name='Central', code='C1'),
+        Warehouse(id=2, name='Pharmacy', code='P1'),
+        Warehouse(id=9, name='Transit', code='TRANSIT', is_virtual=True),
+        Drug(id=1, name='Amoxicillin', has_expiry_date=True)
+    ])
+    session.add(Inventory(warehouse_id=1, drug_id=1, expire_date='2027-01', quantity=5))
+    session.commit()
+    return session
+
+@pytest.fixture
+def warehouseman():
+    return Principal(2, 'keeper', 'Keeper', 'warehouseman', [1], [], 0)
+
+def lots(session):
+    return {(inv.warehouse_id, inv.expire_date): inv.quantity for inv in session.query(Inventory)}
+
+def test_ids_sent_as_strings(stocked, warehouseman):
+    result = api.create_transfer_batch({
+        'source_warehouse_id': '1',
+        'destination_warehouse_id': '2',
+        'lines': [{'drug_id': '1', 'expire_date': '2027-01', 'quantity': '3'}]
+    }, db=stocked, current_user=warehouseman)
+    assert [(t['source_warehouse_id'], t['destination_warehouse_id'], t['quantity_sent']) for t in result] == [(1, 2, 3)]
+    assert lots(stocked) == {(1, '2027-01'): 2, (9, '2027-01'): 3}
+
+def test_other_warehouse_is_refused(stocked, warehouseman):
+    with pytest.raises(HTTPException) as error:
+        api.create_transfer_batch({'source_warehouse_id': '2', 'lines': [{'drug_id': 1, 'quantity': 1}]},
+                                  db=stocked, current_user=warehouseman)
+    assert error.value.status_code == 403
+
+@pytest.mark.parametrize('field', ['source_warehouse_id', 'destination_warehouse_id', 'consumer_id'])
+def test_malformed_id_is_a_bad_request(stocked, admin, field):
+    data = {'source_warehouse_id': 1, 'lines': [{'drug_id': 1, 'expire_date': '2027-01', 'quantity': 1}]}
+    data[field] = 'abc'
+    with pytest.raises(HTTPException) as error:
+        api.create_transfer_batch(data, db=stocked, current_user=admin)
+    assert error.value.status_code == 400
+    assert lots(stocked) == {(1, '2027-01'): 5}
@@ -2,7 +2,7 @@ import React, { useState } from 'react';
 import { Box, Typography, Button, Alert, CircularProgress } from '@mui/material';
 import BackupIcon from '@mui/icons-material/Backup';
 import axios from 'axios';
-import { API_BASE_URL } from '../utils/api';
+import { API_BASE_URL, getBackupJob } from '../utils/api';
 
 function BackupPanel() {
   const [loading, setLoading] = useState(false);
@@ -24,9 +24,17 @@ function BackupPanel() {
       
       setMessage(response.data.message);
       
-      // Show backup file name in console
-      if (response.data.backup) {
-        console.log('Backup created:', response.data.backup);
+      // The backup runs in the background; follow the job until it finishes
+      let job = response.data;
+      while (job.status === 'queued' || job.status === 'running') {
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+        job = (await getBackupJob(job.job_id)).data;
+      }
+      if (job.status === 'done') {
+        setMessage(`بکاپ با موفقیت ایجاد شد: ${job.backup}`);
+      } else {
+        setMessage(null);
+        setError(`خطا در ایجاد بکاپ: ${job.error}`);
       }
     } catch (err) {
       console.error('Backup error:', err);
@@ -13,7 +13,7 @@ import ImageIcon from '@mui/icons-material/Image';
 import InfoIcon from '@mui/icons-material/Info';
 import SearchIcon from '@mui/icons-material/Search';
 import axios from 'axios';
-import { API_BASE_URL } from '../utils/api';
+import { API_BASE_URL, imageUrl as storedImageUrl } from '../utils/api';
 import { canEdit, isAdmin } from '../utils/permissions';
 import { useCurrentUser } from '../utils/useCurrentUser';
 
@@ -252,17 +252,19 @@ function DrugManagement() {
       headerName: 'نام دارو',
       width: 250,
       renderCell: (params) => {
-        // Use new drug-image endpoint for better fallback support
-        const imageUrl = params.row.image ? `${API_BASE_URL}/drug-image/${params.row.id}` : null;
+        // Stored images come from the image store at the size needed; drug-image covers drugs not moved there yet
+        const hash = params.row.image_hash;
+        const imageUrl = hash ? storedImageUrl(hash, 800) : (params.row.image ? `${API_BASE_URL}/drug-image/${params.row.id}` : null);
+        const previewUrl = hash ? storedImageUrl(hash, 200) : imageUrl;
         
         return (
           <Box display="flex" alignItems="center" gap={1}>
-            <Avatar sx={{ bgcolor: 'primary.main', width: 32, height: 32 }}>
+            <Avatar src={hash ? storedImageUrl(hash, 64) : undefined} sx={{ bgcolor: 'primary.main', width: 32, height: 32 }}>
               <LocalPharmacyIcon fontSize="small" />
             </Avatar>
             {imageUrl ? (
               <Tooltip
-                title={<img src={imageUrl} alt="تصویر دارو" style={{ maxWidth: 120, maxHeight: 120, borderRadius: 8 }} />}
+                title={<img src={previewUrl} alt="تصویر دارو" style={{ maxWidth: 120, maxHeight: 120, borderRadius: 8 }} />}
                 placement="top"
                 arrow
               >
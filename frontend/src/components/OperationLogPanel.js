@@ -10,12 +10,17 @@ import ExpandLessIcon from '@mui/icons-material/ExpandLess';
 import PersonIcon from '@mui/icons-material/Person';
 import SearchIcon from '@mui/icons-material/Search';
 import FilterListIcon from '@mui/icons-material/FilterList';
-import { getLogs, getUsers } from '../utils/api';
+import DownloadIcon from '@mui/icons-material/Download';
+import { getLogs, exportLogs, getUsers } from '../utils/api';
 import moment from 'jalali-moment';
 
+const PAGE_SIZE = 200;
+
 function OperationLogPanel() {
-  const [allLogs, setAllLogs] = useState([]);
   const [filteredLogs, setFilteredLogs] = useState([]);
+  const [totalCount, setTotalCount] = useState(0);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [users, setUsers] = useState([]);
   const [expandedLogs, setExpandedLogs] = useState({});
   
@@ -34,52 +39,81 @@ function OperationLogPanel() {
     }).catch(err => console.error(err));
   }, []);
 
+  // Filters are applied on the server; Jalali dates are converted to the Gregorian log timestamps
+  const buildFilterParams = () => {
+    const params = {};
+    if (filterFromDate) {
+      params.from_time = moment.from(filterFromDate, 'fa', 'YYYY/MM/DD').format('YYYY-MM-DD');
+    }
+    if (filterToDate) {
+      params.to_time = moment.from(filterToDate, 'fa', 'YYYY/MM/DD').format('YYYY-MM-DD');
+    }
+    if (filterUser) {
+      params.user_id = filterUser;
+    }
+    if (filterAction) {
+      params.action = filterAction;
+    }
+    return params;
+  };
+
+  const fetchPage = async (cursor) => {
+    const params = { ...buildFilterParams(), limit: PAGE_SIZE };
+    if (cursor) {
+      params.before_id = cursor;
+    }
+    const res = await getLogs(params);
+    setTotalCount(parseInt(res.headers['x-total-count'] || res.data.length, 10));
+    setNextCursor(res.headers['x-next-cursor'] || null);
+    return res.data;
+  };
+
   const handleSearch = async () => {
     try {
-      const res = await getLogs();
-      let filtered = res.data;
-      
-      // Filter by date range - Convert Gregorian to Jalali for comparison
-      if (filterFromDate) {
-        filtered = filtered.filter(log => {
-          // Convert log timestamp (Gregorian) to Jalali
-          const logDateJalali = moment(log.timestamp, 'YYYY-MM-DD HH:mm:ss').locale('fa').format('YYYY/MM/DD');
-          return logDateJalali >= filterFromDate;
-        });
-      }
-      
-      if (filterToDate) {
-        filtered = filtered.filter(log => {
-          // Convert log timestamp (Gregorian) to Jalali
-          const logDateJalali = moment(log.timestamp, 'YYYY-MM-DD HH:mm:ss').locale('fa').format('YYYY/MM/DD');
-          return logDateJalali <= filterToDate;
-        });
-      }
-      
-      // Filter by user
-      if (filterUser) {
-        filtered = filtered.filter(log => log.user_id === parseInt(filterUser));
-      }
-      
-      // Filter by action
-      if (filterAction) {
-        filtered = filtered.filter(log => log.action.includes(filterAction));
-      }
-      
-      setAllLogs(res.data);
-      setFilteredLogs(filtered);
+      const logs = await fetchPage(null);
+      setFilteredLogs(logs);
       setHasSearched(true);
     } catch (err) {
       console.error(err);
     }
   };
 
+  const handleLoadMore = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const logs = await fetchPage(nextCursor);
+      setFilteredLogs(prev => [...prev, ...logs]);
+    } catch (err) {
+      console.error(err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  const handleExport = async () => {
+    try {
+      const res = await exportLogs({ ...buildFilterParams(), format: 'csv' });
+      const url = window.URL.createObjectURL(new Blob([res.data], { type: 'text/csv' }));
+      const link = document.createElement('a');
+      link.href = url;
+      link.setAttribute('download', 'operation_logs.csv');
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
+    } catch (err) {
+      console.error(err);
+    }
+  };
+
   const clearFilters = () => {
     setFilterFromDate('');
     setFilterToDate('');
     setFilterUser('');
     setFilterAction('');
     setFilteredLogs([]);
+    setTotalCount(0);
+    setNextCursor(null);
     setHasSearched(false);
   };
 
@@ -211,6 +245,13 @@ function OperationLogPanel() {
                 >
                   پاک کردن فیلترها
                 </Button>
+                <Button 
+                  variant="outlined" 
+                  startIcon={<DownloadIcon />}
+                  onClick={handleExport}
+                >
+                  خروجی CSV
+                </Button>
                 <Button 
                   variant="contained" 
                   startIcon={<SearchIcon />}
@@ -242,7 +283,7 @@ function OperationLogPanel() {
             <Box>
               <Box sx={{ display: 'flex', justifyContent: 'space-between', alignItems: 'center', mb: 2 }}>
                 <Typography variant="subtitle1" color="text.secondary">
-                  تعداد نتایج: {filteredLogs.length} عملیات
+                  تعداد نتایج: {totalCount} عملیات
                 </Typography>
               </Box>
               <List sx={{ width: '100%', bgcolor: 'background.paper' }}>
@@ -312,6 +353,13 @@ function OperationLogPanel() {
               );
             })}
             </List>
+            {nextCursor && (
+              <Box sx={{ display: 'flex', justifyContent: 'center', mt: 2 }}>
+                <Button variant="outlined" onClick={handleLoadMore} disabled={loadingMore}>
+                  نمایش موارد بیشتر ({filteredLogs.length} از {totalCount})
+                </Button>
+              </Box>
+            )}
             </Box>
         )}
       </Paper>
@@ -69,8 +69,8 @@ function ReportExport() {
   };
 
   const handleBackup = async () => {
-    await backupDB();
-    alert('بکاپ دیتابیس انجام شد');
+    const response = await backupDB();
+    alert(response.data.message);
   };
 
   const columns = [
@@ -53,7 +53,11 @@ function SettingsPanel() {
       return;
     }
     try {
-      await changePassword({ old_password: oldPassword, new_password: newPassword });
+      const res = await changePassword({ old_password: oldPassword, new_password: newPassword });
+      // Older tokens are revoked by a password change
+      if (res.data?.token) {
+        localStorage.setItem('token', res.data.token);
+      }
       setMessage('رمز عبور با موفقیت تغییر یافت');
       setSeverity('success');
       setOldPassword('');
@@ -77,7 +81,7 @@ function SettingsPanel() {
   const handleBackup = async () => {
     try {
       const response = await backupDB();
-      setMessage(`بکاپ دیتابیس با موفقیت انجام شد: ${response.data.backup}`);
+      setMessage(response.data.message);
       setSeverity('success');
     } catch (err) {
       setMessage('خطا در تهیه بکاپ');
@@ -12,7 +12,7 @@ import ImageIcon from '@mui/icons-material/Image';
 import InfoIcon from '@mui/icons-material/Info';
 import SearchIcon from '@mui/icons-material/Search';
 import axios from 'axios';
-import { API_BASE_URL } from '../utils/api';
+import { API_BASE_URL, imageUrl as storedImageUrl } from '../utils/api';
 import { canEdit, isAdmin } from '../utils/permissions';
 import { useCurrentUser } from '../utils/useCurrentUser';
 
@@ -165,8 +165,8 @@ function ToolManagement() {
     setSnackbar({ ...snackbar, open: false });
   };
 
-  const handleViewImage = (imageUrl) => {
-    setDialogImageUrl(`${API_BASE_URL.replace('/api', '')}/${imageUrl}`);
+  const handleViewImage = (tool) => {
+    setDialogImageUrl(tool.image_hash ? storedImageUrl(tool.image_hash) : `${API_BASE_URL.replace('/api', '')}/${tool.image}`);
     setOpenImageDialog(true);
   };
 
@@ -211,7 +211,7 @@ function ToolManagement() {
       minWidth: 80,
       renderCell: (params) => (
         params.value ? (
-          <IconButton size="small" onClick={() => handleViewImage(params.value)}>
+          <IconButton size="small" onClick={() => handleViewImage(params.row)}>
             <ImageIcon color="primary" />
           </IconButton>
         ) : <Typography variant="body2" color="text.secondary">-</Typography>
@@ -11,25 +11,48 @@ export const register = (data) => axios.post(`${BASE_URL}/register`, null, { par
 export const login = (data) => axios.post(`${BASE_URL}/login`, null, { params: data });
 export const recoverPassword = (data) => axios.post(`${BASE_URL}/recover-password`, null, { params: data });
 export const backupDB = () => axios.get(`${BASE_URL}/backup-db`);
+export const getBackupJob = (jobId) => axios.get(`${BASE_URL}/backups/jobs/${jobId}`);
 export const getExpiringDrugs = () => axios.get(`${BASE_URL}/expiring-drugs`);
 // سایر API ها را به همین صورت اضافه کنید
 
 export const getWarehouses = () => axios.get(`${BASE_URL}/warehouses`);
 export const addWarehouse = (data) => axios.post(`${BASE_URL}/warehouses`, data);
 export const getDrugs = () => axios.get(`${BASE_URL}/drugs`);
+// Content-addressed image renditions (64, 200 or 800 px); the URL never changes content, so browsers cache it for good
+export const imageUrl = (imageHash, size = 800) => `${BASE_URL}/images/${imageHash}?size=${size}`;
 export const addDrug = (data) => axios.post(`${BASE_URL}/drugs`, data);
 export const getSuppliers = () => axios.get(`${BASE_URL}/suppliers`);
 export const addSupplier = (data) => axios.post(`${BASE_URL}/suppliers`, data);
 export const getConsumers = () => axios.get(`${BASE_URL}/consumers`);
 export const addConsumer = (data) => axios.post(`${BASE_URL}/consumers`, data);
-export const getInventory = () => axios.get(`${BASE_URL}/inventory`);
+export const getInventory = (params) => axios.get(`${BASE_URL}/inventory`, { params });
+export const getInventorySummary = (params) => axios.get(`${BASE_URL}/inventory/summary`, { params });
 export const addInventory = (data) => axios.post(`${BASE_URL}/inventory`, data);
-export const getLogs = () => axios.get(`${BASE_URL}/logs`);
+export const bulkAddInventory = (lines) => axios.post(`${BASE_URL}/inventory/bulk`, lines);
+export const uploadInventoryReceipt = (file) => {
+  const fd = new FormData();
+  fd.append('file', file);
+  return axios.post(`${BASE_URL}/inventory/bulk/upload`, fd);
+};
+export const getLogs = (params) => axios.get(`${BASE_URL}/logs`, { params });
+export const exportLogs = (params) => axios.get(`${BASE_URL}/logs/export`, { params, responseType: 'blob' });
 
 export const getInventoryReport = (params) => axios.get(`${BASE_URL}/inventory/report`, { params });
 
 export const exportExcel = (params) => axios.get(`${BASE_URL}/export-excel`, { params, responseType: 'blob' });
-export const exportPDF = (params) => axios.get(`${BASE_URL}/export-pdf`, { params, responseType: 'blob' });
+// PDF reports are rendered in the background: submit a job, poll it, then download the file
+export const exportPDF = async (params) => {
+  const { data: job } = await axios.post(`${BASE_URL}/reports/inventory-pdf`, null, { params });
+  let status = job;
+  while (status.status !== 'done') {
+    if (status.status === 'failed') {
+      throw new Error(status.error || 'Report failed');
+    }
+    await new Promise(resolve => setTimeout(resolve, 1000));
+    status = (await axios.get(`${BASE_URL}/reports/jobs/${job.job_id}`)).data;
+  }
+  return axios.get(`${BASE_URL}/reports/jobs/${job.job_id}/download`, { responseType: 'blob' });
+};
 
 export const getUsers = () => axios.get(`${BASE_URL}/users`);
 export const addUser = (data) => axios.post(`${BASE_URL}/users`, data);
@@ -45,10 +68,22 @@ export const changePassword = (data) => {
 export const getSettings = () => axios.get(`${BASE_URL}/settings`);
 export const updateSettings = (data) => axios.post(`${BASE_URL}/settings`, data);
 
+// Incremental sync: pass the version from the previous response as since (0 for a full snapshot)
+export const syncChanges = (since, tables) => axios.get(`${BASE_URL}/sync`, { params: { since, tables } });
 export const getTransfers = () => axios.get(`${BASE_URL}/transfer/all`);
 export const createTransfer = (data) => axios.post(`${BASE_URL}/transfer`, data);
+export const createTransferBatch = (data) => axios.post(`${BASE_URL}/transfer/batch`, data);
 export const confirmTransfer = (id, quantity_received) => axios.post(`${BASE_URL}/transfer/${id}/confirm`, null, { params: { quantity_received } });
 export const rejectTransfer = (id) => axios.post(`${BASE_URL}/transfer/${id}/reject`);
+export const receiveTransfers = (items) => axios.post(`${BASE_URL}/transfer/receive`, { items });
+// Change feed (Server-Sent Events): onEvent gets {type, ...row}, e.g. transfer.created, inventory.lot.
+// type 'resync' means events were missed and the lists should be reloaded. Returns an unsubscribe function.
+export const subscribeChanges = (onEvent) => {
+  const token = localStorage.getItem('token');
+  const source = new EventSource(`${BASE_URL}/events?token=${encodeURIComponent(token)}`);
+  source.onmessage = (e) => onEvent(JSON.parse(e.data));
+  return () => source.close();
+};
 
 // Tools API
 export const getTools = () => axios.get(`${BASE_URL}/tools`);